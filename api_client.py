@@ -4,20 +4,62 @@ API客户端模块 - 处理与Hugging Face API的通信
 
 import requests
 import io
+import json
 import base64
+import threading
+from http.cookiejar import DefaultCookiePolicy
 from PIL import Image
-from config import API_ENDPOINTS, CONTROLNET_API_ENDPOINTS, CONTROLNET_TYPES, PROXY_CONFIG, API_SUPPORTED_MODELS
+from config import API_ENDPOINTS, CONTROLNET_API_ENDPOINTS, CONTROLNET_TYPES, PROXY_CONFIG, API_SUPPORTED_MODELS, QUEUE_CONFIG, HF_API_CONFIG
+from event_coalescing import superseded
+from metrics import stage, count_api_response
+from tracing import span, set_attributes
 
-# 全局变量
+# 全局变量（进程默认会话的Token，界面会话使用各自会话中的Token）
 HF_API_TOKEN = None
 
+# 所有会话共享的HTTP连接池
+_http_client = None
+_http_client_lock = threading.Lock()
+
 def set_api_token(token):
     """设置API Token"""
     global HF_API_TOKEN
     HF_API_TOKEN = token.strip() if token else None
 
-def validate_api_key(api_token):
-    """验证API Key的有效性 - 改进版本"""
+def get_http_client():
+    """获取共享的HTTP客户端：复用到Hugging Face的keep-alive连接；Token和代理按请求传入，
+    并禁用Cookie，避免不同会话之间共享状态"""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            client = requests.Session()
+            pool_size = QUEUE_CONFIG["limits"]["api"] + QUEUE_CONFIG["limits"]["ui"]
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            client.mount("https://", adapter)
+            client.mount("http://", adapter)
+            client.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            _http_client = client
+        return _http_client
+
+def build_proxies(proxy=None):
+    """把代理配置转换为requests的proxies参数，proxy为None时使用进程级代理配置"""
+    proxy = PROXY_CONFIG if proxy is None else proxy
+    proxies = {}
+    if proxy.get("enabled"):
+        if proxy.get("http"):
+            proxies["http"] = proxy["http"]
+        if proxy.get("https"):
+            proxies["https"] = proxy["https"]
+    return proxies or None
+
+def _session_credentials(session):
+    """取得请求使用的Token和代理配置：有会话时用会话设置，否则用进程级全局设置"""
+    if session is None:
+        return HF_API_TOKEN, PROXY_CONFIG
+    return session.get("api_token") or None, session.get("proxy") or PROXY_CONFIG
+
+def validate_api_key(api_token, session=None):
+    """验证API Key的有效性 - 改进版本（使用会话的代理设置）"""
     if not api_token.strip():
         return "⚠️ 请输入有效的API Token"
     
@@ -32,20 +74,14 @@ def validate_api_key(api_token):
     
     try:
         # 构建代理配置
-        proxies = None
-        if PROXY_CONFIG.get('enabled'):
-            proxies = {}
-            if PROXY_CONFIG.get('http'):
-                proxies['http'] = PROXY_CONFIG['http']
-            if PROXY_CONFIG.get('https'):
-                proxies['https'] = PROXY_CONFIG['https']
+        proxies = build_proxies(_session_credentials(session)[1])
         
         headers = {"Authorization": f"Bearer {token}"}
         
         # 方法1: 尝试访问用户信息API (使用正确的v2端点)
         try:
-            response = requests.get(
-                "https://huggingface.co/api/whoami-v2",
+            response = get_http_client().get(
+                f"{HF_API_CONFIG['hub_url']}/api/whoami-v2",
                 headers=headers,
                 timeout=15,
                 proxies=proxies
@@ -70,10 +106,14 @@ def validate_api_key(api_token):
             # whoami API失败，尝试其他方法
             pass
         
+        # 输入已变化时不再继续发起后续验证请求
+        if superseded():
+            return "⏭️ Token已更新，跳过旧Token验证"
+        
         # 方法2: 尝试访问模型列表API（更宽松的验证）
         try:
-            response = requests.get(
-                "https://huggingface.co/api/models",
+            response = get_http_client().get(
+                f"{HF_API_CONFIG['hub_url']}/api/models",
                 headers=headers,
                 timeout=15,
                 proxies=proxies,
@@ -92,10 +132,13 @@ def validate_api_key(api_token):
         except requests.exceptions.RequestException:
             pass
         
+        if superseded():
+            return "⏭️ Token已更新，跳过旧Token验证"
+        
         # 方法3: 最后尝试简单的推理API检查（HEAD请求）
         try:
-            test_endpoint = "https://api-inference.huggingface.co/models/runwayml/stable-diffusion-v1-5"
-            response = requests.head(
+            test_endpoint = f"{HF_API_CONFIG['inference_url']}/models/runwayml/stable-diffusion-v1-5"
+            response = get_http_client().head(
                 test_endpoint,
                 headers=headers,
                 timeout=10,
@@ -134,8 +177,8 @@ def check_model_api_support(model_id, run_mode):
         available_models = ", ".join([API_SUPPORTED_MODELS.get(m, m) for m in API_ENDPOINTS.keys()])
         return f"❌ API模式不支持此模型\n💡 支持的模型: {available_models}"
 
-def test_model_api_connection(model_id, api_token):
-    """测试模型API连接 - 改进版本"""
+def test_model_api_connection(model_id, api_token, session=None):
+    """测试模型API连接 - 改进版本（使用会话的代理设置）"""
     if not api_token.strip():
         return "⚠️ 请先输入有效的API Token"
     
@@ -147,16 +190,10 @@ def test_model_api_connection(model_id, api_token):
         headers = {"Authorization": f"Bearer {api_token.strip()}"}
         
         # 构建代理配置
-        proxies = None
-        if PROXY_CONFIG.get('enabled'):
-            proxies = {}
-            if PROXY_CONFIG.get('http'):
-                proxies['http'] = PROXY_CONFIG['http']
-            if PROXY_CONFIG.get('https'):
-                proxies['https'] = PROXY_CONFIG['https']
+        proxies = build_proxies(_session_credentials(session)[1])
         
         # 使用HEAD请求检查API可访问性（不实际生成图片）
-        response = requests.head(
+        response = get_http_client().head(
             endpoint,
             headers=headers,
             timeout=10,
@@ -188,29 +225,36 @@ def test_model_api_connection(model_id, api_token):
     except Exception as e:
         return f"❌ 连接测试失败: {str(e)[:50]}..."
 
-def query_hf_api(endpoint, payload, api_token=None):
-    """Call Hugging Face API with proxy support"""
+def query_hf_api(endpoint, payload, api_token=None, proxy=None):
+    """Call Hugging Face API with proxy support (proxy=None uses the process-wide proxy config)"""
     headers = {"Content-Type": "application/json"}
     if api_token:
         headers["Authorization"] = f"Bearer {api_token}"
     
     # 配置代理
-    proxies = {}
-    if PROXY_CONFIG["enabled"]:
-        if PROXY_CONFIG["http"]:
-            proxies["http"] = PROXY_CONFIG["http"]
-        if PROXY_CONFIG["https"]:
-            proxies["https"] = PROXY_CONFIG["https"]
+    proxies = build_proxies(proxy) or {}
     
+    # 先序列化请求体，以便在追踪中记录发送的字节数
+    body = json.dumps(payload).encode("utf-8")
+    with span("api.query", endpoint=endpoint, proxy=bool(proxies), bytes_sent=len(body)):
+        return _post_inference(endpoint, body, headers, proxies)
+
+def _post_inference(endpoint, body, headers, proxies):
+    """Send the serialized payload to the inference endpoint and map errors to ASCII-safe messages"""
     try:
         # 增加超时时间并使用代理
-        response = requests.post(
-            endpoint, 
-            headers=headers, 
-            json=payload, 
-            timeout=120,  # 增加到2分钟
-            proxies=proxies if proxies else None
-        )
+        with stage("network_wait"):
+            response = get_http_client().post(
+                endpoint, 
+                headers=headers, 
+                data=body, 
+                timeout=120,  # 增加到2分钟
+                proxies=proxies if proxies else None
+            )
+        count_api_response(response.status_code)
+        # elapsed为发出请求到收到响应头的耗时，与network_wait之差即响应体下载耗时
+        set_attributes(status=response.status_code, bytes_received=len(response.content),
+                       time_to_headers_ms=round(response.elapsed.total_seconds() * 1000, 3))
         
         if response.status_code == 200:
             return response.content
@@ -235,9 +279,11 @@ def query_hf_api(endpoint, payload, api_token=None):
                 error_text = "API response encoding error"
             raise Exception(f"API call failed: {response.status_code}, {error_text}")
     except requests.exceptions.Timeout:
+        count_api_response("timeout")
         proxy_info = f" (using proxy: {proxies})" if proxies else " (no proxy)"
         raise Exception(f"API call timeout after 120s{proxy_info}, please check network connection or proxy settings")
     except requests.exceptions.ConnectionError as e:
+        count_api_response("connection_error")
         proxy_info = f" (using proxy: {proxies})" if proxies else " (no proxy)"
         raise Exception(f"Network connection error{proxy_info}, please check network settings or try enabling proxy")
     except Exception as e:
@@ -249,8 +295,24 @@ def query_hf_api(endpoint, payload, api_token=None):
             error_msg = "API call error with encoding issues"
         raise Exception(error_msg)
 
-def generate_image_api(prompt, negative_prompt="", model_id="runwayml/stable-diffusion-v1-5"):
-    """Generate image using API"""
+def encode_image_b64(image):
+    """Encode a PIL image as base64 PNG for API payloads"""
+    with stage("image_encode"):
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        return base64.b64encode(buffered.getvalue()).decode()
+
+def decode_response_image(image_bytes, raw=False):
+    """Decode the image returned by the API (raw=True keeps the encoded bytes)"""
+    if raw:
+        return image_bytes
+    with stage("response_decode"):
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+    return image
+
+def generate_image_api(prompt, negative_prompt="", model_id="runwayml/stable-diffusion-v1-5", num_steps=20, guidance_scale=7.5, raw=False, session=None):
+    """Generate image using API (raw=True returns the encoded bytes from the API without decoding; session supplies token and proxy)"""
     endpoint = API_ENDPOINTS.get(model_id)
     if not endpoint:
         raise Exception(f"Model {model_id} does not support API mode")
@@ -267,28 +329,30 @@ def generate_image_api(prompt, negative_prompt="", model_id="runwayml/stable-dif
         "inputs": safe_prompt,
         "parameters": {
             "negative_prompt": safe_negative_prompt,
-            "num_inference_steps": 20,
-            "guidance_scale": 7.5,
+            "num_inference_steps": int(num_steps),
+            "guidance_scale": float(guidance_scale),
         }
     }
     
     try:
-        image_bytes = query_hf_api(endpoint, payload, HF_API_TOKEN)
-        image = Image.open(io.BytesIO(image_bytes))
+        api_token, proxy = _session_credentials(session)
+        image_bytes = query_hf_api(endpoint, payload, api_token, proxy)
+        image = decode_response_image(image_bytes, raw)
         return image, "API image generation successful!"
     except Exception as e:
         return None, f"API generation failed: {str(e)}"
 
-def generate_controlnet_image_api(prompt, negative_prompt, control_image, control_type):
-    """Generate ControlNet image using API"""
+def generate_controlnet_image_api(prompt, negative_prompt, control_image, control_type, controlnet_conditioning_scale=None, raw=False, session=None):
+    """Generate ControlNet image using API (raw=True returns the encoded bytes from the API without decoding; session supplies token and proxy)"""
     endpoint = CONTROLNET_API_ENDPOINTS.get(control_type)
     if not endpoint:
         raise Exception(f"ControlNet type {control_type} does not support API mode")
     
-    # Convert control image to base64
-    buffered = io.BytesIO()
-    control_image.save(buffered, format="PNG")
-    control_image_b64 = base64.b64encode(buffered.getvalue()).decode()
+    # Convert control image to base64 (already-encoded strings are reused as-is)
+    if isinstance(control_image, str):
+        control_image_b64 = control_image
+    else:
+        control_image_b64 = encode_image_b64(control_image)
     
     # Ensure prompt and negative_prompt are safe
     try:
@@ -305,27 +369,31 @@ def generate_controlnet_image_api(prompt, negative_prompt, control_image, contro
             "negative_prompt": safe_negative_prompt
         }
     }
+    if controlnet_conditioning_scale is not None:
+        payload["parameters"] = {"controlnet_conditioning_scale": float(controlnet_conditioning_scale)}
     
     try:
-        image_bytes = query_hf_api(endpoint, payload, HF_API_TOKEN)
-        image = Image.open(io.BytesIO(image_bytes))
+        api_token, proxy = _session_credentials(session)
+        image_bytes = query_hf_api(endpoint, payload, api_token, proxy)
+        image = decode_response_image(image_bytes, raw)
         control_type_name = CONTROLNET_TYPES[control_type]['name']
         return image, f"API mode {control_type_name} image generation successful!"
     except Exception as e:
         return None, f"ControlNet API generation failed: {str(e)}"
 
-def generate_img2img_api(prompt, negative_prompt, input_image, strength):
-    """Generate img2img image using API"""
+def generate_img2img_api(prompt, negative_prompt, input_image, strength, raw=False, session=None):
+    """Generate img2img image using API (raw=True returns the encoded bytes from the API without decoding; session supplies token and proxy)"""
     # Note: Hugging Face public API has limited img2img support
     # This is a basic implementation that may need adjustment
     endpoint = API_ENDPOINTS.get("runwayml/stable-diffusion-v1-5")  # Use default model
     if not endpoint:
         raise Exception("img2img API mode not supported")
     
-    # Convert input image to base64
-    buffered = io.BytesIO()
-    input_image.save(buffered, format="PNG")
-    input_image_b64 = base64.b64encode(buffered.getvalue()).decode()
+    # Convert input image to base64 (already-encoded strings are reused as-is)
+    if isinstance(input_image, str):
+        input_image_b64 = input_image
+    else:
+        input_image_b64 = encode_image_b64(input_image)
     
     # Ensure prompt and negative_prompt are safe
     try:
@@ -345,8 +413,9 @@ def generate_img2img_api(prompt, negative_prompt, input_image, strength):
     }
     
     try:
-        image_bytes = query_hf_api(endpoint, payload, HF_API_TOKEN)
-        image = Image.open(io.BytesIO(image_bytes))
+        api_token, proxy = _session_credentials(session)
+        image_bytes = query_hf_api(endpoint, payload, api_token, proxy)
+        image = decode_response_image(image_bytes, raw)
         return image, "API mode img2img generation successful!"
     except Exception as e:
         return None, f"img2img API generation failed: {str(e)}"
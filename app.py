@@ -3,22 +3,35 @@
 重构后的模块化版本
 """
 
+import os
+import functools
 import gradio as gr
 import warnings
 
 # 导入自定义模块
-from config import CONTROLNET_TYPES, PROMPT_CATEGORIES, NEGATIVE_PROMPT_CATEGORIES, API_SUPPORTED_MODELS, MODELS, update_proxy_config
-from models import load_models, get_current_model_info
-from image_generation import generate_image, generate_controlnet_image, generate_img2img, add_prompt_tags
-from api_client import validate_api_key, check_model_api_support, test_model_api_connection, set_api_token
+from config import CONTROLNET_TYPES, PROMPT_CATEGORIES, NEGATIVE_PROMPT_CATEGORIES, API_SUPPORTED_MODELS, MODELS, build_proxy_config, describe_proxy_config
+from config import LOCAL_MAX_DIRECT_RESOLUTION, LOCAL_MAX_RESOLUTION, LOCAL_BACKENDS, SERVICE_CONFIG, METRICS_CONFIG, JOB_QUEUE_CONFIG, OUTPUT_CONFIG
+from models import load_models, get_current_model_info, warmup_compiled_models
+from image_generation import generate_image_stream, generate_controlnet_image_stream, generate_img2img_stream, add_prompt_tags, generate_grid, GRID_PARAMETERS
+from api_client import validate_api_key, check_model_api_support, test_model_api_connection
 from utils import auto_push_to_github, test_proxy_connection, update_model_choices, setup_cleanup_handlers, find_free_port
+from concurrency import limited, lane_slot, event_options, configure_queue, watch_timeout
+from event_coalescing import coalesce
+from session import create_session
+from memory_accounting import format_memory_report
+from job_queue import submit_job, get_job, list_jobs, cancel_job, watch_job, format_job, format_job_list, TERMINAL_STATES
 import utils  # 导入utils模块以便访问全局变量
 
 warnings.filterwarnings("ignore")
 
+RESOLUTION_INFO = f"超过 {LOCAL_MAX_DIRECT_RESOLUTION} 时本地模式自动启用分块VAE解码"
+
 # 创建Gradio界面
 def create_interface():
     with gr.Blocks(title="🎨 AI 图像生成器", theme=gr.themes.Soft()) as demo:
+        # 每个浏览器会话独立的运行模式/模型/ControlNet/Token/代理设置，互不影响
+        session_state = gr.State(create_session())
+        
         gr.Markdown("""
         # 🎨 AI 图像生成器 Pro
         
@@ -73,6 +86,13 @@ def create_interface():
                     info="选择不同的控制方式"
                 )
                 
+                local_backend_dropdown = gr.Dropdown(
+                    choices=[(f"{info['name']} - {info['description']}", key) for key, info in LOCAL_BACKENDS.items()],
+                    value="pytorch",
+                    label="⚙️ 本地推理后端",
+                    info="仅本地模式生效"
+                )
+                
                 # API Token 设置
                 with gr.Accordion("🔑 API设置 (API模式必看)", open=True):
                     gr.Markdown("""
@@ -152,12 +172,14 @@ def create_interface():
                     test_proxy_btn = gr.Button("🔗 测试代理连接", variant="secondary")
                     
                     test_proxy_btn.click(
-                        test_proxy_connection,
+                        limited("ui")(test_proxy_connection),
                         inputs=[proxy_enabled, http_proxy_input, https_proxy_input],
-                        outputs=[proxy_status]
+                        outputs=[proxy_status],
+                        **event_options("ui")
                     )
                     
                 load_btn = gr.Button("🚀 加载选中模型", variant="primary", size="lg")
+                warmup_btn = gr.Button("🔥 预热编译分桶 (仅torch.compile后端)", variant="secondary")
                 
             with gr.Column(scale=2):
                 current_model_display = gr.Textbox(
@@ -169,6 +191,23 @@ def create_interface():
         
         load_status = gr.Textbox(label="加载状态", value="选择模型后点击加载开始使用", lines=3)
         
+        # 内存占用总览：进程内存、已加载管道各组件（按dtype）、缓存目录大小
+        with gr.Accordion("📊 内存占用", open=False):
+            memory_report = gr.Textbox(label="内存与缓存占用", lines=12, interactive=False)
+            memory_refresh_btn = gr.Button("🔄 刷新内存统计", variant="secondary")
+        
+        # 后台任务队列：各生成页的"加入后台队列"把请求写入任务数据库，由工作进程执行，刷新页面后可凭任务ID继续查看
+        with gr.Accordion("📥 后台任务队列", open=False):
+            with gr.Row():
+                job_id_box = gr.Textbox(label="任务ID", placeholder="提交后自动填入，也可粘贴之前的任务ID", scale=3)
+                job_watch_btn = gr.Button("👀 跟踪进度", variant="secondary", scale=1)
+                job_cancel_btn = gr.Button("🚫 取消任务", variant="stop", scale=1)
+            with gr.Row():
+                job_status = gr.Textbox(label="任务状态", lines=5, interactive=False)
+                job_result = gr.Image(label="任务结果", type="filepath")
+            job_list = gr.Textbox(label="最近任务", lines=8, interactive=False)
+            job_list_btn = gr.Button("🔄 刷新任务列表", variant="secondary")
+        
         # GitHub 自动推送区域
         with gr.Accordion("🚀 GitHub 自动推送", open=False):
             gr.Markdown("""
@@ -314,14 +353,17 @@ def create_interface():
                             guidance_scale1 = gr.Slider(1, 20, value=7.5, step=0.5, label="引导强度")
                         
                         with gr.Row():
-                            width1 = gr.Slider(256, 1024, value=512, step=64, label="宽度")
-                            height1 = gr.Slider(256, 1024, value=512, step=64, label="高度")
+                            width1 = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="宽度", info=RESOLUTION_INFO)
+                            height1 = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="高度", info=RESOLUTION_INFO)
                         
                         seed1 = gr.Number(label="随机种子 (-1为随机)", value=-1)
-                        generate_btn1 = gr.Button("🎨 生成图像", variant="primary")
+                        with gr.Row():
+                            generate_btn1 = gr.Button("🎨 生成图像", variant="primary")
+                            stop_btn1 = gr.Button("⏹️ 停止", variant="stop")
+                            queue_btn1 = gr.Button("📥 加入后台队列", variant="secondary")
                     
                     with gr.Column(scale=1):
-                        output_image1 = gr.Image(label="生成的图像", type="pil")
+                        output_image1 = gr.Image(label="生成的图像", type="filepath")
                         output_status1 = gr.Textbox(label="生成状态")
             
             # Tab 2: 传统图生图
@@ -354,14 +396,17 @@ def create_interface():
                             guidance_scale_img2img = gr.Slider(1, 20, value=7.5, step=0.5, label="引导强度")
                         
                         with gr.Row():
-                            width_img2img = gr.Slider(256, 1024, value=512, step=64, label="宽度")
-                            height_img2img = gr.Slider(256, 1024, value=512, step=64, label="高度")
+                            width_img2img = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="宽度", info=RESOLUTION_INFO)
+                            height_img2img = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="高度", info=RESOLUTION_INFO)
                         
                         seed_img2img = gr.Number(label="随机种子 (-1为随机)", value=-1)
-                        generate_btn_img2img = gr.Button("🔄 传统图生图", variant="secondary")
+                        with gr.Row():
+                            generate_btn_img2img = gr.Button("🔄 传统图生图", variant="secondary")
+                            stop_btn_img2img = gr.Button("⏹️ 停止", variant="stop")
+                            queue_btn_img2img = gr.Button("📥 加入后台队列", variant="secondary")
                     
                     with gr.Column(scale=1):
-                        output_image_img2img = gr.Image(label="生成的图像", type="pil")
+                        output_image_img2img = gr.Image(label="生成的图像", type="filepath")
                         output_status_img2img = gr.Textbox(label="生成状态")
             
             # Tab 3: ControlNet图像引导
@@ -401,17 +446,63 @@ def create_interface():
                         controlnet_scale = gr.Slider(0.0, 2.0, value=1.0, step=0.1, label="ControlNet强度")
                         
                         with gr.Row():
-                            width2 = gr.Slider(256, 1024, value=512, step=64, label="宽度")
-                            height2 = gr.Slider(256, 1024, value=512, step=64, label="高度")
+                            width2 = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="宽度", info=RESOLUTION_INFO)
+                            height2 = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="高度", info=RESOLUTION_INFO)
                         
                         seed2 = gr.Number(label="随机种子 (-1为随机)", value=-1)
-                        generate_btn2 = gr.Button("🎨 ControlNet生成", variant="primary")
+                        with gr.Row():
+                            generate_btn2 = gr.Button("🎨 ControlNet生成", variant="primary")
+                            stop_btn2 = gr.Button("⏹️ 停止", variant="stop")
+                            queue_btn2 = gr.Button("📥 加入后台队列", variant="secondary")
                     
                     with gr.Column(scale=1):
                         with gr.Row():
                             control_preview = gr.Image(label="控制图像预览", type="pil")
-                            output_image2 = gr.Image(label="生成的图像", type="pil")
+                            output_image2 = gr.Image(label="生成的图像", type="filepath")
                         output_status2 = gr.Textbox(label="生成状态")
+            
+            # Tab 4: 参数网格扫描
+            with gr.TabItem("📊 参数网格"):
+                with gr.Row():
+                    with gr.Column(scale=1):
+                        grid_mode = gr.Radio(
+                            choices=[("📝 文生图", "txt2img"), ("🔄 传统图生图", "img2img"), ("🖼️ ControlNet", "controlnet")],
+                            value="txt2img",
+                            label="生成模式"
+                        )
+                        grid_input_image = gr.Image(label="输入/控制图像 (图生图与ControlNet需要)", type="pil")
+                        grid_control_type = gr.Radio(
+                            choices=[(info['name'], key) for key, info in CONTROLNET_TYPES.items()],
+                            value="canny",
+                            label="🎮 控制类型"
+                        )
+                        grid_prompt = gr.Textbox(label="提示词 (Prompt)", lines=3)
+                        grid_negative_prompt = gr.Textbox(label="负面提示词 (Negative Prompt)", lines=2)
+                        
+                        grid_param_choices = [("无", "none")] + [(info[0], key) for key, info in GRID_PARAMETERS.items()]
+                        with gr.Row():
+                            grid_x_param = gr.Dropdown(choices=grid_param_choices, value="guidance_scale", label="X轴参数")
+                            grid_x_values = gr.Textbox(label="X轴取值 (逗号分隔)", value="5, 7.5, 10")
+                        with gr.Row():
+                            grid_y_param = gr.Dropdown(choices=grid_param_choices, value="none", label="Y轴参数")
+                            grid_y_values = gr.Textbox(label="Y轴取值 (逗号分隔)", value="")
+                        
+                        gr.Markdown("**基础参数**（未被扫描的参数使用以下取值）")
+                        with gr.Row():
+                            grid_num_steps = gr.Slider(10, 50, value=20, step=1, label="采样步数")
+                            grid_guidance_scale = gr.Slider(1, 20, value=7.5, step=0.5, label="引导强度")
+                        with gr.Row():
+                            grid_strength = gr.Slider(0.1, 1.0, value=0.7, step=0.1, label="变化强度")
+                            grid_controlnet_scale = gr.Slider(0.0, 2.0, value=1.0, step=0.1, label="ControlNet强度")
+                        with gr.Row():
+                            grid_width = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="宽度", info=RESOLUTION_INFO)
+                            grid_height = gr.Slider(256, LOCAL_MAX_RESOLUTION, value=512, step=64, label="高度", info=RESOLUTION_INFO)
+                        grid_seed = gr.Number(label="随机种子 (-1为随机，固定种子便于对比)", value=42)
+                        generate_grid_btn = gr.Button("📊 生成参数网格", variant="primary")
+                    
+                    with gr.Column(scale=1):
+                        output_grid = gr.Image(label="参数网格联系表", type="filepath")
+                        output_status_grid = gr.Textbox(label="生成状态")
         
         # 示例和对比说明
         gr.Markdown("""
@@ -474,99 +565,108 @@ def create_interface():
         
         # 绑定事件
         
-        # API Token 设置事件
-        def update_api_token(token):
-            set_api_token(token)
-            return f"🔑 API Token {'已设置' if token else '未设置'}"
-        
-        # 运行模式切换事件 - 更新模型选择器和显示
-        def update_run_mode_and_models(mode):
+        # 运行模式切换事件 - 一个处理函数同时更新模式显示、模型选择器和API支持状态
+        @coalesce("run_mode", outputs=3)
+        def update_run_mode_and_models(mode, model_id):
             mode_text = "🌐 API模式" if mode == "api" else "💻 本地模式"
             storage_text = "存储占用: 0 GB" if mode == "api" else "存储占用: 4-10 GB"
             status_text = f"⚙️ {mode_text}\n💾 {storage_text}"
             
             # 同时更新模型选择器
             model_choices_info = update_model_choices(mode)
-            return status_text, gr.Dropdown.update(**model_choices_info)
+            return status_text, gr.Dropdown.update(**model_choices_info), check_model_api_support(model_id, mode)
         
         run_mode_radio.change(
             update_run_mode_and_models,
-            inputs=[run_mode_radio],
-            outputs=[current_model_display, model_dropdown]
-        )
-        
-        # 代理设置事件
-        def update_proxy_settings(enabled, http_proxy, https_proxy):
-            status = update_proxy_config(enabled, http_proxy, https_proxy)
-            return status
-        
-        proxy_enabled.change(
-            update_proxy_settings,
-            inputs=[proxy_enabled, http_proxy_input, https_proxy_input],
-            outputs=[proxy_status]
-        )
-        
-        http_proxy_input.change(
-            update_proxy_settings,
-            inputs=[proxy_enabled, http_proxy_input, https_proxy_input],
-            outputs=[proxy_status]
+            inputs=[run_mode_radio, model_dropdown],
+            outputs=[current_model_display, model_dropdown, model_api_status],
+            **event_options("ui")
         )
         
-        https_proxy_input.change(
-            update_proxy_settings,
-            inputs=[proxy_enabled, http_proxy_input, https_proxy_input],
-            outputs=[proxy_status]
-        )
+        # 代理设置事件 - 三个输入共用一个事件键，只应用最后一次；地址输入完成（失去焦点或回车）后才触发
+        @coalesce("proxy")
+        def update_proxy_settings(enabled, http_proxy, https_proxy, session):
+            session["proxy"] = build_proxy_config(enabled, http_proxy, https_proxy)
+            return describe_proxy_config(session["proxy"])
+        
+        for proxy_trigger in (proxy_enabled.change, http_proxy_input.blur, http_proxy_input.submit,
+                              https_proxy_input.blur, https_proxy_input.submit):
+            proxy_trigger(
+                update_proxy_settings,
+                inputs=[proxy_enabled, http_proxy_input, https_proxy_input, session_state],
+                outputs=[proxy_status],
+                **event_options("ui")
+            )
         
         # GitHub 推送事件
         push_to_github_btn.click(
             auto_push_to_github,
             inputs=[],
-            outputs=[github_status]
+            outputs=[github_status],
+            **event_options("generate")
         )
         
-        # API Token 实时验证
-        api_token_input.change(
-            validate_api_key,
-            inputs=[api_token_input],
-            outputs=[token_status]
-        )
-        
-        # 模型API支持检测
-        def update_model_api_status(model_id, run_mode):
-            return check_model_api_support(model_id, run_mode)
+        # API Token 验证 - 输入完成（失去焦点或回车）后才发起验证请求；Token只写入当前会话
+        @coalesce("api_token")
+        @limited("ui")
+        def update_session_token(api_token, session):
+            session["api_token"] = api_token.strip()
+            return validate_api_key(api_token, session)
+        
+        for token_trigger in (api_token_input.blur, api_token_input.submit):
+            token_trigger(
+                update_session_token,
+                inputs=[api_token_input, session_state],
+                outputs=[token_status],
+                **event_options("ui")
+            )
+        
+        # 模型切换事件 - 一个处理函数同时更新API支持状态和当前模型显示
+        @coalesce("model", outputs=2)
+        def update_model_status(model_id, run_mode):
+            return check_model_api_support(model_id, run_mode), f"📦 选中模型: {MODELS.get(model_id, model_id)}"
         
         model_dropdown.change(
-            update_model_api_status,
+            update_model_status,
             inputs=[model_dropdown, run_mode_radio],
-            outputs=[model_api_status]
-        )
-        
-        run_mode_radio.change(
-            update_model_api_status,
-            inputs=[model_dropdown, run_mode_radio],
-            outputs=[model_api_status]
+            outputs=[model_api_status, current_model_display],
+            **event_options("ui")
         )
         
         # API连接测试
         test_api_btn.click(
-            test_model_api_connection,
-            inputs=[model_dropdown, api_token_input],
-            outputs=[model_api_status]
+            limited("ui")(test_model_api_connection),
+            inputs=[model_dropdown, api_token_input, session_state],
+            outputs=[model_api_status],
+            **event_options("ui")
         )
         
-        # 模型加载事件
+        # 模型加载事件 - 本地加载很重，占用本地生成通道
+        def load_models_limited(run_mode, selected_model, controlnet_type, api_token, local_backend, session):
+            with lane_slot("api" if run_mode == "api" else "local"):
+                return load_models(run_mode, selected_model, controlnet_type, api_token, local_backend, session=session)
+        
         load_btn.click(
-            load_models, 
-            inputs=[run_mode_radio, model_dropdown, controlnet_dropdown, api_token_input], 
-            outputs=[load_status]
+            load_models_limited, 
+            inputs=[run_mode_radio, model_dropdown, controlnet_dropdown, api_token_input, local_backend_dropdown, session_state], 
+            outputs=[load_status],
+            api_name="load_models",
+            **event_options("generate")
         )
         
-        # 更新当前模型显示
-        model_dropdown.change(
-            lambda x: f"📦 选中模型: {MODELS.get(x, x)}",
-            inputs=[model_dropdown],
-            outputs=[current_model_display]
+        # 编译分桶预热，报告写入加载状态
+        warmup_btn.click(
+            limited("local")(warmup_compiled_models),
+            inputs=[session_state],
+            outputs=[load_status],
+            **event_options("generate")
+        )
+        
+        memory_refresh_btn.click(
+            limited("ui")(format_memory_report),
+            inputs=[],
+            outputs=[memory_report],
+            **event_options("ui")
         )
         
         # Prompt 辅助器事件
@@ -593,64 +693,181 @@ def create_interface():
         apply_positive_to_prompt1.click(
             get_selected_positive_tags,
             inputs=[quality_tags, style_tags, lighting_tags, composition_tags, mood_tags, scene_tags, color_tags],
-            outputs=[prompt1]
+            outputs=[prompt1],
+            **event_options("ui")
         )
         
         apply_positive_to_img2img.click(
             get_selected_positive_tags,
             inputs=[quality_tags, style_tags, lighting_tags, composition_tags, mood_tags, scene_tags, color_tags],
-            outputs=[prompt_img2img]
+            outputs=[prompt_img2img],
+            **event_options("ui")
         )
         
         apply_positive_to_prompt2.click(
             get_selected_positive_tags,
             inputs=[quality_tags, style_tags, lighting_tags, composition_tags, mood_tags, scene_tags, color_tags],
-            outputs=[prompt2]
+            outputs=[prompt2],
+            **event_options("ui")
         )
         
         # 负面词条应用到各个negative prompt框的事件
         apply_negative_to_prompt1.click(
             get_selected_negative_tags,
             inputs=[neg_quality_tags, neg_anatomy_tags, neg_face_tags, neg_style_tags, neg_tech_tags, neg_lighting_tags, neg_composition_tags],
-            outputs=[negative_prompt1]
+            outputs=[negative_prompt1],
+            **event_options("ui")
         )
         
         apply_negative_to_img2img.click(
             get_selected_negative_tags,
             inputs=[neg_quality_tags, neg_anatomy_tags, neg_face_tags, neg_style_tags, neg_tech_tags, neg_lighting_tags, neg_composition_tags],
-            outputs=[negative_prompt_img2img]
+            outputs=[negative_prompt_img2img],
+            **event_options("ui")
         )
         
         apply_negative_to_prompt2.click(
             get_selected_negative_tags,
             inputs=[neg_quality_tags, neg_anatomy_tags, neg_face_tags, neg_style_tags, neg_tech_tags, neg_lighting_tags, neg_composition_tags],
-            outputs=[negative_prompt2]
+            outputs=[negative_prompt2],
+            **event_options("ui")
         )
         
         # 清空标签
         clear_tags_btn.click(
             clear_all_tags,
             outputs=[quality_tags, style_tags, lighting_tags, composition_tags, mood_tags, scene_tags, color_tags,
-                    neg_quality_tags, neg_anatomy_tags, neg_face_tags, neg_style_tags, neg_tech_tags, neg_lighting_tags, neg_composition_tags]
+                    neg_quality_tags, neg_anatomy_tags, neg_face_tags, neg_style_tags, neg_tech_tags, neg_lighting_tags, neg_composition_tags],
+            **event_options("ui")
         )
         
-        # 图像生成事件
-        generate_btn1.click(
-            generate_image,
-            inputs=[prompt1, negative_prompt1, num_steps1, guidance_scale1, width1, height1, seed1],
-            outputs=[output_image1, output_status1]
+        # 图像生成事件（本地模式流式返回中间预览，停止按钮取消正在进行的生成；api_name 供 gradio_client 和压测工具调用）
+        generate_event1 = generate_btn1.click(
+            limited(outputs=2)(generate_image_stream),
+            inputs=[prompt1, negative_prompt1, num_steps1, guidance_scale1, width1, height1, seed1, session_state],
+            outputs=[output_image1, output_status1],
+            api_name="txt2img",
+            **event_options("generate")
         )
         
-        generate_btn_img2img.click(
-            generate_img2img,
-            inputs=[prompt_img2img, negative_prompt_img2img, input_image, strength, num_steps_img2img, guidance_scale_img2img, width_img2img, height_img2img, seed_img2img],
-            outputs=[output_image_img2img, output_status_img2img]
+        generate_event_img2img = generate_btn_img2img.click(
+            limited(outputs=2)(generate_img2img_stream),
+            inputs=[prompt_img2img, negative_prompt_img2img, input_image, strength, num_steps_img2img, guidance_scale_img2img, width_img2img, height_img2img, seed_img2img, session_state],
+            outputs=[output_image_img2img, output_status_img2img],
+            api_name="img2img",
+            **event_options("generate")
         )
         
-        generate_btn2.click(
-            generate_controlnet_image,
-            inputs=[prompt2, negative_prompt2, control_image, control_type_radio, num_steps2, guidance_scale2, controlnet_scale, width2, height2, seed2],
-            outputs=[output_image2, control_preview, output_status2]
+        generate_event2 = generate_btn2.click(
+            limited(outputs=3)(generate_controlnet_image_stream),
+            inputs=[prompt2, negative_prompt2, control_image, control_type_radio, num_steps2, guidance_scale2, controlnet_scale, width2, height2, seed2, session_state],
+            outputs=[output_image2, control_preview, output_status2],
+            api_name="controlnet",
+            **event_options("generate")
+        )
+        
+        stop_btn1.click(None, None, None, cancels=[generate_event1], queue=False)
+        stop_btn_img2img.click(None, None, None, cancels=[generate_event_img2img], queue=False)
+        stop_btn2.click(None, None, None, cancels=[generate_event2], queue=False)
+        
+        # 后台任务事件：提交只写任务数据库（界面操作通道），提交后自动订阅任务进度
+        def queue_job(kind, session, input_image=None, **params):
+            if not session["loaded"]:
+                return "", "❌ 请先加载模型"
+            if kind != "txt2img" and input_image is None:
+                return "", "❌ 请先上传图像"
+            job_id = submit_job(kind, params, session, input_image)
+            return job_id, format_job(get_job(job_id))
+        
+        def queue_txt2img(prompt, negative_prompt, num_steps, guidance_scale, width, height, seed, session):
+            return queue_job("txt2img", session, prompt=prompt, negative_prompt=negative_prompt, num_steps=int(num_steps),
+                             guidance_scale=guidance_scale, width=int(width), height=int(height), seed=int(seed))
+        
+        def queue_img2img(prompt, negative_prompt, input_image, strength, num_steps, guidance_scale, width, height, seed, session):
+            return queue_job("img2img", session, input_image, prompt=prompt, negative_prompt=negative_prompt, strength=strength,
+                             num_steps=int(num_steps), guidance_scale=guidance_scale, width=int(width), height=int(height), seed=int(seed))
+        
+        def queue_controlnet(prompt, negative_prompt, control_image, control_type, num_steps, guidance_scale, controlnet_conditioning_scale,
+                             width, height, seed, session):
+            return queue_job("controlnet", session, control_image, prompt=prompt, negative_prompt=negative_prompt, control_type=control_type,
+                             num_steps=int(num_steps), guidance_scale=guidance_scale, controlnet_conditioning_scale=controlnet_conditioning_scale,
+                             width=int(width), height=int(height), seed=int(seed))
+        
+        def watch_job_progress(job_id):
+            if not (job_id or "").strip():
+                return
+            job = None
+            for job in watch_job(job_id, timeout=watch_timeout()):
+                yield format_job(job), job["result"]
+            if job is None:
+                yield format_job(None), None
+            elif job["state"] not in TERMINAL_STATES:
+                # 订阅时长到了任务仍未结束（Gradio 3中只短时间跟踪）
+                job = get_job(job_id) or job
+                note = "" if job["state"] in TERMINAL_STATES else "\n👀 已停止自动跟踪，点击「👀 跟踪进度」继续查看"
+                yield format_job(job) + note, job["result"]
+        
+        def show_job(job_id):
+            job = get_job(job_id)
+            return format_job(job), job["result"] if job else None
+        
+        def cancel_job_from_ui(job_id):
+            if cancel_job(job_id):
+                return format_job(get_job(job_id))
+            return f"⚠️ 只能取消排队中的任务\n{format_job(get_job(job_id))}"
+        
+        queue_events = (
+            (queue_btn1, queue_txt2img, [prompt1, negative_prompt1, num_steps1, guidance_scale1, width1, height1, seed1, session_state]),
+            (queue_btn_img2img, queue_img2img, [prompt_img2img, negative_prompt_img2img, input_image, strength, num_steps_img2img,
+                                                guidance_scale_img2img, width_img2img, height_img2img, seed_img2img, session_state]),
+            (queue_btn2, queue_controlnet, [prompt2, negative_prompt2, control_image, control_type_radio, num_steps2, guidance_scale2,
+                                            controlnet_scale, width2, height2, seed2, session_state]),
+        )
+        for queue_btn, handler, handler_inputs in queue_events:
+            queue_btn.click(
+                limited("ui")(handler),
+                inputs=handler_inputs,
+                outputs=[job_id_box, job_status],
+                **event_options("ui")
+            ).then(
+                watch_job_progress,
+                inputs=[job_id_box],
+                outputs=[job_status, job_result],
+                **event_options("watch")
+            )
+        
+        job_watch_btn.click(
+            limited("ui")(show_job),
+            inputs=[job_id_box],
+            outputs=[job_status, job_result],
+            **event_options("ui")
+        ).then(
+            watch_job_progress,
+            inputs=[job_id_box],
+            outputs=[job_status, job_result],
+            **event_options("watch")
+        )
+        
+        job_cancel_btn.click(
+            limited("ui")(cancel_job_from_ui),
+            inputs=[job_id_box],
+            outputs=[job_status],
+            **event_options("ui")
+        )
+        
+        job_list_btn.click(
+            limited("ui")(lambda: format_job_list(list_jobs())),
+            inputs=[],
+            outputs=[job_list],
+            **event_options("ui")
+        )
+        
+        generate_grid_btn.click(
+            limited()(functools.partial(generate_grid, output="file")),
+            inputs=[grid_mode, grid_prompt, grid_negative_prompt, grid_input_image, grid_control_type, grid_num_steps, grid_guidance_scale,
+                    grid_strength, grid_controlnet_scale, grid_width, grid_height, grid_seed, grid_x_param, grid_x_values, grid_y_param, grid_y_values, session_state],
+            outputs=[output_grid, output_status_grid],
+            **event_options("generate")
         )
         
         return demo
@@ -668,28 +885,56 @@ if __name__ == "__main__":
     # 寻找可用端口
     available_port = find_free_port(7861)
     
-    # 创建并启动界面
+    # 创建并启动界面，启用请求队列
     demo = create_interface()
+    configure_queue(demo)
+    
+    # 后台任务的工作进程（关闭时等待当前任务结束，超时终止的任务会在心跳超时后重新排队）
+    if JOB_QUEUE_CONFIG["workers"] > 0:
+        from job_queue import start_workers
+        print(f"🧵 启动 {JOB_QUEUE_CONFIG['workers']} 个后台任务工作进程...")
+        start_workers(JOB_QUEUE_CONFIG["workers"])
     
     # 设置全局变量，用于清理函数
     utils.demo_instance = demo
     utils.server_port = available_port
     
+    # 界面模式下的指标抓取端口（挂载生成服务时同端口已提供 /metrics）
+    if METRICS_CONFIG["port"] and not SERVICE_CONFIG["mount_with_ui"]:
+        from metrics import start_metrics_server
+        start_metrics_server(METRICS_CONFIG["port"])
+    
     print("✅ 界面初始化完成！")
     print(f"🌐 正在启动服务器，端口: {available_port}")
     print("💡 程序退出时将自动释放端口")
     print("=" * 60)
     
+    # 输出存储和后台任务结果在 ~/.cache 下，Gradio 4默认只提供工作目录和临时目录中的文件
+    allowed_paths = [OUTPUT_CONFIG["dir"], os.path.dirname(JOB_QUEUE_CONFIG["path"])]
+    
     try:
-        # 启动Gradio应用
-        demo.launch(
-            server_name="0.0.0.0",        # 允许外部访问
-            server_port=available_port,    # 使用找到的可用端口
-            share=False,                   # 不使用公共链接
-            inbrowser=True,                # 自动打开浏览器
-            show_error=True,               # 显示错误信息
-            debug=False                    # 生产模式
-        )
+        if SERVICE_CONFIG["mount_with_ui"]:
+            # 在同一端口同时提供界面和无界面生成服务
+            import uvicorn
+            from service import create_service_app, load_service_models
+            # 生成服务使用自己的会话和模型，不跟随界面用户的加载
+            print(load_service_models(SERVICE_CONFIG["mode"], SERVICE_CONFIG["model"], SERVICE_CONFIG["controlnet"],
+                                      os.environ.get("HF_API_TOKEN", ""), SERVICE_CONFIG["backend"]))
+            print(f"🔌 生成服务已挂载: http://0.0.0.0:{available_port}{SERVICE_CONFIG['prefix']}/")
+            mount_options = {"allowed_paths": allowed_paths} if int(gr.__version__.split(".")[0]) >= 4 else {}
+            app = gr.mount_gradio_app(create_service_app(), demo, path="/", **mount_options)
+            uvicorn.run(app, host="0.0.0.0", port=available_port)
+        else:
+            # 启动Gradio应用
+            demo.launch(
+                server_name="0.0.0.0",        # 允许外部访问
+                server_port=available_port,    # 使用找到的可用端口
+                share=False,                   # 不使用公共链接
+                inbrowser=True,                # 自动打开浏览器
+                show_error=True,               # 显示错误信息
+                debug=False,                   # 生产模式
+                allowed_paths=allowed_paths    # 允许返回输出存储中的文件
+            )
     except KeyboardInterrupt:
         print("\n🛑 收到键盘中断信号...")
         utils.cleanup_on_exit()
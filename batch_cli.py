@@ -0,0 +1,344 @@
+"""
+批量生成命令行工具 - 读取JSONL任务文件，并发执行，输出图像和结果清单，支持中断后续跑
+
+任务文件每行一个JSON对象，例如：
+{"id": "cat-001", "prompt": "a cute cat", "mode": "txt2img", "model": "runwayml/stable-diffusion-v1-5", "width": 512, "height": 512, "seed": 42}
+{"id": "edge-001", "prompt": "oil painting", "mode": "controlnet", "control_type": "canny", "control_image": "inputs/house.png"}
+
+任务中加 "profile": true 时对该任务做性能剖析，剖析ID写入结果清单。
+
+加 --queue 时任务提交到持久化任务队列（见 job_queue.py），由工作进程执行，本进程只等待结果；
+中断后用同一输出目录重新运行，已提交的任务不会重复提交，继续等待其结果。
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import shutil
+import argparse
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image
+from config import LOCAL_BACKENDS
+from profiling import profile_request
+
+MANIFEST_NAME = "manifest.jsonl"
+JOB_MODES = ("txt2img", "img2img", "controlnet")
+
+def load_jobs(path):
+    """读取JSONL任务文件，缺少id的任务按内容生成稳定id"""
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"第 {line_no} 行不是合法JSON: {e}")
+            if not job.get("prompt"):
+                raise ValueError(f"第 {line_no} 行缺少 prompt")
+            job.setdefault("mode", "txt2img")
+            if job["mode"] not in JOB_MODES:
+                raise ValueError(f"第 {line_no} 行的 mode 不支持: {job['mode']}")
+            if not job.get("id"):
+                job["id"] = hashlib.sha1(line.encode("utf-8")).hexdigest()[:12]
+            jobs.append(job)
+    
+    ids = [job["id"] for job in jobs]
+    duplicates = {job_id for job_id in ids if ids.count(job_id) > 1}
+    if duplicates:
+        raise ValueError(f"任务id重复: {', '.join(sorted(duplicates))}")
+    return jobs
+
+def load_completed_ids(manifest_path):
+    """从结果清单中读取已成功完成的任务id（忽略崩溃时写了一半的最后一行）"""
+    completed = set()
+    if not os.path.exists(manifest_path):
+        return completed
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["id"])
+    return completed
+
+# 多个工作线程共用一个结果清单文件
+_manifest_lock = threading.Lock()
+
+def append_manifest(manifest_file, record):
+    """线程安全地追加一条结果记录，并立即落盘"""
+    with _manifest_lock:
+        manifest_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+
+def open_manifest(manifest_path):
+    """以追加方式打开结果清单"""
+    manifest = open(manifest_path, "a", encoding="utf-8")
+    # 崩溃可能留下不完整的最后一行，先补换行避免与新记录粘连
+    if manifest.tell() > 0:
+        with open(manifest_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                manifest.write("\n")
+    return manifest
+
+def _open_image(path, base_dir):
+    """按任务文件所在目录解析相对路径并打开图像"""
+    if not path:
+        return None
+    if not os.path.isabs(path):
+        path = os.path.join(base_dir, path)
+    return Image.open(path).convert("RGB")
+
+def _job_params(job):
+    """任务文件中的参数转为生成函数的关键字参数"""
+    params = {
+        "prompt": job["prompt"],
+        "negative_prompt": job.get("negative_prompt", ""),
+        "num_steps": int(job.get("steps", 20)),
+        "guidance_scale": float(job.get("guidance_scale", 7.5)),
+        "width": int(job.get("width", 512)),
+        "height": int(job.get("height", 512)),
+        "seed": int(job.get("seed", -1)),
+    }
+    if job["mode"] == "img2img":
+        params["strength"] = float(job.get("strength", 0.7))
+    elif job["mode"] == "controlnet":
+        params["control_type"] = job.get("control_type", "canny")
+        params["controlnet_conditioning_scale"] = float(job.get("controlnet_conditioning_scale", 1.0))
+    return params
+
+def _job_input_image(job, base_dir):
+    """图生图的输入图像或ControlNet的控制图像"""
+    if job["mode"] == "img2img":
+        return _open_image(job.get("input_image") or job.get("control_image"), base_dir)
+    if job["mode"] == "controlnet":
+        return _open_image(job.get("control_image"), base_dir)
+    return None
+
+def run_job(job, base_dir, session=None):
+    """执行单个任务，返回 (图像, 状态)"""
+    from concurrency import limited
+    from image_generation import generate_image, generate_img2img, generate_controlnet_image
+    
+    params = _job_params(job)
+    if job["mode"] == "txt2img":
+        return limited()(generate_image)(**params, session=session)
+    if job["mode"] == "img2img":
+        return limited()(generate_img2img)(input_image=_job_input_image(job, base_dir), **params, session=session)
+    
+    image, _, status = limited()(generate_controlnet_image)(control_image=_job_input_image(job, base_dir), **params, session=session)
+    return image, status
+
+def _execute(job, base_dir, output_dir, manifest, session=None):
+    """执行任务并写入结果清单"""
+    start = time.time()
+    record = {"id": job["id"], "mode": job["mode"], "model": job.get("model"), "prompt": job["prompt"]}
+    with profile_request() if job.get("profile") else nullcontext({}) as profile_capture:
+        try:
+            image, status = run_job(job, base_dir, session)
+        except Exception as e:
+            image, status = None, f"❌ 任务执行异常: {e}"
+    if profile_capture.get("id"):
+        record["profile_id"] = profile_capture["id"]
+    
+    if image is not None:
+        output_path = os.path.join(output_dir, f"{job['id']}.png")
+        tmp_path = output_path + ".tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, output_path)
+        record.update(status="ok", output=os.path.basename(output_path))
+    else:
+        record.update(status="error")
+    
+    record.update(message=status, seconds=round(time.time() - start, 3), finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+    append_manifest(manifest, record)
+    return record
+
+def _size_lane(run_mode, concurrency):
+    """按 -j 调整本进程的生成通道：API通道放宽到并发数；本地通道保护内存/推理进程池，超出时提示并按上限执行"""
+    from config import QUEUE_CONFIG
+    limits = QUEUE_CONFIG["limits"]
+    if run_mode == "api":
+        # 批量工具独占本进程的API通道，不与界面用户共享，通道上限跟随 -j
+        limits["api"] = max(limits["api"], concurrency)
+        return concurrency
+    if concurrency > limits["local"]:
+        print(f"⚠️ 本地模式同时只执行 {limits['local']} 个生成（local 通道上限），-j {concurrency} 的其余线程只用于重叠图像读写")
+    return min(concurrency, limits["local"])
+
+def run_batch(jobs_path, output_dir, run_mode="api", default_model="runwayml/stable-diffusion-v1-5", api_token="",
+              local_backend="pytorch", concurrency=4, resume=True):
+    """执行整个任务文件，返回 (成功数, 失败数, 跳过数)"""
+    from models import load_models
+    from session import create_session
+    
+    jobs = load_jobs(jobs_path)
+    base_dir = os.path.dirname(os.path.abspath(jobs_path))
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    
+    completed = load_completed_ids(manifest_path) if resume else set()
+    pending = [job for job in jobs if job["id"] not in completed]
+    skipped = len(jobs) - len(pending)
+    print(f"📋 共 {len(jobs)} 个任务，已完成 {skipped} 个，待执行 {len(pending)} 个")
+    
+    # 按 (模型, ControlNet类型) 分组，每组只加载一次模型
+    groups = {}
+    for job in pending:
+        key = (job.get("model") or default_model, job.get("control_type", "canny"))
+        groups.setdefault(key, []).append(job)
+    
+    concurrency = max(1, concurrency)
+    effective = _size_lane(run_mode, concurrency)
+    print(f"⚙️ 并发: {effective} 个同时生成")
+    
+    manifest = open_manifest(manifest_path)
+    succeeded = failed = 0
+    try:
+        for (model_id, control_type), group_jobs in groups.items():
+            # 每组使用自己的会话，不改动进程默认会话
+            session = create_session(run_mode, model_id, control_type, local_backend=local_backend)
+            status = load_models(run_mode, model_id, control_type, api_token, local_backend, session=session)
+            print(status)
+            if status.startswith("❌"):
+                for job in group_jobs:
+                    append_manifest(manifest, {"id": job["id"], "mode": job["mode"], "model": model_id, "prompt": job["prompt"],
+                                    "status": "error", "message": status, "seconds": 0,
+                                    "finished_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+                failed += len(group_jobs)
+                continue
+            
+            # 本地模式实际并发受 local 通道限制，多出的线程只用于重叠图像读写
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(_execute, job, base_dir, output_dir, manifest, session) for job in group_jobs]
+                for future in as_completed(futures):
+                    record = future.result()
+                    if record["status"] == "ok":
+                        succeeded += 1
+                    else:
+                        failed += 1
+                    print(f"{'✅' if record['status'] == 'ok' else '❌'} [{succeeded + failed}/{len(pending)}] "
+                          f"{record['id']} ({record['seconds']:.1f}s)")
+    finally:
+        manifest.close()
+    
+    return succeeded, failed, skipped
+
+def run_batch_queued(jobs_path, output_dir, run_mode="api", default_model="runwayml/stable-diffusion-v1-5", api_token="",
+                     local_backend="pytorch", resume=True, workers=0):
+    """把任务提交到持久化任务队列并等待结果，返回 (成功数, 失败数, 跳过数)
+    
+    workers大于0时在本进程中启动相应数量的工作进程，否则由已运行的工作进程执行。
+    """
+    from config import JOB_QUEUE_CONFIG
+    from session import create_session
+    from job_queue import submit_job, get_job, start_workers, stop_workers, TERMINAL_STATES
+    
+    jobs = load_jobs(jobs_path)
+    base_dir = os.path.dirname(os.path.abspath(jobs_path))
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    
+    completed = load_completed_ids(manifest_path) if resume else set()
+    pending = [job for job in jobs if job["id"] not in completed]
+    skipped = len(jobs) - len(pending)
+    print(f"📋 共 {len(jobs)} 个任务，已完成 {skipped} 个，待提交 {len(pending)} 个")
+    
+    # 输出目录作为批次标识，中断后重新运行时复用已提交的任务；--no-resume 时另起新批次
+    batch = os.path.abspath(output_dir) if resume else f"{os.path.abspath(output_dir)}@{time.time():.0f}"
+    manifest = open_manifest(manifest_path)
+    succeeded = failed = 0
+    queued = {}
+    for job in pending:
+        model_id = job.get("model") or default_model
+        session = create_session(run_mode, model_id, job.get("control_type", "canny"), api_token, local_backend=local_backend)
+        try:
+            queued[submit_job(job["mode"], _job_params(job), session, _job_input_image(job, base_dir),
+                              batch=batch, client_id=job["id"])] = job
+        except (OSError, ValueError) as e:
+            # 输入图像缺失或无法读取、参数无效：只记录该任务失败，与直接执行时一致
+            failed += 1
+            append_manifest(manifest, {"id": job["id"], "mode": job["mode"], "model": model_id, "prompt": job["prompt"],
+                                       "status": "error", "message": f"❌ 任务提交失败: {e}", "seconds": 0,
+                                       "finished_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+            print(f"❌ [{succeeded + failed}/{len(pending)}] {job['id']} 提交失败: {e}")
+    print(f"📥 已提交 {len(queued)} 个任务到 {JOB_QUEUE_CONFIG['path']}")
+    
+    processes = start_workers(workers) if workers > 0 and queued else []
+    try:
+        while queued:
+            for job_id in list(queued):
+                queued_job = get_job(job_id)
+                if queued_job["state"] not in TERMINAL_STATES:
+                    continue
+                job = queued.pop(job_id)
+                record = {"id": job["id"], "mode": job["mode"], "model": queued_job["session"].get("model"),
+                          "prompt": job["prompt"], "job_id": job_id}
+                if queued_job["state"] == "succeeded" and queued_job["result"] and os.path.exists(queued_job["result"]):
+                    output_path = os.path.join(output_dir, job["id"] + os.path.splitext(queued_job["result"])[1])
+                    shutil.copyfile(queued_job["result"], output_path + ".tmp")
+                    os.replace(output_path + ".tmp", output_path)
+                    record.update(status="ok", output=os.path.basename(output_path))
+                    succeeded += 1
+                else:
+                    record.update(status="error")
+                    failed += 1
+                seconds = (queued_job["finished_at"] or 0) - (queued_job["started_at"] or queued_job["finished_at"] or 0)
+                record.update(message=queued_job["message"], seconds=round(seconds, 3),
+                              finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+                append_manifest(manifest, record)
+                print(f"{'✅' if record['status'] == 'ok' else '❌'} [{succeeded + failed}/{len(pending)}] "
+                      f"{record['id']} ({record['seconds']:.1f}s)")
+            if queued:
+                time.sleep(JOB_QUEUE_CONFIG["poll_interval"])
+    finally:
+        manifest.close()
+        if processes:
+            stop_workers(processes)
+    
+    return succeeded, failed, skipped
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量生成：读取JSONL任务文件，支持并发与中断续跑")
+    parser.add_argument("jobs", help="JSONL任务文件路径")
+    parser.add_argument("-o", "--output", default="batch_output", help="输出目录（图像和 manifest.jsonl）")
+    parser.add_argument("--run-mode", choices=["api", "local"], default="api")
+    parser.add_argument("--model", default="runwayml/stable-diffusion-v1-5", help="任务未指定model时使用的模型")
+    parser.add_argument("--token", default=os.environ.get("HF_API_TOKEN", ""), help="Hugging Face API Token")
+    parser.add_argument("--backend", choices=list(LOCAL_BACKENDS.keys()), default="pytorch", help="本地推理后端")
+    parser.add_argument("-j", "--concurrency", type=int, default=4, help="并发任务数")
+    parser.add_argument("--no-resume", action="store_true", help="忽略已有结果清单，重新执行所有任务")
+    parser.add_argument("--queue", action="store_true", help="提交到持久化任务队列，由工作进程执行")
+    parser.add_argument("--workers", type=int, default=0, help="--queue 时在本进程启动的工作进程数，0表示使用已运行的工作进程")
+    args = parser.parse_args(argv)
+    
+    try:
+        if args.queue:
+            succeeded, failed, skipped = run_batch_queued(
+                args.jobs, args.output, args.run_mode, args.model, args.token, args.backend,
+                resume=not args.no_resume, workers=args.workers
+            )
+        else:
+            succeeded, failed, skipped = run_batch(
+                args.jobs, args.output, args.run_mode, args.model, args.token, args.backend,
+                args.concurrency, resume=not args.no_resume
+            )
+    except ValueError as e:
+        print(f"❌ 任务文件错误: {e}")
+        return 2
+    
+    print(f"📊 完成: 成功 {succeeded}，失败 {failed}，跳过 {skipped}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
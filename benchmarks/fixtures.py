@@ -0,0 +1,28 @@
+"""
+基准测试夹具 - 可重复的合成测试图像（微型模型检查点见 tiny_checkpoints.py）
+
+不需要网络或下载，同一台机器上多次运行结果可比较。
+"""
+
+import io
+
+def synthetic_image(size, seed=0):
+    """生成带边缘和渐变的合成RGB图像（纯噪声图像会让Canny等预处理的耗时失真）"""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    image = np.stack([(x * 255 // size), (y * 255 // size), ((x + y) * 127 // size)], axis=-1).astype(np.uint8)
+    # 叠加若干实心矩形，产生清晰的边缘
+    for _ in range(12):
+        x0, y0 = rng.integers(0, size - size // 8, size=2)
+        w, h = rng.integers(size // 16, size // 4, size=2)
+        image[y0:y0 + h, x0:x0 + w] = rng.integers(0, 256, size=3)
+    noise = rng.integers(-8, 9, size=image.shape)
+    return Image.fromarray(np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+
+def encoded_image(size, fmt="PNG", seed=0):
+    """合成图像的编码字节（模拟推理接口的返回）"""
+    buffered = io.BytesIO()
+    synthetic_image(size, seed).save(buffered, format=fmt)
+    return buffered.getvalue()
@@ -0,0 +1,111 @@
+"""
+启动耗时基准 - 用 `python -X importtime` 统计导入应用模块的耗时分解
+
+API模式的前端不应在启动时加载 torch/diffusers/cv2，本脚本同时检查这一点：
+
+    python benchmarks/import_time.py                  # 统计导入 app 的耗时
+    python benchmarks/import_time.py --module service --top 15
+    python benchmarks/import_time.py --json import_time.json --max-ms 3000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只应在本地模式/预处理时才导入的重量级模块
+HEAVY_MODULES = ("torch", "diffusers", "transformers", "cv2", "onnxruntime")
+
+def run_import(module):
+    """在全新解释器中导入模块，返回 (墙钟耗时秒, importtime原始输出, 已加载的重量级模块)"""
+    code = (
+        f"import {module}; import sys, json; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_DIR, capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+    heavy = json.loads(result.stdout.strip().splitlines()[-1])
+    return elapsed, result.stderr, heavy
+
+def parse_importtime(output):
+    """解析 -X importtime 输出，按顶层包汇总累计耗时（微秒）"""
+    packages = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # 顶层导入只有一个前导空格，嵌套导入的耗时已包含在父模块的累计耗时中
+        if name.startswith("  "):
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(cumulative_us)
+    return packages
+
+def build_report(module, elapsed, packages, heavy):
+    """生成报告字典"""
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "module": module,
+        "wall_ms": round(elapsed * 1000, 1),
+        "import_ms": round(sum(packages.values()) / 1000, 1),
+        "packages": [{"package": name, "cumulative_ms": round(us / 1000, 1)} for name, us in ranked],
+        "heavy_modules_loaded": heavy,
+        "python": sys.version.split()[0],
+    }
+
+def format_report(report, top=10):
+    """格式化为文本"""
+    lines = [
+        f"📦 导入 {report['module']}: 导入耗时 {report['import_ms']:.0f} ms，进程总耗时 {report['wall_ms']:.0f} ms",
+        f"{'包':<28}{'累计耗时(ms)':>14}",
+    ]
+    for entry in report["packages"][:top]:
+        lines.append(f"{entry['package']:<28}{entry['cumulative_ms']:>14.1f}")
+    if report["heavy_modules_loaded"]:
+        lines.append(f"⚠️ 启动时加载了重量级模块: {', '.join(report['heavy_modules_loaded'])}")
+    else:
+        lines.append("✅ 启动时未加载 torch/diffusers/cv2 等重量级模块")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="统计导入应用模块的启动耗时")
+    parser.add_argument("--module", default="app", help="要导入的模块（默认 app）")
+    parser.add_argument("--top", type=int, default=10, help="显示耗时最高的前N个包")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取导入耗时最短的一次")
+    parser.add_argument("--json", help="把报告写入JSON文件")
+    parser.add_argument("--max-ms", type=float, help="导入耗时超过该值时以非零状态退出")
+    parser.add_argument("--allow-heavy", action="store_true", help="允许启动时加载重量级模块")
+    args = parser.parse_args(argv)
+
+    report = None
+    for _ in range(max(1, args.repeat)):
+        elapsed, output, heavy = run_import(args.module)
+        candidate = build_report(args.module, elapsed, parse_importtime(output), heavy)
+        if report is None or candidate["import_ms"] < report["import_ms"]:
+            report = candidate
+
+    print(format_report(report, args.top))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = False
+    if report["heavy_modules_loaded"] and not args.allow_heavy:
+        failed = True
+    if args.max_ms is not None and report["import_ms"] > args.max_ms:
+        print(f"❌ 导入耗时 {report['import_ms']:.0f} ms 超过上限 {args.max_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,451 @@
+"""
+并发压测 - 按设定的到达率和生成类型比例向生成服务或Gradio界面发送请求，
+统计吞吐、延迟分位数、排队等待和错误率随时间的变化
+
+目标：
+    service   无界面生成服务（service.py），POST /v1/<类型>，排队等待取自响应头 X-Queue-Wait-Ms
+    gradio    Gradio界面（app.py），通过 gradio_client 调用 txt2img / img2img / controlnet 接口；
+              每个虚拟会话先按运行模式调用 load_models，排队等待 = Gradio队列等待 + 生成通道等待
+
+与本地模拟推理API一起使用，可以在不消耗额度的情况下测出单个节点能支撑的负载：
+
+    python mock_hf_api.py --latency lognormal:3,0.4 --concurrency 16 &
+    SD_HF_API_BASE_URL=http://127.0.0.1:8765 python service.py --mode api --token hf_mock --port 7870 &
+    python benchmarks/load_test.py --target service --url http://127.0.0.1:7870 --stages 0.5:60,1:60,2:60
+
+    python benchmarks/load_test.py --target gradio --url http://127.0.0.1:7861 --rate 1 --duration 120 \\
+        --mix txt2img=0.6,img2img=0.2,controlnet=0.2 --run-modes api=0.8,local=0.2 --json load.json
+
+默认按泊松过程开环发送（--rate / --stages），请求不因服务变慢而减少；--users 改为闭环：
+每个虚拟用户收到结果并等待 --think 秒后再发下一个请求。
+"""
+
+import argparse
+import base64
+import io
+import itertools
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PROMPTS = [
+    "a serene mountain lake at sunset, golden hour lighting, highly detailed",
+    "portrait of a wise old wizard, fantasy art, detailed facial features",
+    "futuristic cityscape with flying cars, cyberpunk style, neon lights",
+    "a cute cat sitting on a windowsill, soft morning light",
+    "oil painting of a lighthouse in a storm",
+    "isometric illustration of a cozy cabin in the woods",
+    "macro photo of a dew drop on a leaf",
+    "watercolor map of an imaginary island",
+]
+GENERATION_MODES = ("txt2img", "img2img", "controlnet")
+# 状态文本中的生成通道排队提示（concurrency._append_queue_note）
+_LANE_WAIT_PATTERN = re.compile(r"等待 ([\d.]+)s")
+
+def parse_weights(text, allowed):
+    """解析 "a=0.6,b=0.4" 形式的比例，返回 [(名称, 权重), ...]"""
+    weights = []
+    for item in text.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in allowed:
+            raise ValueError(f"未知的取值: {name}（可选: {', '.join(allowed)}）")
+        weights.append((name, float(weight or 1)))
+    weights = [(name, weight) for name, weight in weights if weight > 0]
+    if not weights:
+        raise ValueError(f"比例全为0: {text}")
+    return weights
+
+def parse_stages(text):
+    """解析 "速率:秒数,..." 形式的负载阶段，返回 [(每秒请求数, 秒数), ...]"""
+    stages = []
+    for item in text.split(","):
+        rate, _, duration = item.strip().partition(":")
+        stages.append((float(rate), float(duration)))
+    return stages
+
+def arrival_times(stages, process="poisson", seed=0):
+    """按负载阶段生成请求到达时刻（相对开始的秒数）"""
+    rng = random.Random(seed)
+    times, stage_start = [], 0.0
+    for rate, duration in stages:
+        t = stage_start
+        while rate > 0:
+            t += rng.expovariate(rate) if process == "poisson" else 1.0 / rate
+            if t >= stage_start + duration:
+                break
+            times.append(t)
+        stage_start += duration
+    return times
+
+def prompt_sampler(prompts, distribution="uniform", seed=0):
+    """提示词抽样：uniform 均匀，zipf 少数热门提示词占大部分请求（更接近真实用户，也会命中缓存）"""
+    rng = random.Random(seed)
+    if distribution == "zipf":
+        weights = [1.0 / (rank + 1) ** 1.1 for rank in range(len(prompts))]
+    else:
+        weights = [1.0] * len(prompts)
+    lock = threading.Lock()
+
+    def sample():
+        with lock:
+            return rng.choices(prompts, weights)[0]
+    return sample
+
+def load_input_image(path=None, size=512):
+    """img2img / ControlNet 的输入图像，返回 (PNG文件路径, base64)"""
+    import tempfile
+    if path:
+        with open(path, "rb") as f:
+            data = f.read()
+    else:
+        from fixtures import synthetic_image
+        buffered = io.BytesIO()
+        synthetic_image(size).save(buffered, format="PNG")
+        data = buffered.getvalue()
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+            f.write(data)
+            path = f.name
+    return path, base64.b64encode(data).decode()
+
+# ---------------------------------------------------------------------------
+# 压测目标：返回 (发送函数, 描述)；发送函数接收请求字典，返回 {"ok", "error", "queue_wait"}
+# ---------------------------------------------------------------------------
+
+def service_target(args, image_b64):
+    """无界面生成服务，运行模式由服务启动参数决定"""
+    import requests
+    from config import SERVICE_CONFIG
+
+    base = args.url.rstrip("/") + SERVICE_CONFIG["prefix"]
+    health = requests.get(f"{base}/health", timeout=10).json()
+    if not health.get("loaded"):
+        raise RuntimeError(f"生成服务尚未加载模型: {health}")
+    local = threading.local()
+
+    def send(request):
+        if not hasattr(local, "http"):
+            local.http = requests.Session()
+        body = {"prompt": request["prompt"], "negative_prompt": args.negative_prompt, "num_steps": args.steps,
+                "guidance_scale": args.guidance_scale, "width": args.size, "height": args.size, "seed": request["seed"]}
+        if request["mode"] != "txt2img":
+            body["image"] = image_b64
+        if request["mode"] == "img2img":
+            body["strength"] = args.strength
+        if request["mode"] == "controlnet":
+            body["control_type"] = args.control_type
+        try:
+            response = local.http.post(f"{base}/{request['mode']}", json=body, timeout=args.timeout)
+        except requests.exceptions.Timeout:
+            return {"ok": False, "error": "timeout"}
+        except requests.exceptions.ConnectionError:
+            return {"ok": False, "error": "connection_error"}
+        wait = response.headers.get("X-Queue-Wait-Ms")
+        return {"ok": response.status_code == 200, "error": None if response.status_code == 200 else f"http_{response.status_code}",
+                "queue_wait": float(wait) / 1000 if wait else None}
+
+    return send, {"run_mode": health.get("mode"), "model": health.get("model")}
+
+def gradio_target(args, image_path):
+    """Gradio界面：每种运行模式建立 --sessions 个会话（各自的gr.State），先加载模型再发送生成请求"""
+    from gradio_client import Client
+    try:
+        from gradio_client import handle_file
+    except ImportError:
+        handle_file = lambda path: path  # 旧版gradio_client直接传文件路径
+    from gradio_client.utils import Status
+
+    running_codes = {getattr(Status, name) for name in ("PROCESSING", "ITERATING", "PROGRESS") if hasattr(Status, name)}
+    run_modes = [name for name, _ in parse_weights(args.run_modes, ("api", "local"))]
+    sessions = {}
+    for run_mode in run_modes:
+        model = args.model if run_mode == "api" else args.local_model
+        sessions[run_mode] = []
+        for _ in range(args.sessions):
+            client = Client(args.url, verbose=False)
+            status = client.predict(run_mode, model, args.control_type, args.token, args.local_backend, api_name="/load_models")
+            if not str(status).startswith("✅"):
+                raise RuntimeError(f"{run_mode} 会话加载模型失败: {status}")
+            sessions[run_mode].append(client)
+    cycles = {run_mode: itertools.cycle(clients) for run_mode, clients in sessions.items()}
+    cycle_lock = threading.Lock()
+    image_arg = handle_file(image_path) if image_path else None
+
+    def send(request):
+        with cycle_lock:
+            client = next(cycles[request["run_mode"]])
+        common = (args.steps, args.guidance_scale)
+        size = (args.size, args.size, request["seed"])
+        if request["mode"] == "txt2img":
+            inputs = (request["prompt"], args.negative_prompt, *common, *size)
+        elif request["mode"] == "img2img":
+            inputs = (request["prompt"], args.negative_prompt, image_arg, args.strength, *common, *size)
+        else:
+            inputs = (request["prompt"], args.negative_prompt, image_arg, args.control_type, *common, 1.0, *size)
+
+        submitted = time.perf_counter()
+        started = None
+        job = client.submit(*inputs, api_name=f"/{request['mode']}")
+        # 轮询任务状态，第一次进入执行状态的时刻即Gradio队列等待结束
+        while not job.done():
+            if started is None and job.status().code in running_codes:
+                started = time.perf_counter()
+            if time.perf_counter() - submitted > args.timeout:
+                job.cancel()
+                return {"ok": False, "error": "timeout"}
+            time.sleep(0.05)
+        try:
+            outputs = job.result()
+        except Exception as e:
+            return {"ok": False, "error": type(e).__name__}
+
+        status = str(outputs[-1])
+        lane_wait = _LANE_WAIT_PATTERN.search(status)
+        queue_wait = (started - submitted if started else 0.0) + (float(lane_wait.group(1)) if lane_wait else 0.0)
+        ok = bool(outputs[0]) and not status.startswith("❌")
+        return {"ok": ok, "error": None if ok else "generation_failed", "queue_wait": queue_wait}
+
+    return send, {"run_modes": run_modes, "sessions_per_mode": args.sessions}
+
+# ---------------------------------------------------------------------------
+# 负载驱动与统计
+# ---------------------------------------------------------------------------
+
+def run_load(send, args):
+    """发送负载，返回 (每个请求的结果列表, 实际耗时秒, 被客户端丢弃的请求的到达时刻列表)"""
+    rng = random.Random(args.seed)
+    modes = parse_weights(args.mix, GENERATION_MODES)
+    run_modes = parse_weights(args.run_modes, ("api", "local")) if args.target == "gradio" else [("service", 1)]
+    sample_prompt = prompt_sampler(args.prompt_list, args.prompt_dist, args.seed)
+    results, lock = [], threading.Lock()
+    state = {"in_flight": 0, "dropped": []}
+    start = time.perf_counter()
+
+    def make_request():
+        with lock:
+            return {"mode": rng.choices([m for m, _ in modes], [w for _, w in modes])[0],
+                    "run_mode": rng.choices([m for m, _ in run_modes], [w for _, w in run_modes])[0],
+                    "prompt": sample_prompt(), "seed": rng.randrange(2 ** 31)}
+
+    def execute(request, scheduled):
+        sent = time.perf_counter()
+        try:
+            outcome = send(request)
+        except Exception as e:
+            outcome = {"ok": False, "error": type(e).__name__}
+        finished = time.perf_counter()
+        record = {"mode": request["mode"], "run_mode": request["run_mode"], "scheduled": round(scheduled, 3),
+                  "sent": round(sent - start, 3), "finished": round(finished - start, 3),
+                  "latency": round(finished - sent, 4), "ok": outcome["ok"], "error": outcome.get("error"),
+                  "queue_wait": outcome.get("queue_wait")}
+        with lock:
+            results.append(record)
+            state["in_flight"] -= 1
+
+    if args.users:
+        # 闭环：每个虚拟用户串行发送请求
+        deadline = start + args.duration
+
+        def user_loop():
+            while time.perf_counter() < deadline:
+                with lock:
+                    state["in_flight"] += 1
+                execute(make_request(), time.perf_counter() - start)
+                time.sleep(args.think)
+        threads = [threading.Thread(target=user_loop, daemon=True) for _ in range(args.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        # 开环：按到达时刻发送，客户端同时在途的请求达到上限时记为丢弃（说明压测机本身成为瓶颈）
+        with ThreadPoolExecutor(max_workers=args.max_in_flight) as pool:
+            for scheduled in arrival_times(args.stage_list, args.arrival, args.seed):
+                delay = start + scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                with lock:
+                    if state["in_flight"] >= args.max_in_flight:
+                        state["dropped"].append(scheduled)
+                        continue
+                    state["in_flight"] += 1
+                pool.submit(execute, make_request(), scheduled)
+    results.sort(key=lambda record: record["sent"])
+    return results, time.perf_counter() - start, state["dropped"]
+
+def percentile(values, q):
+    """最近秩百分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    # 秩为 ceil(q% × n)；round(x + 0.5) 遇到 .5 时按银行家舍入取偶数，会多算一位
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values) / 100) - 1))]
+
+def _latency_stats(records):
+    latencies = [record["latency"] for record in records if record["ok"]]
+    waits = [record["queue_wait"] for record in records if record["queue_wait"] is not None]
+    return {
+        "requests": len(records),
+        "ok": sum(record["ok"] for record in records),
+        "error_rate": round(1 - sum(record["ok"] for record in records) / len(records), 4) if records else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p90": percentile(latencies, 90),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies) if latencies else None,
+        "queue_wait_p50": percentile(waits, 50),
+        "queue_wait_p95": percentile(waits, 95),
+    }
+
+def summarize(results, elapsed, dropped):
+    """整体统计和按 运行模式/生成类型 的分组统计"""
+    errors = {}
+    for record in results:
+        if not record["ok"]:
+            errors[record["error"]] = errors.get(record["error"], 0) + 1
+    groups = {}
+    for record in results:
+        groups.setdefault(f"{record['run_mode']}/{record['mode']}", []).append(record)
+    return {
+        **_latency_stats(results),
+        "elapsed": round(elapsed, 2),
+        "throughput": round(sum(record["ok"] for record in results) / elapsed, 4) if elapsed else None,
+        "dropped": len(dropped),
+        "errors": errors,
+        "by_mode": {name: _latency_stats(records) for name, records in sorted(groups.items())},
+    }
+
+def timeline(results, interval, dropped=()):
+    """按完成时刻分窗口统计，观察负载上升时吞吐、延迟和排队的变化（到达数包括被客户端丢弃的请求）"""
+    windows = {}
+    for record in results:
+        windows.setdefault(int(record["finished"] // interval), []).append(record)
+    offered = {}
+    for scheduled in [record["scheduled"] for record in results] + list(dropped):
+        window = int(scheduled // interval)
+        offered[window] = offered.get(window, 0) + 1
+    rows = []
+    for window in range(max(list(windows) + list(offered) + [0]) + 1):
+        records = windows.get(window, [])
+        stats = _latency_stats(records)
+        waits = [record["queue_wait"] for record in records if record["queue_wait"] is not None]
+        rows.append({
+            "start": window * interval,
+            "offered_rps": round(offered.get(window, 0) / interval, 3),
+            "completed_rps": round(stats["ok"] / interval, 3),
+            "error_rate": stats["error_rate"],
+            "latency_p50": stats["latency_p50"],
+            "latency_p95": stats["latency_p95"],
+            "queue_wait_mean": round(sum(waits) / len(waits), 4) if waits else None,
+        })
+    return rows
+
+def _fmt(value, spec=".2f"):
+    return "-" if value is None else format(value, spec)
+
+def format_report(summary, rows):
+    lines = [
+        f"📊 请求 {summary['requests']}（成功 {summary['ok']}，客户端丢弃 {summary['dropped']}），耗时 {summary['elapsed']:.1f}s，"
+        f"吞吐 {_fmt(summary['throughput'], '.3f')} 张/秒，错误率 {_fmt(summary['error_rate'], '.1%')}",
+        f"⏱️ 延迟 p50 {_fmt(summary['latency_p50'])}s | p90 {_fmt(summary['latency_p90'])}s | p95 {_fmt(summary['latency_p95'])}s | "
+        f"p99 {_fmt(summary['latency_p99'])}s | 最大 {_fmt(summary['latency_max'])}s",
+        f"⏳ 排队 p50 {_fmt(summary['queue_wait_p50'])}s | p95 {_fmt(summary['queue_wait_p95'])}s",
+    ]
+    if summary["errors"]:
+        lines.append("❌ 错误: " + ", ".join(f"{kind} {count}" for kind, count in sorted(summary["errors"].items())))
+    lines.append("")
+    lines.append(f"{'分组':<24}{'请求':>6}{'错误率':>9}{'p50(s)':>9}{'p95(s)':>9}{'排队p95':>9}")
+    for name, stats in summary["by_mode"].items():
+        lines.append(f"{name:<24}{stats['requests']:>6}{_fmt(stats['error_rate'], '.1%'):>9}{_fmt(stats['latency_p50']):>9}"
+                     f"{_fmt(stats['latency_p95']):>9}{_fmt(stats['queue_wait_p95']):>9}")
+    lines.append("")
+    lines.append(f"{'时间(s)':>8}{'到达/s':>9}{'完成/s':>9}{'错误率':>9}{'p50(s)':>9}{'p95(s)':>9}{'排队(s)':>9}")
+    for row in rows:
+        lines.append(f"{row['start']:>8.0f}{row['offered_rps']:>9.2f}{row['completed_rps']:>9.2f}{_fmt(row['error_rate'], '.1%'):>9}"
+                     f"{_fmt(row['latency_p50']):>9}{_fmt(row['latency_p95']):>9}{_fmt(row['queue_wait_mean']):>9}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成接口并发压测")
+    parser.add_argument("--target", choices=["service", "gradio"], default="service")
+    parser.add_argument("--url", default="http://127.0.0.1:7870", help="生成服务或Gradio界面地址")
+    load = parser.add_argument_group("负载")
+    load.add_argument("--rate", type=float, default=1.0, help="每秒请求数（开环）")
+    load.add_argument("--duration", type=float, default=60.0, help="持续时间（秒）")
+    load.add_argument("--stages", help="分阶段负载 \"速率:秒数,...\"，例如 0.5:60,1:60,2:60（覆盖 --rate/--duration）")
+    load.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson", help="到达过程")
+    load.add_argument("--max-in-flight", type=int, default=256, help="客户端同时在途请求上限")
+    load.add_argument("--users", type=int, default=0, help="闭环虚拟用户数（设置后忽略 --rate/--stages）")
+    load.add_argument("--think", type=float, default=0.0, help="闭环模式下两次请求之间的间隔（秒）")
+    load.add_argument("--seed", type=int, default=0, help="随机种子（到达时刻、类型和提示词抽样）")
+    mix = parser.add_argument_group("请求组成")
+    mix.add_argument("--mix", default="txt2img=1", help="生成类型比例，例如 txt2img=0.6,img2img=0.2,controlnet=0.2")
+    mix.add_argument("--run-modes", default="api=1", help="运行模式比例（仅gradio目标），例如 api=0.8,local=0.2")
+    mix.add_argument("--prompts", help="提示词文件（每行一个），默认使用内置示例")
+    mix.add_argument("--prompt-dist", choices=["uniform", "zipf"], default="uniform", help="提示词分布")
+    mix.add_argument("--negative-prompt", default="blurry, low quality")
+    mix.add_argument("--steps", type=int, default=20)
+    mix.add_argument("--guidance-scale", type=float, default=7.5)
+    mix.add_argument("--size", type=int, default=512, help="生成宽高")
+    mix.add_argument("--strength", type=float, default=0.7, help="img2img变化强度")
+    mix.add_argument("--control-type", default="canny")
+    mix.add_argument("--image", help="img2img/ControlNet输入图像，默认使用合成图像")
+    gradio = parser.add_argument_group("Gradio目标")
+    gradio.add_argument("--sessions", type=int, default=4, help="每种运行模式的会话数")
+    gradio.add_argument("--model", default="runwayml/stable-diffusion-v1-5", help="API模式会话加载的模型")
+    gradio.add_argument("--local-model", default="runwayml/stable-diffusion-v1-5", help="本地模式会话加载的模型")
+    gradio.add_argument("--local-backend", default="pytorch")
+    gradio.add_argument("--token", default="", help="Hugging Face API Token（指向模拟API时任意 hf_ 开头的字符串即可）")
+    output = parser.add_argument_group("输出")
+    output.add_argument("--timeout", type=float, default=600.0, help="单个请求超时（秒）")
+    output.add_argument("--interval", type=float, default=10.0, help="时间序列的窗口长度（秒）")
+    output.add_argument("--json", help="把汇总和时间序列写入JSON文件")
+    output.add_argument("--raw", help="把每个请求的结果写入JSONL文件")
+    args = parser.parse_args(argv)
+
+    args.stage_list = parse_stages(args.stages) if args.stages else [(args.rate, args.duration)]
+    if args.stages:
+        args.duration = sum(duration for _, duration in args.stage_list)
+    if args.prompts:
+        with open(args.prompts, encoding="utf-8") as f:
+            args.prompt_list = [line.strip() for line in f if line.strip()]
+    else:
+        args.prompt_list = DEFAULT_PROMPTS
+
+    needs_image = any(mode != "txt2img" for mode, _ in parse_weights(args.mix, GENERATION_MODES))
+    image_path, image_b64 = load_input_image(args.image, args.size) if needs_image else (None, None)
+    if args.target == "service":
+        send, target_info = service_target(args, image_b64)
+    else:
+        send, target_info = gradio_target(args, image_path)
+    load_desc = f"{args.users} 个闭环用户" if args.users else " → ".join(f"{rate:g}/s×{duration:g}s" for rate, duration in args.stage_list)
+    print(f"🚀 压测 {args.target} {args.url}（{target_info}）：{load_desc}，类型 {args.mix}")
+
+    results, elapsed, dropped = run_load(send, args)
+    summary = summarize(results, elapsed, dropped)
+    rows = timeline(results, args.interval, dropped)
+    print(format_report(summary, rows))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"target": args.target, "url": args.url, "target_info": target_info, "stages": args.stage_list,
+                       "users": args.users, "mix": args.mix, "run_modes": args.run_modes, "summary": summary, "timeline": rows},
+                      f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已写入 {args.json}")
+    if args.raw:
+        with open(args.raw, "w", encoding="utf-8") as f:
+            for record in results:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
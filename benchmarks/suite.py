@@ -0,0 +1,323 @@
+"""
+生成热路径基准测试 - 可重复的离线场景，输出JSON结果并与基线比较
+
+场景（缺少依赖的场景自动跳过）：
+    preprocess.*        ControlNet预处理（Canny/涂鸦/深度）在不同图像尺寸下的耗时
+    payload.*           上传前的PNG编码+base64
+    decode.*            解码推理接口返回的图像
+    output.*            输出存储的编码（WebP/JPEG/PNG）
+    api.*               API模式端到端：编码/序列化 → 本地模拟推理API（mock_hf_api.py）→ 解码
+    local.*             微型检查点（tiny_checkpoints.py）经 load_models 加载的耗时，以及文生图/ControlNet生成的每步耗时
+
+    python benchmarks/suite.py                                  # 运行全部场景
+    python benchmarks/suite.py --filter preprocess --repeat 20
+    python benchmarks/suite.py --json results.json --save-baseline benchmarks/baseline.json
+    python benchmarks/suite.py --baseline benchmarks/baseline.json --threshold 0.15
+
+所有结果都是"每次操作耗时"（越低越好）。与基线比较时，中位数变慢超过阈值即视为回退，以非零状态退出。
+基线与机器相关，应在同一台机器（或同规格的CI节点）上生成和比较。
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SUITE_VERSION = 1
+IMAGE_SIZES = (256, 512, 1024)
+
+class Skip(Exception):
+    """场景依赖缺失或不适用，跳过"""
+
+def _require(*modules):
+    """检查场景依赖，缺失时跳过"""
+    import importlib
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            raise Skip(f"缺少依赖 {module}")
+
+# ---------------------------------------------------------------------------
+# 场景：每个场景函数完成准备工作，返回 (被计时的函数, 每次调用包含的操作数)
+# ---------------------------------------------------------------------------
+
+def scenario_preprocess(control_type, size):
+    _require("numpy", "PIL", "cv2")
+    from image_generation import preprocess_control_image
+    from fixtures import synthetic_image
+    image = synthetic_image(size)
+    return lambda: preprocess_control_image(image, control_type), 1
+
+def scenario_payload_encode(size):
+    _require("PIL", "requests")
+    from api_client import encode_image_b64
+    from fixtures import synthetic_image
+    image = synthetic_image(size)
+    return lambda: encode_image_b64(image), 1
+
+def scenario_response_decode(size, fmt):
+    _require("PIL", "requests")
+    from api_client import decode_response_image
+    from fixtures import encoded_image
+    data = encoded_image(size, fmt)
+    return lambda: decode_response_image(data), 1
+
+def scenario_output_encode(size, fmt):
+    _require("PIL")
+    from image_store import encode_image
+    from fixtures import synthetic_image
+    image = synthetic_image(size)
+    return lambda: encode_image(image, fmt), 1
+
+_mock_api = {}
+
+def _mock_api_session():
+    """启动一次本地模拟推理API（零延迟、无冷启动和限流，只测客户端开销）并把端点指向它"""
+    from config import set_hf_api_base_url
+    from session import create_session
+    from mock_hf_api import start_mock_server
+    if "server" not in _mock_api:
+        _mock_api["server"], base_url = start_mock_server(latency="fixed:0", cold_start=0, rate_limit=0, error_rate=0)
+        set_hf_api_base_url(base_url)
+    return create_session(run_mode="api", api_token="hf_benchmark_token")
+
+def scenario_api_roundtrip(mode, size):
+    _require("PIL", "requests")
+    import api_client
+    from fixtures import synthetic_image
+    session = _mock_api_session()
+    image = synthetic_image(size)
+
+    def run():
+        if mode == "txt2img":
+            result, status = api_client.generate_image_api("a benchmark prompt", "blurry", "runwayml/stable-diffusion-v1-5", 20, 7.5, session=session)
+        elif mode == "img2img":
+            result, status = api_client.generate_img2img_api("a benchmark prompt", "blurry", image, 0.75, session=session)
+        else:
+            result, status = api_client.generate_controlnet_image_api("a benchmark prompt", "blurry", image, "canny", session=session)
+        if result is None:
+            raise RuntimeError(status)
+    return run, 1
+
+_tiny_local = {}
+
+def _tiny_local_session():
+    """生成（或复用）微型检查点，通过 load_models 以本地PyTorch后端加载，返回会话"""
+    _require("torch", "diffusers", "transformers")
+    import torch
+    import models
+    from config import LOCAL_MODEL_CONFIG
+    from session import create_session
+    from tiny_checkpoints import ensure_tiny_checkpoints
+
+    if "session" not in _tiny_local:
+        torch.set_num_threads(max(1, min(8, os.cpu_count() or 1)))
+        paths = ensure_tiny_checkpoints()
+        LOCAL_MODEL_CONFIG["controlnet_dir"] = paths["controlnet"]
+        session = create_session(run_mode="local", model=paths["sd"])
+        status = models.load_models("local", paths["sd"], "canny", session=session)
+        if not status.startswith("✅ 本地模式所有模型加载成功"):
+            raise RuntimeError(status)
+        _tiny_local.update(session=session, paths=paths)
+    return _tiny_local["session"]
+
+def scenario_local_load():
+    session = _tiny_local_session()
+    import models
+
+    def run():
+        # 清空管道池，测量从磁盘加载基础管道和ControlNet的完整耗时
+        models.unload_models()
+        status = models.load_models("local", session["model"], "canny", session=session)
+        if not status.startswith("✅"):
+            raise RuntimeError(status)
+    return run, 1
+
+def scenario_local_generate(mode, steps, size):
+    session = _tiny_local_session()
+    _require("cv2")
+    from image_generation import generate_image, generate_controlnet_image
+    from fixtures import synthetic_image
+    control_image = synthetic_image(size)
+
+    def run():
+        if mode == "txt2img":
+            image, status = generate_image("a benchmark prompt", "blurry", steps, 7.5, size, size, 0, session=session)
+        else:
+            image, status = generate_controlnet_image("a benchmark prompt", "blurry", control_image, "canny", steps, 7.5, 1.0,
+                                                      size, size, 0, session=session)
+        if image is None:
+            raise RuntimeError(status)
+    # 按步数折算为每步耗时
+    return run, steps
+
+SCENARIOS = {}
+for _type in ("canny", "scribble", "depth"):
+    for _size in IMAGE_SIZES:
+        SCENARIOS[f"preprocess.{_type}.{_size}"] = (scenario_preprocess, (_type, _size))
+for _size in IMAGE_SIZES:
+    SCENARIOS[f"payload.png_b64.{_size}"] = (scenario_payload_encode, (_size,))
+for _fmt in ("PNG", "JPEG", "WEBP"):
+    SCENARIOS[f"decode.{_fmt.lower()}.512"] = (scenario_response_decode, (512, _fmt))
+for _fmt in ("webp", "jpeg", "png"):
+    SCENARIOS[f"output.{_fmt}.512"] = (scenario_output_encode, (512, _fmt))
+for _mode in ("txt2img", "img2img", "controlnet"):
+    SCENARIOS[f"api.{_mode}_roundtrip.512"] = (scenario_api_roundtrip, (_mode, 512))
+SCENARIOS["local.load_models_tiny"] = (scenario_local_load, ())
+SCENARIOS["local.txt2img_tiny.64px_10steps"] = (scenario_local_generate, ("txt2img", 10, 64))
+SCENARIOS["local.controlnet_tiny.64px_10steps"] = (scenario_local_generate, ("controlnet", 10, 64))
+
+# ---------------------------------------------------------------------------
+# 计时与报告
+# ---------------------------------------------------------------------------
+
+def measure(func, operations=1, repeat=10, warmup=2, min_seconds=0.0):
+    """重复调用函数，返回每次操作的耗时统计（毫秒）"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    start = time.perf_counter()
+    while len(samples) < repeat or time.perf_counter() - start < min_seconds:
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000 / operations)
+    samples.sort()
+    return {
+        "median_ms": round(statistics.median(samples), 4),
+        "p90_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.9))], 4),
+        "min_ms": round(samples[0], 4),
+        "mean_ms": round(statistics.fmean(samples), 4),
+        # 每秒操作数（本地管道场景即每秒去噪步数）
+        "ops_per_sec": round(1000 / statistics.median(samples), 3) if statistics.median(samples) else None,
+        "runs": len(samples),
+        "operations_per_run": operations,
+    }
+
+def run_suite(pattern=None, repeat=10, warmup=2, min_seconds=0.0):
+    """运行匹配的场景，返回报告字典"""
+    report = {
+        "suite_version": SUITE_VERSION,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "filter": pattern,
+        "results": {},
+        "skipped": {},
+        "failed": {},
+    }
+    for name, (scenario, args) in SCENARIOS.items():
+        if pattern and pattern not in name:
+            continue
+        try:
+            func, operations = scenario(*args)
+            report["results"][name] = measure(func, operations, repeat, warmup, min_seconds)
+            print(f"  ✅ {name:<36}{report['results'][name]['median_ms']:>12.3f} ms")
+        except Skip as e:
+            report["skipped"][name] = str(e)
+            print(f"  ⏭️ {name:<36} 跳过: {e}")
+        except Exception as e:
+            report["failed"][name] = str(e)
+            print(f"  ❌ {name:<36} 运行失败: {e}")
+    return report
+
+def compare(report, baseline, threshold=0.15):
+    """与基线比较中位数耗时，返回 (比较行列表, 是否有回退)；基线中可用 thresholds 按场景覆盖阈值
+
+    运行失败的场景，以及基线中有、本次（在 --filter 范围内）没有结果的场景同样算作回退。
+    """
+    rows, regressed = [], False
+    overrides = baseline.get("thresholds", {})
+    pattern = report.get("filter")
+    for name, base in baseline.get("results", {}).items():
+        if name in report["results"] or (pattern and pattern not in name):
+            continue
+        if name in report.get("failed", {}):
+            status = f"❌ 运行失败: {report['failed'][name]}"
+        elif name in report["skipped"]:
+            status = f"⚠️ 跳过: {report['skipped'][name]}"
+        else:
+            status = "⚠️ 本次未运行"
+        rows.append((name, base["median_ms"], None, None, status))
+        regressed = True
+    for name, error in report.get("failed", {}).items():
+        if name not in baseline.get("results", {}):
+            rows.append((name, None, None, None, f"❌ 运行失败: {error}"))
+            regressed = True
+    for name, result in report["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            rows.append((name, None, result["median_ms"], None, "🆕 无基线"))
+            continue
+        change = result["median_ms"] / base["median_ms"] - 1 if base["median_ms"] else 0.0
+        limit = overrides.get(name, threshold)
+        if change > limit:
+            status = f"❌ 变慢超过 {limit:.0%}"
+            regressed = True
+        elif change < -limit:
+            status = "🚀 变快"
+        else:
+            status = "✅"
+        rows.append((name, base["median_ms"], result["median_ms"], change, status))
+    return rows, regressed
+
+def format_comparison(rows):
+    lines = [f"{'场景':<38}{'基线(ms)':>12}{'当前(ms)':>12}{'变化':>10}  状态"]
+    for name, base, current, change, status in rows:
+        base_text = f"{base:.3f}" if base is not None else "-"
+        current_text = f"{current:.3f}" if current is not None else "-"
+        change_text = f"{change:+.1%}" if change is not None else "-"
+        lines.append(f"{name:<38}{base_text:>12}{current_text:>12}{change_text:>10}  {status}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成热路径基准测试")
+    parser.add_argument("--filter", help="只运行名称包含该字符串的场景")
+    parser.add_argument("--list", action="store_true", help="列出所有场景")
+    parser.add_argument("--repeat", type=int, default=10, help="每个场景的计时次数")
+    parser.add_argument("--warmup", type=int, default=2, help="计时前的预热次数")
+    parser.add_argument("--min-seconds", type=float, default=0.0, help="每个场景至少运行的秒数")
+    parser.add_argument("--json", help="把结果写入JSON文件")
+    parser.add_argument("--baseline", help="与该基线文件比较")
+    parser.add_argument("--threshold", type=float, default=0.15, help="中位数变慢超过该比例视为回退（默认0.15）")
+    parser.add_argument("--save-baseline", help="把本次结果保存为基线")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in SCENARIOS:
+            print(name)
+        return 0
+
+    print(f"⏱️ 运行基准测试（重复 {args.repeat} 次，预热 {args.warmup} 次）")
+    report = run_suite(args.filter, args.repeat, args.warmup, args.min_seconds)
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"💾 结果已写入 {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows, regressed = compare(report, baseline, args.threshold)
+        print(format_comparison(rows))
+        if regressed:
+            print("❌ 存在性能回退、运行失败或缺失的场景")
+            return 1
+    if report["failed"]:
+        print(f"❌ {len(report['failed'])} 个场景运行失败")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
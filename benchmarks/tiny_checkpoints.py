@@ -0,0 +1,153 @@
+"""
+微型检查点生成器 - 随机权重的微型SD 1.x管道和ControlNet，load_models可直接从本地目录加载
+
+结构与SD 1.5相同（UNet2DConditionModel + AutoencoderKL + CLIP文本编码器，VAE同样下采样8倍，
+ControlNet由UNet派生、通道一致），只是层数和通道数很小：任何CPU上几秒内完成加载和生成，
+用于测量批量、缓存、编译、组件共享等管道层面的性能回退。生成结果是噪声，不能用于评估画质。
+
+    python benchmarks/tiny_checkpoints.py                     # 写入 ~/.cache/sd_frontend/tiny_checkpoints
+    python benchmarks/tiny_checkpoints.py --out /tmp/tiny --force
+
+输出目录结构：
+    <输出目录>/sd                    基础管道（模型ID处填写该目录）
+    <输出目录>/controlnet/<类型>      canny / scribble / depth
+
+    SD_LOCAL_CONTROLNET_DIR=<输出目录>/controlnet python service.py --mode local --model <输出目录>/sd
+"""
+
+import os
+import sys
+import json
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from config import LOCAL_CACHE_DIR, CONTROLNET_TYPES
+
+# 组件结构变化时递增，已生成的旧检查点会被重新生成
+TINY_CHECKPOINT_VERSION = 1
+DEFAULT_DIR = os.path.join(LOCAL_CACHE_DIR, "tiny_checkpoints")
+
+def tiny_tokenizer():
+    """不依赖下载的CLIP分词器：词表只包含单字节字符，不做BPE合并"""
+    import tempfile
+    from transformers import CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    characters = list(bytes_to_unicode().values())
+    vocab = {"<|startoftext|>": 0, "!": 1, "<|endoftext|>": 2}
+    for token in characters + [c + "</w>" for c in characters]:
+        vocab.setdefault(token, len(vocab))
+    with tempfile.TemporaryDirectory() as directory:
+        vocab_path = os.path.join(directory, "vocab.json")
+        merges_path = os.path.join(directory, "merges.txt")
+        with open(vocab_path, "w", encoding="utf-8") as f:
+            json.dump(vocab, f)
+        with open(merges_path, "w", encoding="utf-8") as f:
+            f.write("#version: 0.2\n")
+        return CLIPTokenizer(vocab_path, merges_path, model_max_length=77)
+
+def tiny_pipeline_components(seed=0):
+    """构建随机权重的微型SD组件，返回可直接传给 StableDiffusionPipeline 的字典"""
+    import torch
+    from diffusers import UNet2DConditionModel, AutoencoderKL, DPMSolverMultistepScheduler
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        # 潜变量8x8，对应默认生成尺寸64x64
+        sample_size=8,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=1,
+        block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    )
+    vae = AutoencoderKL(
+        # 四级结构与SD相同，潜变量为图像尺寸的1/8
+        in_channels=3,
+        out_channels=3,
+        block_out_channels=(16, 16, 32, 32),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        layers_per_block=1,
+        norm_num_groups=8,
+        sample_size=64,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=2, pad_token_id=1, vocab_size=1000,
+        hidden_size=32, intermediate_size=37, num_attention_heads=4, num_hidden_layers=2,
+        max_position_embeddings=77,
+    ))
+    scheduler = DPMSolverMultistepScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+    return {
+        "unet": unet,
+        "vae": vae,
+        "text_encoder": text_encoder,
+        "tokenizer": tiny_tokenizer(),
+        "scheduler": scheduler,
+        "safety_checker": None,
+        "feature_extractor": None,
+    }
+
+def tiny_controlnet(unet, seed=0):
+    """由微型UNet派生的ControlNet（条件图同样下采样8倍到潜变量尺寸），权重加随机扰动以区分不同类型"""
+    import torch
+    from diffusers import ControlNetModel
+
+    controlnet = ControlNetModel.from_unet(unet, conditioning_embedding_out_channels=(8, 16, 32, 32))
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for parameter in controlnet.parameters():
+            parameter.add_(torch.randn(parameter.shape, generator=generator) * 0.02)
+    return controlnet
+
+def write_tiny_checkpoints(out_dir=DEFAULT_DIR, seed=0):
+    """生成微型检查点并保存，返回 {"sd": 基础管道目录, "controlnet": ControlNet目录}"""
+    from diffusers import StableDiffusionPipeline
+
+    components = tiny_pipeline_components(seed)
+    paths = {"sd": os.path.join(out_dir, "sd"), "controlnet": os.path.join(out_dir, "controlnet")}
+    pipeline = StableDiffusionPipeline(**components, requires_safety_checker=False)
+    pipeline.save_pretrained(paths["sd"])
+    for index, control_type in enumerate(CONTROLNET_TYPES):
+        tiny_controlnet(components["unet"], seed + index + 1).save_pretrained(os.path.join(paths["controlnet"], control_type))
+
+    import diffusers
+    with open(os.path.join(out_dir, "tiny_checkpoints.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": TINY_CHECKPOINT_VERSION, "seed": seed, "diffusers": diffusers.__version__}, f)
+    return paths
+
+def ensure_tiny_checkpoints(out_dir=DEFAULT_DIR, seed=0, force=False):
+    """检查点不存在、版本或种子不一致时重新生成，返回目录字典"""
+    paths = {"sd": os.path.join(out_dir, "sd"), "controlnet": os.path.join(out_dir, "controlnet")}
+    try:
+        with open(os.path.join(out_dir, "tiny_checkpoints.json"), encoding="utf-8") as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        marker = {}
+    if force or marker.get("version") != TINY_CHECKPOINT_VERSION or marker.get("seed") != seed:
+        return write_tiny_checkpoints(out_dir, seed)
+    return paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成随机权重的微型SD/ControlNet检查点")
+    parser.add_argument("--out", default=DEFAULT_DIR, help="输出目录")
+    parser.add_argument("--seed", type=int, default=0, help="权重随机种子")
+    parser.add_argument("--force", action="store_true", help="已存在时也重新生成")
+    args = parser.parse_args(argv)
+
+    paths = ensure_tiny_checkpoints(args.out, args.seed, args.force)
+    print(f"✅ 微型检查点: {args.out}")
+    print(f"📦 基础模型: {paths['sd']}")
+    print(f"🎮 ControlNet: {paths['controlnet']}/{{{','.join(CONTROLNET_TYPES)}}}")
+    print(f"💡 SD_LOCAL_CONTROLNET_DIR={paths['controlnet']} python service.py --mode local --model {paths['sd']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+编译后端模块 - 按分辨率分桶的torch.compile，编译产物持久化到磁盘
+"""
+
+import os
+import json
+import time
+import torch
+from config import LOCAL_CACHE_DIR, COMPILE_CONFIG, get_device
+from memory_policy import memory_policy_applied
+
+# 已完成编译的 (管道类型, 宽, 高)
+_compiled_buckets = set()
+_artifacts_path = None
+
+def get_compile_cache_dir():
+    """获取编译缓存目录"""
+    return os.path.join(LOCAL_CACHE_DIR, "compile")
+
+def configure_compile_cache(model_id):
+    """启用Inductor的磁盘缓存，并加载之前保存的编译产物"""
+    global _artifacts_path
+    cache_dir = get_compile_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    # FX图缓存和AOT autograd缓存写入固定目录，重启后可直接复用
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    
+    # 每个分桶、每种管道都会产生一份图，放宽重编译上限
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, len(COMPILE_CONFIG["buckets"]) * 4
+    )
+    
+    # torch>=2.7 支持把所有编译缓存打包成一个文件
+    safe_name = model_id.replace("/", "--").replace("\\", "--").replace(":", "")
+    _artifacts_path = os.path.join(cache_dir, f"{safe_name}-torch{torch.__version__}.bin".replace("+", "_"))
+    load_artifacts = getattr(torch.compiler, "load_cache_artifacts", None)
+    if load_artifacts is not None and os.path.exists(_artifacts_path):
+        try:
+            with open(_artifacts_path, "rb") as f:
+                load_artifacts(f.read())
+            print(f"📦 已加载编译缓存: {_artifacts_path}")
+        except Exception as e:
+            print(f"⚠️ 编译缓存加载失败，将重新编译: {e}")
+
+def save_compile_artifacts():
+    """把当前进程的编译缓存写回磁盘"""
+    save_artifacts = getattr(torch.compiler, "save_cache_artifacts", None)
+    if save_artifacts is None or _artifacts_path is None:
+        return
+    try:
+        result = save_artifacts()
+        if result is not None:
+            data = result[0]
+            tmp_path = _artifacts_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, _artifacts_path)
+    except Exception as e:
+        print(f"⚠️ 编译缓存保存失败: {e}")
+
+def snap_to_bucket(width, height):
+    """把请求分辨率对齐到最接近的预设分桶（优先保持宽高比）"""
+    width, height = int(width), int(height)
+    aspect = width / height
+    
+    def distance(bucket):
+        bucket_w, bucket_h = bucket
+        return (abs(bucket_w / bucket_h - aspect), abs(bucket_w - width) + abs(bucket_h - height))
+    
+    return min(COMPILE_CONFIG["buckets"], key=distance)
+
+def compile_pipelines(pipelines):
+    """编译管道共享的UNet和VAE解码器（多个管道共享同一模块时只编译一次）"""
+    compiled = {}
+    for pipeline in pipelines:
+        if pipeline is None:
+            continue
+        for owner, attr in ((pipeline, "unet"), (pipeline.vae, "decoder")):
+            module = getattr(owner, attr)
+            if id(module) not in compiled:
+                compiled[id(module)] = torch.compile(module, mode=COMPILE_CONFIG["mode"], dynamic=False)
+            setattr(owner, attr, compiled[id(module)])
+    print(f"⚙️ 已启用torch.compile（{len(compiled)} 个模块，按分辨率分桶编译）")
+
+def mark_bucket_used(kind, width, height):
+    """记录分桶使用情况，新分桶首次编译后保存编译缓存"""
+    key = (kind, width, height)
+    if key in _compiled_buckets:
+        return False
+    _compiled_buckets.add(key)
+    save_compile_artifacts()
+    return True
+
+def _time_generation(pipeline, width, height, steps):
+    """计时一次固定种子的文生图（与实际请求相同的autocast设置，编译出的图才能被实际请求复用）"""
+    generator = torch.Generator(device="cpu").manual_seed(0)
+    start = time.time()
+    with torch.autocast(get_device()):
+        pipeline(prompt="warmup", num_inference_steps=steps, width=width, height=height, generator=generator)
+    return time.time() - start
+
+def _eager(module):
+    """取得编译前的原始模块"""
+    return getattr(module, "_orig_mod", module)
+
+def warmup_buckets(pipeline, buckets=None, steps=None):
+    """逐个分桶预热编译，返回包含编译耗时和稳态加速比的报告"""
+    buckets = buckets or COMPILE_CONFIG["buckets"]
+    steps = steps or COMPILE_CONFIG["warmup_steps"]
+    
+    compiled_unet, compiled_decoder = pipeline.unet, pipeline.vae.decoder
+    rows = []
+    for width, height in buckets:
+        # 应用与实际请求相同的内存策略（切片/分块会改变编译的图，否则实际请求还要重新编译）；
+        # 独占共享组件，让共用这些模块的生成在换回原始模块期间等待
+        with memory_policy_applied(pipeline, width, height, exclusive=True):
+            # 首次调用包含编译（或从磁盘缓存加载）时间
+            first = _time_generation(pipeline, width, height, steps)
+            compiled_time = _time_generation(pipeline, width, height, steps)
+            
+            # 临时换回原始模块测量eager耗时
+            pipeline.unet, pipeline.vae.decoder = _eager(compiled_unet), _eager(compiled_decoder)
+            try:
+                eager_time = _time_generation(pipeline, width, height, steps)
+            finally:
+                pipeline.unet, pipeline.vae.decoder = compiled_unet, compiled_decoder
+        
+        _compiled_buckets.add(("txt2img", width, height))
+        rows.append({
+            "bucket": f"{width}x{height}",
+            "compile_seconds": max(first - compiled_time, 0.0),
+            "eager_seconds": eager_time,
+            "compiled_seconds": compiled_time,
+            "speedup": eager_time / compiled_time if compiled_time > 0 else None,
+        })
+        print(f"🔥 分桶 {width}x{height} 预热完成")
+    
+    save_compile_artifacts()
+    report_path = os.path.join(get_compile_cache_dir(), "warmup_report.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"steps": steps, "buckets": rows, "time": time.strftime("%Y-%m-%d %H:%M:%S")}, f, ensure_ascii=False, indent=2)
+    
+    return rows
+
+def format_warmup_report(rows):
+    """把预热结果格式化为文本表格"""
+    lines = ["🔥 编译预热报告", f"{'分桶':<10} | {'编译(s)':>8} | {'eager(s)':>8} | {'编译后(s)':>9} | 加速比"]
+    for row in rows:
+        speedup = f"{row['speedup']:.2f}x" if row["speedup"] else "-"
+        lines.append(f"{row['bucket']:<10} | {row['compile_seconds']:>8.1f} | {row['eager_seconds']:>8.2f} | "
+                     f"{row['compiled_seconds']:>9.2f} | {speedup}")
+    return "\n".join(lines)
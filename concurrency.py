@@ -0,0 +1,286 @@
+"""
+并发控制模块 - 按通道（API生成/本地生成/界面操作）限制并发，并配置Gradio请求队列
+"""
+
+import time
+import inspect
+import collections
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import QUEUE_CONFIG, JOB_QUEUE_CONFIG
+from session import find_session
+from tracing import span, start_span, end_span, activate, record_span, enabled as tracing_enabled
+
+# 每个通道按到达顺序排队的等待者，以及正在等待/执行的任务数
+_lane_waiters = {lane: collections.deque() for lane in QUEUE_CONFIG["limits"]}
+_lane_stats = {lane: {"waiting": 0, "running": 0} for lane in QUEUE_CONFIG["limits"]}
+_stats_lock = threading.Lock()
+# 任务数变化时通知等待排空的关闭流程和排队中的任务
+_idle_condition = threading.Condition(_stats_lock)
+
+# observe_queue_wait() 设置的字典，第一次拿到通道槽位时填入排队信息
+_queue_wait_probe = contextvars.ContextVar("sd_queue_wait_probe", default=None)
+
+# 关闭流程：停止接收新任务 / 要求进行中的生成在下一步中止
+_accepting = True
+_cancel_event = threading.Event()
+
+class ShuttingDown(RuntimeError):
+    """服务正在关闭，不再接收新任务"""
+
+def stop_accepting():
+    """停止接收新任务，已在排队的任务拿到槽位后也会被拒绝"""
+    global _accepting
+    _accepting = False
+
+def is_accepting():
+    """是否仍在接收新任务"""
+    return _accepting
+
+def request_cancel():
+    """要求进行中的生成在下一步中止"""
+    _cancel_event.set()
+
+def cancel_requested():
+    """是否已要求中止进行中的生成"""
+    return _cancel_event.is_set()
+
+def use_cancel_event(event):
+    """改用外部的中止事件（推理工作进程使用调度器为它创建的 multiprocessing.Event）"""
+    global _cancel_event
+    _cancel_event = event
+
+def _active_tasks():
+    return sum(stats["waiting"] + stats["running"] for stats in _lane_stats.values())
+
+def wait_until_idle(timeout=None):
+    """等待所有通道的任务结束，返回是否在超时前排空"""
+    with _idle_condition:
+        return _idle_condition.wait_for(lambda: _active_tasks() == 0, timeout)
+
+def _join_lane(lane):
+    """排到通道队尾，返回排队凭证"""
+    if not _accepting:
+        raise ShuttingDown("🛑 服务正在关闭，暂不接收新任务")
+    ticket = {"lane": lane, "start": time.time()}
+    with _stats_lock:
+        _lane_waiters[lane].append(ticket)
+        _lane_stats[lane]["waiting"] += 1
+        ticket["position"] = len(_lane_waiters[lane])
+    return ticket
+
+def _wait_turn(ticket, timeout=None):
+    """等待轮到该凭证且通道有空闲槽位，拿到槽位返回True，超时返回False"""
+    lane = ticket["lane"]
+    with _idle_condition:
+        ready = _idle_condition.wait_for(
+            lambda: _lane_waiters[lane][0] is ticket and _lane_stats[lane]["running"] < QUEUE_CONFIG["limits"][lane], timeout)
+        if ready:
+            _lane_waiters[lane].popleft()
+            _lane_stats[lane]["waiting"] -= 1
+            _lane_stats[lane]["running"] += 1
+            # 队首变化，后面的任务可能已经可以开始
+            _idle_condition.notify_all()
+        return ready
+
+def _leave_lane(ticket):
+    """放弃排队（调用方在等待期间断开）"""
+    with _idle_condition:
+        _lane_waiters[ticket["lane"]].remove(ticket)
+        _lane_stats[ticket["lane"]]["waiting"] -= 1
+        _idle_condition.notify_all()
+
+def queue_position(ticket):
+    """凭证当前在通道队列中的位置（从1开始）"""
+    with _stats_lock:
+        waiters = _lane_waiters[ticket["lane"]]
+        return waiters.index(ticket) + 1 if ticket in waiters else 0
+
+@contextmanager
+def _holding_slot(ticket):
+    """已拿到槽位：执行代码块，结束后释放槽位，返回排队信息字典"""
+    lane = ticket["lane"]
+    try:
+        if not _accepting:
+            raise ShuttingDown("🛑 服务正在关闭，排队中的任务已取消")
+        yield {"lane": lane, "position": ticket["position"], "waited": time.time() - ticket["start"]}
+    finally:
+        with _idle_condition:
+            _lane_stats[lane]["running"] -= 1
+            _idle_condition.notify_all()
+
+@contextmanager
+def lane_slot(lane):
+    """占用指定通道的一个执行槽位（按到达顺序），返回排队信息字典"""
+    ticket = _join_lane(lane)
+    try:
+        _wait_turn(ticket)
+    except BaseException:
+        _leave_lane(ticket)
+        raise
+    with _holding_slot(ticket) as slot:
+        yield slot
+
+@contextmanager
+def spare_lane_slots(lane, count):
+    """不等待地再占用通道中最多count个空闲槽位，返回实际占用的数量
+
+    已持有一个槽位的任务（如推理进程池上的参数网格）用它扩展并行度：只借用当前空闲的容量，有请求在排队时不借用。
+    """
+    with _stats_lock:
+        acquired = 0
+        if not _lane_waiters[lane]:
+            acquired = max(0, min(count, QUEUE_CONFIG["limits"][lane] - _lane_stats[lane]["running"]))
+        _lane_stats[lane]["running"] += acquired
+    try:
+        yield acquired
+    finally:
+        with _idle_condition:
+            _lane_stats[lane]["running"] -= acquired
+            _idle_condition.notify_all()
+
+def current_generation_lane(session=None):
+    """根据会话（未传入时为进程默认会话）的运行模式选择生成通道"""
+    if session is None:
+        from models import RUN_MODE
+        return "api" if RUN_MODE == "api" else "local"
+    return "api" if session["run_mode"] == "api" else "local"
+
+def _append_queue_note(result, slot):
+    """排队明显时，在返回结果的状态文本后附加排队信息"""
+    if slot["waited"] < 0.5 or not isinstance(result, tuple) or not result or not isinstance(result[-1], str):
+        return result
+    note = f"\n⏳ 排队第 {slot['position']} 位，等待 {slot['waited']:.1f}s"
+    return result[:-1] + (result[-1] + note,)
+
+def _handler_name(func):
+    """处理函数名（functools.partial取被包装函数的名字），用作追踪根span名称"""
+    return getattr(func, "__name__", None) or getattr(getattr(func, "func", None), "__name__", "handler")
+
+def _record_queue_wait(slot):
+    record_span("queue.wait", slot["waited"], lane=slot["lane"], position=slot["position"])
+    probe = _queue_wait_probe.get()
+    if probe is not None and "waited" not in probe:
+        probe.update(slot)
+
+@contextmanager
+def observe_queue_wait():
+    """取得代码块内（包括复制了上下文的工作线程）第一次进入通道槽位时的排队信息，
+    返回的字典在拿到槽位后填入 "lane"、"position"、"waited"（秒）"""
+    probe = {}
+    token = _queue_wait_probe.set(probe)
+    try:
+        yield probe
+    finally:
+        _queue_wait_probe.reset(token)
+
+def _queue_update(ticket, outputs):
+    """排队期间产出的界面更新：只改最后一个输出（状态文本），其余输出保持不变"""
+    import gradio as gr
+    waited = time.time() - ticket["start"]
+    note = f"⏳ 排队中：第 {queue_position(ticket)} 位，已等待 {waited:.0f}s"
+    return tuple(gr.update() for _ in range(outputs - 1)) + (note,)
+
+def limited(lane=None, outputs=None):
+    """装饰器：在通道槽位内执行处理函数，lane为None时按会话（或进程默认）运行模式选择生成通道。
+    每次调用开启一个追踪trace（已在追踪中时为子span），排队等待记录为 queue.wait。
+    outputs为生成器事件的输出个数（最后一个为状态文本）：设置后排队期间定期产出当前排队位置和已等待时间"""
+    def decorator(func):
+        name = _handler_name(func)
+        
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                slot_lane = lane or current_generation_lane(find_session(args, kwargs))
+                # 生成器在两次产出之间会交出执行权，只在每次恢复执行时把根span设为当前span
+                root = start_span(name, lane=slot_lane) if tracing_enabled() else None
+                error = None
+                try:
+                    ticket = _join_lane(slot_lane)
+                    interval = QUEUE_CONFIG["position_update_interval"] if outputs else None
+                    try:
+                        while not _wait_turn(ticket, interval):
+                            yield _queue_update(ticket, outputs)
+                    except BaseException:
+                        # 排队期间出错或调用方断开（GeneratorExit），让出队列位置
+                        _leave_lane(ticket)
+                        raise
+                    with _holding_slot(ticket) as slot:
+                        with activate(root):
+                            _record_queue_wait(slot)
+                            results = func(*args, **kwargs)
+                        try:
+                            while True:
+                                with activate(root):
+                                    try:
+                                        result = next(results)
+                                    except StopIteration:
+                                        break
+                                yield _append_queue_note(result, slot)
+                        finally:
+                            with activate(root):
+                                results.close()
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    if root is not None:
+                        end_span(root, error)
+            return generator_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            slot_lane = lane or current_generation_lane(find_session(args, kwargs))
+            with span(name, lane=slot_lane):
+                with lane_slot(slot_lane) as slot:
+                    _record_queue_wait(slot)
+                    return _append_queue_note(func(*args, **kwargs), slot)
+        return wrapper
+    return decorator
+
+def get_queue_status():
+    """获取各通道的排队与执行情况"""
+    with _stats_lock:
+        return {lane: dict(stats, limit=QUEUE_CONFIG["limits"][lane]) for lane, stats in _lane_stats.items()}
+
+def _gradio_major_version():
+    """获取Gradio主版本号"""
+    import gradio as gr
+    try:
+        return int(gr.__version__.split(".")[0])
+    except (ValueError, AttributeError):
+        return 3
+
+def event_options(lane):
+    """生成事件绑定参数：Gradio 4使用独立并发组，Gradio 3中轻量操作绕过队列
+
+    lane为 "watch" 时用于订阅状态的生成器事件（只轮询不计算），Gradio 4中不限并发；
+    Gradio 3只有一个全局工作池，订阅期间占用其中一个工作槽位，订阅时长需用 watch_timeout() 限制
+    """
+    limits = QUEUE_CONFIG["limits"]
+    if lane == "watch":
+        if _gradio_major_version() >= 4:
+            return {"concurrency_limit": None, "concurrency_id": "watch"}
+        return {"queue": True}
+    if _gradio_major_version() >= 4:
+        if lane == "ui":
+            return {"concurrency_limit": limits["ui"], "concurrency_id": "ui"}
+        # 生成类事件共享一个并发组，按模式的细分限制由 limited() 在运行时保证
+        return {"concurrency_limit": limits["api"] + limits["local"], "concurrency_id": "generate"}
+    return {"queue": lane != "ui"}
+
+def watch_timeout():
+    """"watch" 事件每次订阅的最长秒数：Gradio 3中订阅与生成共用工作池，只短时间跟踪，避免挤占生成"""
+    if _gradio_major_version() >= 4:
+        return JOB_QUEUE_CONFIG["watch_timeout"]
+    return JOB_QUEUE_CONFIG["shared_watch_timeout"]
+
+def configure_queue(demo):
+    """为Gradio应用启用请求队列"""
+    limits = QUEUE_CONFIG["limits"]
+    if _gradio_major_version() >= 4:
+        return demo.queue(max_size=QUEUE_CONFIG["max_size"], default_concurrency_limit=limits["ui"])
+    # Gradio 3只有一个全局工作池，容量覆盖两种生成通道，轻量操作不进入队列
+    return demo.queue(concurrency_count=limits["api"] + limits["local"], max_size=QUEUE_CONFIG["max_size"])
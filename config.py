@@ -2,10 +2,24 @@
 配置模块 - 存储应用的配置信息和常量
 """
 
-import torch
+import os
 
-# 设备配置
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# 设备配置 - 首次使用时才导入torch检测CUDA，API模式启动无需加载torch
+_DEVICE = None
+
+def get_device():
+    """获取推理设备（"cuda" 或 "cpu"），结果缓存"""
+    global _DEVICE
+    if _DEVICE is None:
+        import torch
+        _DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    return _DEVICE
+
+def __getattr__(name):
+    # 兼容旧代码中的 config.DEVICE / from config import DEVICE
+    if name == "DEVICE":
+        return get_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # 默认运行模式
 DEFAULT_RUN_MODE = "api"  # "local" 或 "api"
@@ -17,31 +31,50 @@ PROXY_CONFIG = {
     "https": None
 }
 
+# Hugging Face 服务地址：设置 SD_HF_API_BASE_URL（例如本地模拟服务 http://127.0.0.1:8765）后，
+# 推理接口和Hub接口（whoami-v2、模型列表）都指向该地址
+_HF_API_BASE_URL = os.environ.get("SD_HF_API_BASE_URL", "").rstrip("/")
+HF_API_CONFIG = {
+    "inference_url": _HF_API_BASE_URL or "https://api-inference.huggingface.co",
+    "hub_url": _HF_API_BASE_URL or "https://huggingface.co",
+}
+
 # API模式下的推理端点 - 官方支持的热门模型
 API_ENDPOINTS = {
     # 最新推荐模型 (官方文档推荐)
-    "black-forest-labs/FLUX.1-dev": "https://api-inference.huggingface.co/models/black-forest-labs/FLUX.1-dev",
-    "black-forest-labs/FLUX.1-schnell": "https://api-inference.huggingface.co/models/black-forest-labs/FLUX.1-schnell",
-    "stabilityai/stable-diffusion-xl-base-1.0": "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0",
-    "stabilityai/stable-diffusion-3.5-large": "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-3.5-large",
-    "stabilityai/stable-diffusion-3-medium-diffusers": "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-3-medium-diffusers",
-    "latent-consistency/lcm-lora-sdxl": "https://api-inference.huggingface.co/models/latent-consistency/lcm-lora-sdxl",
-    "Kwai-Kolors/Kolors": "https://api-inference.huggingface.co/models/Kwai-Kolors/Kolors",
+    "black-forest-labs/FLUX.1-dev": f"{HF_API_CONFIG['inference_url']}/models/black-forest-labs/FLUX.1-dev",
+    "black-forest-labs/FLUX.1-schnell": f"{HF_API_CONFIG['inference_url']}/models/black-forest-labs/FLUX.1-schnell",
+    "stabilityai/stable-diffusion-xl-base-1.0": f"{HF_API_CONFIG['inference_url']}/models/stabilityai/stable-diffusion-xl-base-1.0",
+    "stabilityai/stable-diffusion-3.5-large": f"{HF_API_CONFIG['inference_url']}/models/stabilityai/stable-diffusion-3.5-large",
+    "stabilityai/stable-diffusion-3-medium-diffusers": f"{HF_API_CONFIG['inference_url']}/models/stabilityai/stable-diffusion-3-medium-diffusers",
+    "latent-consistency/lcm-lora-sdxl": f"{HF_API_CONFIG['inference_url']}/models/latent-consistency/lcm-lora-sdxl",
+    "Kwai-Kolors/Kolors": f"{HF_API_CONFIG['inference_url']}/models/Kwai-Kolors/Kolors",
     
     # 经典稳定的API模型
-    "runwayml/stable-diffusion-v1-5": "https://api-inference.huggingface.co/models/runwayml/stable-diffusion-v1-5",
-    "stabilityai/stable-diffusion-2-1": "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-2-1",
-    "prompthero/openjourney": "https://api-inference.huggingface.co/models/prompthero/openjourney",
-    "dreamlike-art/dreamlike-diffusion-1.0": "https://api-inference.huggingface.co/models/dreamlike-art/dreamlike-diffusion-1.0",
+    "runwayml/stable-diffusion-v1-5": f"{HF_API_CONFIG['inference_url']}/models/runwayml/stable-diffusion-v1-5",
+    "stabilityai/stable-diffusion-2-1": f"{HF_API_CONFIG['inference_url']}/models/stabilityai/stable-diffusion-2-1",
+    "prompthero/openjourney": f"{HF_API_CONFIG['inference_url']}/models/prompthero/openjourney",
+    "dreamlike-art/dreamlike-diffusion-1.0": f"{HF_API_CONFIG['inference_url']}/models/dreamlike-art/dreamlike-diffusion-1.0",
 }
 
 # ControlNet API endpoints
 CONTROLNET_API_ENDPOINTS = {
-    "canny": "https://api-inference.huggingface.co/models/lllyasviel/sd-controlnet-canny",
-    "scribble": "https://api-inference.huggingface.co/models/lllyasviel/sd-controlnet-scribble", 
-    "depth": "https://api-inference.huggingface.co/models/lllyasviel/sd-controlnet-depth"
+    "canny": f"{HF_API_CONFIG['inference_url']}/models/lllyasviel/sd-controlnet-canny",
+    "scribble": f"{HF_API_CONFIG['inference_url']}/models/lllyasviel/sd-controlnet-scribble", 
+    "depth": f"{HF_API_CONFIG['inference_url']}/models/lllyasviel/sd-controlnet-depth"
 }
 
+def set_hf_api_base_url(base_url=None):
+    """把推理端点和Hub接口改为指向 base_url（None恢复官方地址），原地修改端点字典，已导入的模块立即生效"""
+    base_url = base_url.rstrip("/") if base_url else None
+    old_inference = HF_API_CONFIG["inference_url"]
+    HF_API_CONFIG["inference_url"] = base_url or "https://api-inference.huggingface.co"
+    HF_API_CONFIG["hub_url"] = base_url or "https://huggingface.co"
+    for endpoints in (API_ENDPOINTS, CONTROLNET_API_ENDPOINTS):
+        for key, endpoint in endpoints.items():
+            if endpoint.startswith(old_inference + "/"):
+                endpoints[key] = HF_API_CONFIG["inference_url"] + endpoint[len(old_inference):]
+
 # ControlNet 类型配置
 CONTROLNET_TYPES = {
     "canny": {
@@ -87,6 +120,209 @@ LOCAL_ONLY_MODELS = {
     "hakurei/waifu-diffusion": "Waifu Diffusion (动漫风格)"
 }
 
+# 本地推理后端
+LOCAL_BACKENDS = {
+    "pytorch": {
+        "name": "PyTorch 原生",
+        "description": "默认后端，GPU下使用fp16，CPU下使用fp32"
+    },
+    "int8": {
+        "name": "INT8 动态量化 (仅CPU)",
+        "description": "文本编码器和UNet的线性层使用int8权重，CPU推理更快、内存更省"
+    },
+    "onnx": {
+        "name": "ONNX Runtime (CPU)",
+        "description": "首次加载时导出ONNX并缓存，使用ONNX Runtime图优化推理（ControlNet仍使用PyTorch）"
+    },
+    "compile": {
+        "name": "torch.compile 分辨率分桶",
+        "description": "请求分辨率对齐到预设分桶并编译UNet/VAE，编译产物持久化到磁盘"
+    }
+}
+
+# torch.compile 编译模式配置
+COMPILE_CONFIG = {
+    # 预设分辨率分桶 (宽, 高)，请求会对齐到最接近的分桶
+    "buckets": [(512, 512), (512, 768), (768, 512), (768, 768), (1024, 1024)],
+    # 加载模型时立即预热所有分桶；关闭时首次遇到某个分桶才编译
+    "warmup_at_load": False,
+    # 预热时每次生成使用的采样步数
+    "warmup_steps": 4,
+    "mode": "default",
+}
+
+# 本地缓存目录（量化权重、ONNX导出等派生产物）
+LOCAL_CACHE_DIR = os.environ.get(
+    "SD_FRONTEND_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "sd_frontend")
+)
+
+# 本地模型来源：ControlNet默认从Hub下载；设置 SD_LOCAL_CONTROLNET_DIR 后从 <目录>/<ControlNet类型> 加载
+# （例如 benchmarks/tiny_checkpoints.py 生成的微型检查点）。基础模型直接在模型ID处填写本地目录即可
+LOCAL_MODEL_CONFIG = {
+    "controlnet_dir": os.environ.get("SD_LOCAL_CONTROLNET_DIR") or None,
+}
+
+# 分辨率上限：超过 LOCAL_MAX_DIRECT_RESOLUTION 的本地生成必须使用分块VAE解码
+LOCAL_MAX_DIRECT_RESOLUTION = 1024
+LOCAL_MAX_RESOLUTION = 2048
+
+# 本地推理内存策略
+MEMORY_POLICY = {
+    "enabled": True,
+    # 允许推理占用的可用内存比例，其余留给系统和其他进程
+    "ram_budget_ratio": 0.6,
+    # 超过该像素数时总是启用分块VAE解码
+    "vae_tiling_pixels": 768 * 768,
+}
+
+# 本地生成的流式预览
+PREVIEW_CONFIG = {
+    # 每隔多少步推送一次预览
+    "every_n_steps": 5,
+    # 预览图相对潜变量尺寸的放大倍数（潜变量为最终分辨率的1/8）
+    "upscale": 2,
+}
+
+# 生成结果的输出存储：界面直接返回编码后的文件，按内容哈希命名
+OUTPUT_CONFIG = {
+    "dir": os.path.join(LOCAL_CACHE_DIR, "outputs"),
+    # 本地生成结果的编码格式：webp / jpeg / png；API模式直接保存上游返回的原始字节
+    "format": os.environ.get("SD_OUTPUT_FORMAT", "webp"),
+    "quality": 90,
+    # PNG使用低压缩等级，编码速度优先
+    "png_compress_level": 1,
+    # 超过该数量时清理最旧的文件
+    "max_files": 1000,
+}
+
+# 优雅关闭：先等待进行中的任务完成，超时后要求其在下一步中止
+SHUTDOWN_CONFIG = {
+    # 等待进行中任务自然完成的最长时间（秒）
+    "drain_timeout": float(os.environ.get("SD_SHUTDOWN_DRAIN_TIMEOUT", "20")),
+    # 发出中止请求后再等待的最长时间（秒）
+    "cancel_timeout": 5.0,
+}
+
+# 本地管道池：不同会话加载的本地模型共享此池，超过容量时淘汰最久未使用的模型
+# 默认容纳2个模型，两个会话交替使用不同模型时不会每次都互相淘汰、重新加载；内存紧张时设为1
+PIPELINE_POOL_SIZE = int(os.environ.get("SD_PIPELINE_POOL_SIZE", "2"))
+
+# 本地推理进程池（inference_pool.py）：N个工作进程各自加载本地管道，绑定到不同的CPU核心组并行生成
+INFERENCE_POOL_CONFIG = {
+    # 工作进程数，0表示不启用（在界面进程内推理）；每个进程都加载一份模型
+    "workers": int(os.environ.get("SD_INFERENCE_WORKERS", "0")),
+    # 每个进程的推理线程数（同时也是绑定的核心数），0表示把可用核心平均分给各进程
+    "threads_per_worker": int(os.environ.get("SD_INFERENCE_THREADS", "0")),
+    # 是否把每个进程绑定到固定的核心组（sched_setaffinity，仅Linux）
+    "pin_cores": os.environ.get("SD_INFERENCE_PIN_CORES", "1") == "1",
+    # 共享内存按该像素数预分配（RGB），输入输出图像不能超过
+    "max_image_pixels": LOCAL_MAX_RESOLUTION * LOCAL_MAX_RESOLUTION,
+}
+
+# 请求排队与并发限制
+QUEUE_CONFIG = {
+    # Gradio队列最多容纳的等待请求数，超出后新请求直接被拒绝
+    "max_size": 64,
+    # 各通道同时执行的任务数：API模式生成 / 本地模式生成（启用推理进程池时等于工作进程数）/ 轻量界面操作
+    "limits": {"api": 4, "local": max(1, INFERENCE_POOL_CONFIG["workers"]), "ui": 8},
+    # 生成任务排队期间刷新排队位置和等待时间的间隔（秒）
+    "position_update_interval": 1.0,
+}
+
+# 持久化任务队列（job_queue.py）：生成请求写入SQLite成为任务，由独立的工作进程执行
+JOB_QUEUE_CONFIG = {
+    "path": os.path.join(LOCAL_CACHE_DIR, "jobs", "jobs.sqlite3"),
+    # 界面启动时一起启动的工作进程数；每个工作进程会再加载一份模型，默认0，只使用 `python job_queue.py worker` 单独启动的工作进程
+    "workers": int(os.environ.get("SD_JOB_WORKERS", "0")),
+    # 工作进程没有任务时的轮询间隔、界面/批量工具查询任务状态的间隔（秒）
+    "poll_interval": 1.0,
+    # 执行中的任务每隔多久写一次心跳；超过 stale_after 没有心跳的任务视为工作进程已崩溃，重新排队
+    "heartbeat_interval": 5.0,
+    "stale_after": 60.0,
+    # 因工作进程崩溃被重新排队的最多次数，超过后标记为失败
+    "max_attempts": 3,
+    # 结果图像在任务结束后保留的时间（秒），过期后由工作进程删除（任务记录保留），0表示永久保留
+    "result_retention": float(os.environ.get("SD_JOB_RESULT_RETENTION", str(7 * 24 * 3600))),
+    # 工作进程检查过期结果的间隔（秒）
+    "result_prune_interval": 3600,
+    # 界面订阅单个任务进度的最长时间（秒），超时后可凭任务ID重新查看
+    "watch_timeout": 1800,
+    # Gradio 3中订阅会占用生成共用的全局工作池槽位，每次只跟踪这么久（秒），之后由用户点击继续跟踪
+    "shared_watch_timeout": 15,
+}
+
+# 无界面HTTP生成服务
+SERVICE_CONFIG = {
+    # 接口路径前缀
+    "prefix": "/v1",
+    # 为True时在Gradio界面同一端口挂载生成服务
+    "mount_with_ui": os.environ.get("SD_SERVICE_WITH_UI", "0") == "1",
+    # 请求体大小上限（base64编码后的图像）
+    "max_body_bytes": 20 * 1024 * 1024,
+    # 挂载在界面旁时生成服务自己加载的模型（独立运行时由命令行参数指定），与界面用户加载的模型无关
+    "mode": os.environ.get("SD_SERVICE_MODE", "api"),
+    "model": os.environ.get("SD_SERVICE_MODEL", "runwayml/stable-diffusion-v1-5"),
+    "controlnet": os.environ.get("SD_SERVICE_CONTROLNET", "canny"),
+    "backend": os.environ.get("SD_SERVICE_BACKEND", "pytorch"),
+}
+
+# 各阶段耗时指标（Prometheus文本格式）
+METRICS_CONFIG = {
+    # 界面模式下独立的指标抓取端口，0表示不启动（生成服务总是提供 /metrics）
+    "port": int(os.environ.get("SD_METRICS_PORT", "0")),
+    # 直方图分桶上界（秒），覆盖从图像编码到本地长时间去噪的范围
+    "buckets": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+}
+
+# 请求追踪：每个界面事件/服务请求一个trace，各层操作记录为嵌套span
+TRACING_CONFIG = {
+    # 导出方式：none（默认，不记录）/ jsonl（本地文件）/ otlp（OTLP/HTTP JSON收集器）
+    # 默认关闭：每个请求都要生成span并由后台线程写出，排查性能问题时再通过 SD_TRACE_EXPORTER 开启
+    "exporter": os.environ.get("SD_TRACE_EXPORTER", "none"),
+    "path": os.path.join(LOCAL_CACHE_DIR, "traces", "traces.jsonl"),
+    "otlp_endpoint": os.environ.get("SD_TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces"),
+    # JSONL文件超过该大小时轮转为 traces.jsonl.1
+    "max_file_bytes": 50 * 1024 * 1024,
+}
+
+# 按需性能剖析：单个请求显式要求（服务请求头 X-Profile / 批量任务 "profile": true），或按比例抽样
+PROFILING_CONFIG = {
+    # 抽样比例，0表示只剖析显式要求的请求
+    "sample_rate": float(os.environ.get("SD_PROFILE_SAMPLE_RATE", "0")),
+    "dir": os.path.join(LOCAL_CACHE_DIR, "profiles"),
+    # 本地模式使用PyTorch Profiler（导出Chrome trace），否则使用cProfile
+    "torch_profiler": os.environ.get("SD_PROFILE_TORCH", "1") == "1",
+    # 文本摘要中显示的函数/算子数
+    "summary_rows": 40,
+    # 剖析目录保留的剖析次数和总大小上限，超过时删除最旧的剖析文件（Chrome trace单个可达数百MB）
+    "max_profiles": 100,
+    "max_bytes": int(os.environ.get("SD_PROFILE_MAX_MB", "2048")) * 1024 * 1024,
+}
+
+# 本地模拟推理API（mock_hf_api.py）：离线压测和基准测试时用 SD_HF_API_BASE_URL 把应用指向它
+MOCK_API_CONFIG = {
+    "host": "127.0.0.1",
+    "port": 8765,
+    # 生成耗时分布（秒）："fixed:2"、"uniform:1,3"、"normal:2,0.5"、"lognormal:2,0.4"（中位数,sigma）
+    "latency": "lognormal:2.0,0.4",
+    # 模型首次被请求后的冷启动时长（秒），期间返回503和estimated_time；0表示始终就绪
+    "cold_start": 0.0,
+    # 模型空闲超过该时长（秒）后重新进入冷启动，0表示不卸载
+    "idle_unload": 0.0,
+    # 每个Token在滑动窗口内允许的请求数，超出返回429；0表示不限流
+    "rate_limit": 0,
+    "rate_window": 60.0,
+    # 请求体大小上限（字节），超出返回413
+    "max_payload_bytes": 10 * 1024 * 1024,
+    # 同时处理的生成请求数，超出的请求排队等待；0表示不限制
+    "concurrency": 0,
+    # 随机返回500的比例
+    "error_rate": 0.0,
+    # 是否要求 "Authorization: Bearer hf_..." 请求头
+    "require_token": True,
+}
+
 # 兼容性：保持原有MODELS变量
 MODELS = {**API_SUPPORTED_MODELS, **LOCAL_ONLY_MODELS}
 
@@ -177,14 +413,22 @@ def get_available_models(run_mode):
         # 本地模式支持所有模型
         return {**API_SUPPORTED_MODELS, **LOCAL_ONLY_MODELS}
 
-def update_proxy_config(enabled, http_proxy, https_proxy):
-    """更新代理配置"""
-    global PROXY_CONFIG
-    PROXY_CONFIG["enabled"] = enabled
-    PROXY_CONFIG["http"] = http_proxy if http_proxy.strip() else None
-    PROXY_CONFIG["https"] = https_proxy if https_proxy.strip() else None
-    
-    if enabled and (PROXY_CONFIG["http"] or PROXY_CONFIG["https"]):
-        return f"✅ 代理已启用: HTTP={PROXY_CONFIG['http'] or 'None'}, HTTPS={PROXY_CONFIG['https'] or 'None'}"
+def build_proxy_config(enabled, http_proxy, https_proxy):
+    """根据界面输入构造代理配置字典"""
+    return {
+        "enabled": bool(enabled),
+        "http": http_proxy.strip() if http_proxy and http_proxy.strip() else None,
+        "https": https_proxy.strip() if https_proxy and https_proxy.strip() else None,
+    }
+
+def describe_proxy_config(proxy):
+    """代理配置的状态文本"""
+    if proxy["enabled"] and (proxy["http"] or proxy["https"]):
+        return f"✅ 代理已启用: HTTP={proxy['http'] or 'None'}, HTTPS={proxy['https'] or 'None'}"
     else:
         return "❌ 代理已禁用"
+
+def update_proxy_config(enabled, http_proxy, https_proxy):
+    """更新进程级代理配置（命令行服务、批量生成等未区分会话的调用方使用）"""
+    PROXY_CONFIG.update(build_proxy_config(enabled, http_proxy, https_proxy))
+    return describe_proxy_config(PROXY_CONFIG)
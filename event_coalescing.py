@@ -0,0 +1,85 @@
+"""
+事件合并模块 - 丢弃频繁触发的界面事件中被新调用取代的旧调用
+
+防抖放在客户端：逐字输入的文本框绑定 .blur/.submit 而不是 .change，服务端不为等待输入停顿占用工作线程。
+"""
+
+import inspect
+import itertools
+import functools
+import threading
+
+# (事件键, 会话) -> 最新调用序号；调用结束后删除，只保存进行中的调用
+_latest_calls = {}
+_calls_lock = threading.Lock()
+# 全局递增的调用序号，删除后重新登记的事件键不会复用旧序号
+_call_ids = itertools.count(1)
+# 当前线程正在执行的调用，供处理函数检查自己是否已被取代
+_current = threading.local()
+
+def _next_call_id(key):
+    """登记一次新调用并返回其序号"""
+    with _calls_lock:
+        call_id = next(_call_ids)
+        _latest_calls[key] = call_id
+        return call_id
+
+def _finish_call(key, call_id):
+    """调用结束：仍是最新调用时删除该事件键的登记"""
+    with _calls_lock:
+        if _latest_calls.get(key) == call_id:
+            del _latest_calls[key]
+
+def _is_latest(key, call_id):
+    """判断调用是否仍是该事件键的最新调用"""
+    with _calls_lock:
+        return _latest_calls.get(key) == call_id
+
+def superseded():
+    """在合并事件的处理函数中调用：当前调用已被同一会话的新调用取代时返回True"""
+    check = getattr(_current, "check", None)
+    return bool(check and check())
+
+def _no_change(outputs):
+    """生成"不更新任何输出"的返回值"""
+    import gradio as gr
+    if outputs == 1:
+        return gr.update()
+    return tuple(gr.update() for _ in range(outputs))
+
+def coalesce(key, outputs=1):
+    """装饰器：同一会话内同一事件键的连续调用只保留最后一次的结果
+    
+    执行期间被新调用取代的调用结果会被丢弃，处理函数可以通过 superseded() 提前结束剩余的网络请求。
+    """
+    import gradio as gr
+    
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            # Gradio把请求对象作为最后一个位置参数注入
+            request = None
+            if args and isinstance(args[-1], gr.Request):
+                args, request = args[:-1], args[-1]
+            session = getattr(request, "session_hash", None) or "global"
+            call_key = (key, session)
+            call_id = _next_call_id(call_key)
+            
+            previous = getattr(_current, "check", None)
+            _current.check = lambda: not _is_latest(call_key, call_id)
+            try:
+                result = func(*args)
+                if not _is_latest(call_key, call_id):
+                    return _no_change(outputs)
+                return result
+            finally:
+                _current.check = previous
+                _finish_call(call_key, call_id)
+        
+        # 让Gradio识别并注入请求对象（用于区分会话），Gradio只检查位置参数
+        parameters = list(inspect.signature(func).parameters.values())
+        parameters.append(inspect.Parameter("request", inspect.Parameter.POSITIONAL_OR_KEYWORD, default=None, annotation=gr.Request))
+        wrapper.__signature__ = inspect.Signature(parameters)
+        wrapper.__annotations__ = dict(getattr(func, "__annotations__", {}), request=gr.Request)
+        return wrapper
+    return decorator
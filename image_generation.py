@@ -2,40 +2,101 @@
 图像生成模块 - 处理各种图像生成功能
 """
 
-import torch
-import cv2
+import time
+import inspect
+import functools
+import queue
+import threading
+import contextvars
 import numpy as np
 from PIL import Image
-from models import pipe, controlnet_pipe, img2img_pipe, current_model, current_controlnet, RUN_MODE
-from config import DEVICE, CONTROLNET_TYPES
-from api_client import generate_image_api, generate_controlnet_image_api, generate_img2img_api
+from models import get_session_pipelines
+from config import CONTROLNET_TYPES, PREVIEW_CONFIG, get_device
+from session import resolve_session, find_session
+from memory_policy import memory_policy_applied, report_peak_memory
+from onnx_backend import is_onnx_pipeline
+from inference_pool import is_pool_pipeline, pool_size, run_in_pool
+from concurrency import cancel_requested, spare_lane_slots
+from image_store import store_image, store_encoded
+from api_client import generate_image_api, generate_controlnet_image_api, generate_img2img_api, encode_image_b64
+from metrics import request_labels, stage, pipeline_stages, record_generation
+from tracing import span, set_attributes
+from profiling import profiled
+from memory_accounting import track_request_peak
 
-def generate_image(prompt, negative_prompt, num_steps, guidance_scale, width, height, seed):
-    """基础文生图功能"""
-    from models import pipe, current_model, RUN_MODE
+# 记录到追踪span中的生成参数
+TRACED_PARAMETERS = ("mode", "control_type", "num_steps", "guidance_scale", "strength", "width", "height", "seed", "x_param", "y_param")
+
+def _measured(kind):
+    """装饰器：按会话的运行模式/模型和管道类型标记本次生成，记录端到端耗时、结果和追踪span，按需做性能剖析"""
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            session = resolve_session(find_session(args, kwargs))
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            parameters = {name: arguments[name] for name in TRACED_PARAMETERS if arguments.get(name) is not None}
+            with request_labels(mode=session["run_mode"], model=session["model"], pipeline=kind), \
+                    span(f"generate.{kind}", run_mode=session["run_mode"], model=session["model"], **parameters), \
+                    profiled(kind, session["run_mode"], session["model"]) as profile_capture, \
+                    track_request_peak(session["run_mode"] == "local" and not pool_size()):
+                start = time.perf_counter()
+                outcome = "error"
+                try:
+                    result = func(*args, **kwargs)
+                    if profile_capture is not None and isinstance(result[0], str):
+                        # 剖析索引记录对应的输出文件
+                        profile_capture["output"] = result[0]
+                    if result[0] is not None:
+                        outcome = "ok"
+                    elif cancel_requested():
+                        outcome = "cancelled"
+                    return result
+                finally:
+                    set_attributes(outcome=outcome)
+                    record_generation(time.perf_counter() - start, outcome)
+        return wrapper
+    return decorator
+
+
+@_measured("txt2img")
+def generate_image(prompt, negative_prompt, num_steps, guidance_scale, width, height, seed, preview_callback=None, output="pil", session=None):
+    """基础文生图功能（output="file" 时返回输出存储中的文件路径，"bytes" 时API模式返回上游编码字节）"""
+    session = resolve_session(session)
+    pipe = get_session_pipelines(session)["pipe"]
     
     if pipe is None:
         return None, "Please load the model first"
     
-    if RUN_MODE == "api":
+    if session["run_mode"] == "api":
         # API模式
         try:
-            image, status = generate_image_api(prompt, negative_prompt, current_model)
-            return image, status
+            image, status = generate_image_api(prompt, negative_prompt, session["model"], raw=output != "pil", session=session)
+            return _finish_image(image, output), status
         except Exception as e:
             return None, f"❌ API生成失败: {str(e)}"
     
+    elif is_pool_pipeline(pipe):
+        # 推理进程池：分派给空闲的工作进程，结果图像经共享内存返回
+        image, status = run_in_pool("txt2img", {"prompt": prompt, "negative_prompt": negative_prompt, "num_steps": num_steps,
+                                                "guidance_scale": guidance_scale, "width": width, "height": height, "seed": seed},
+                                    session, should_cancel=_stopped_check(preview_callback))
+        return _finish_image(image, output), status
+    
     else:
-        # 本地模式
+        # 本地模式 - torch只在本地推理时导入，API模式启动不必加载
+        import torch
         try:
             # 设置随机种子
-            if seed != -1:
-                generator = torch.Generator(device=DEVICE).manual_seed(seed)
-            else:
-                generator = None
+            generator = _make_generator(seed, pipe)
+            
+            # 编译后端需要把分辨率对齐到分桶
+            width, height, bucket_note = _snap_resolution(width, height, session["local_backend"])
                 
-            # 生成图像
-            with torch.autocast(DEVICE):
+            # 根据分辨率和可用内存启用省内存选项，生成期间保持
+            with memory_policy_applied(pipe, width, height) as memory_decision, \
+                    torch.autocast(get_device()), pipeline_stages():
                 result = pipe(
                     prompt=prompt,
                     negative_prompt=negative_prompt if negative_prompt else None,
@@ -43,17 +104,20 @@ def generate_image(prompt, negative_prompt, num_steps, guidance_scale, width, he
                     guidance_scale=guidance_scale,
                     width=width,
                     height=height,
-                    generator=generator
+                    generator=generator,
+                    **_preview_kwargs(pipe, preview_callback)
                 )
             
-            image = result.images[0]
-            return image, "✅ 本地图像生成成功！"
+            _mark_bucket_used("txt2img", width, height, session["local_backend"])
+            image = _finish_image(result.images[0], output)
+            return image, f"✅ 本地图像生成成功！{bucket_note}\n{report_peak_memory(memory_decision)}"
             
         except Exception as e:
             return None, f"❌ 本地生成失败: {str(e)}"
 
 def preprocess_canny(image, low_threshold=100, high_threshold=200):
     """预处理图像为Canny边缘"""
+    import cv2
     image = np.array(image)
     canny = cv2.Canny(image, low_threshold, high_threshold)
     canny_image = canny[:, :, None]
@@ -62,6 +126,7 @@ def preprocess_canny(image, low_threshold=100, high_threshold=200):
 
 def preprocess_scribble(image):
     """预处理图像为涂鸦风格（简化边缘）"""
+    import cv2
     image = np.array(image)
     # 转换为灰度图
     gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
@@ -77,6 +142,7 @@ def preprocess_scribble(image):
 
 def preprocess_depth(image):
     """预处理图像为深度图（使用简单的深度估计）"""
+    import cv2
     image = np.array(image)
     # 转换为灰度图作为简单的深度估计
     gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
@@ -91,18 +157,48 @@ def preprocess_depth(image):
 
 def preprocess_control_image(image, control_type):
     """根据控制类型预处理图像"""
-    if control_type == "canny":
-        return preprocess_canny(image)
-    elif control_type == "scribble":
-        return preprocess_scribble(image)
-    elif control_type == "depth":
-        return preprocess_depth(image)
-    else:
-        return preprocess_canny(image)  # 默认使用canny
+    with stage("preprocess"):
+        if control_type == "canny":
+            return preprocess_canny(image)
+        elif control_type == "scribble":
+            return preprocess_scribble(image)
+        elif control_type == "depth":
+            return preprocess_depth(image)
+        else:
+            return preprocess_canny(image)  # 默认使用canny
+
+def _finish_image(image, output):
+    """按输出方式整理生成结果：output="file" 时写入输出存储并返回文件路径，API原始字节不解码直接保存；
+    output="bytes" 时API原始字节原样返回，本地生成仍返回PIL图像"""
+    if image is None or output != "file":
+        return image
+    if isinstance(image, bytes):
+        return store_encoded(image)
+    return store_image(image)
+
+def _snap_resolution(width, height, backend):
+    """编译后端下把分辨率对齐到预设分桶，返回 (宽, 高, 提示文本)"""
+    if backend != "compile":
+        return width, height, ""
+    
+    from compile_backend import snap_to_bucket
+    bucket_width, bucket_height = snap_to_bucket(width, height)
+    if (bucket_width, bucket_height) == (int(width), int(height)):
+        return bucket_width, bucket_height, ""
+    return bucket_width, bucket_height, f"\n📐 分辨率已对齐到编译分桶 {bucket_width}x{bucket_height}"
+
+def _mark_bucket_used(kind, width, height, backend):
+    """编译后端下记录分桶使用，新分桶编译后持久化编译缓存"""
+    if backend == "compile":
+        from compile_backend import mark_bucket_used
+        mark_bucket_used(kind, width, height)
 
-def generate_controlnet_image(prompt, negative_prompt, control_image, control_type, num_steps, guidance_scale, controlnet_conditioning_scale, width, height, seed):
-    """ControlNet图像引导生成"""
-    from models import controlnet_pipe, current_controlnet, RUN_MODE
+@_measured("controlnet")
+def generate_controlnet_image(prompt, negative_prompt, control_image, control_type, num_steps, guidance_scale, controlnet_conditioning_scale, width, height, seed, preview_callback=None, output="pil", session=None):
+    """ControlNet图像引导生成（output="file" 时返回输出存储中的文件路径，"bytes" 时API模式返回上游编码字节）"""
+    session = resolve_session(session)
+    controlnet_pipe = get_session_pipelines(session)["controlnet_pipe"]
+    current_controlnet = session["controlnet"]
     
     if controlnet_pipe is None:
         return None, None, "❌ 请先加载模型"
@@ -114,28 +210,38 @@ def generate_controlnet_image(prompt, negative_prompt, control_image, control_ty
     if current_controlnet != control_type:
         return None, None, f"❌ 当前加载的是 {CONTROLNET_TYPES[current_controlnet]['name']}，请重新加载模型选择 {CONTROLNET_TYPES[control_type]['name']}"
     
+    if session["run_mode"] != "api" and is_pool_pipeline(controlnet_pipe):
+        # 推理进程池：控制图预处理也在工作进程中完成，预处理结果随生成结果经共享内存返回
+        image, processed_image, status = run_in_pool("controlnet", {
+            "prompt": prompt, "negative_prompt": negative_prompt, "control_image": control_image, "control_type": control_type,
+            "num_steps": num_steps, "guidance_scale": guidance_scale, "controlnet_conditioning_scale": controlnet_conditioning_scale,
+            "width": width, "height": height, "seed": seed}, session, should_cancel=_stopped_check(preview_callback))
+        return _finish_image(image, output), processed_image, status
+    
     # 预处理控制图像
     processed_image = preprocess_control_image(control_image, control_type)
     
-    if RUN_MODE == "api":
+    if session["run_mode"] == "api":
         # API模式
         try:
-            image, status = generate_controlnet_image_api(prompt, negative_prompt, processed_image, control_type)
-            return image, processed_image, status
+            image, status = generate_controlnet_image_api(prompt, negative_prompt, processed_image, control_type, raw=output != "pil", session=session)
+            return _finish_image(image, output), processed_image, status
         except Exception as e:
             return None, processed_image, f"❌ API生成失败: {str(e)}"
     
     else:
-        # 本地模式
+        # 本地模式 - torch只在本地推理时导入，API模式启动不必加载
+        import torch
         try:
             # 设置随机种子
-            if seed != -1:
-                generator = torch.Generator(device=DEVICE).manual_seed(seed)
-            else:
-                generator = None
+            generator = _make_generator(seed, controlnet_pipe)
+            
+            # 编译后端需要把分辨率对齐到分桶
+            width, height, bucket_note = _snap_resolution(width, height, session["local_backend"])
                 
-            # 生成图像
-            with torch.autocast(DEVICE):
+            # 根据分辨率和可用内存启用省内存选项，生成期间保持
+            with memory_policy_applied(controlnet_pipe, width, height) as memory_decision, \
+                    torch.autocast(get_device()), pipeline_stages():
                 result = controlnet_pipe(
                     prompt=prompt,
                     negative_prompt=negative_prompt if negative_prompt else None,
@@ -145,19 +251,23 @@ def generate_controlnet_image(prompt, negative_prompt, control_image, control_ty
                     controlnet_conditioning_scale=controlnet_conditioning_scale,
                     width=width,
                     height=height,
-                    generator=generator
+                    generator=generator,
+                    **_preview_kwargs(controlnet_pipe, preview_callback)
                 )
             
-            image = result.images[0]
             control_type_name = CONTROLNET_TYPES[control_type]['name']
-            return image, processed_image, f"✅ {control_type_name}图像生成成功！"
+            _mark_bucket_used("controlnet", width, height, session["local_backend"])
+            image = _finish_image(result.images[0], output)
+            return image, processed_image, f"✅ {control_type_name}图像生成成功！{bucket_note}\n{report_peak_memory(memory_decision)}"
             
         except Exception as e:
             return None, processed_image, f"❌ 生成失败: {str(e)}"
 
-def generate_img2img(prompt, negative_prompt, input_image, strength, num_steps, guidance_scale, width, height, seed):
-    """传统图生图功能"""
-    from models import img2img_pipe, RUN_MODE
+@_measured("img2img")
+def generate_img2img(prompt, negative_prompt, input_image, strength, num_steps, guidance_scale, width, height, seed, preview_callback=None, output="pil", session=None):
+    """传统图生图功能（output="file" 时返回输出存储中的文件路径，"bytes" 时API模式返回上游编码字节）"""
+    session = resolve_session(session)
+    img2img_pipe = get_session_pipelines(session)["img2img_pipe"]
     
     if img2img_pipe is None:
         return None, "❌ 请先加载模型"
@@ -165,28 +275,41 @@ def generate_img2img(prompt, negative_prompt, input_image, strength, num_steps,
     if input_image is None:
         return None, "❌ 请上传输入图像"
     
+    if session["run_mode"] != "api" and is_pool_pipeline(img2img_pipe):
+        # 推理进程池：缩放和分桶对齐在工作进程中完成
+        image, status = run_in_pool("img2img", {
+            "prompt": prompt, "negative_prompt": negative_prompt, "input_image": input_image, "strength": strength,
+            "num_steps": num_steps, "guidance_scale": guidance_scale, "width": width, "height": height, "seed": seed},
+            session, should_cancel=_stopped_check(preview_callback))
+        return _finish_image(image, output), status
+    
+    # 编译后端需要把分辨率对齐到分桶
+    bucket_note = ""
+    if session["run_mode"] != "api":
+        width, height, bucket_note = _snap_resolution(width, height, session["local_backend"])
+    
     # 调整图像大小
-    input_image = input_image.resize((width, height))
+    with stage("preprocess"):
+        input_image = input_image.resize((width, height))
     
-    if RUN_MODE == "api":
+    if session["run_mode"] == "api":
         # API模式
         try:
-            image, status = generate_img2img_api(prompt, negative_prompt, input_image, strength)
-            return image, status
+            image, status = generate_img2img_api(prompt, negative_prompt, input_image, strength, raw=output != "pil", session=session)
+            return _finish_image(image, output), status
         except Exception as e:
             return None, f"❌ API生成失败: {str(e)}"
     
     else:
-        # 本地模式
+        # 本地模式 - torch只在本地推理时导入，API模式启动不必加载
+        import torch
         try:
             # 设置随机种子
-            if seed != -1:
-                generator = torch.Generator(device=DEVICE).manual_seed(seed)
-            else:
-                generator = None
+            generator = _make_generator(seed, img2img_pipe)
                 
-            # 生成图像
-            with torch.autocast(DEVICE):
+            # 根据分辨率和可用内存启用省内存选项，生成期间保持
+            with memory_policy_applied(img2img_pipe, width, height) as memory_decision, \
+                    torch.autocast(get_device()), pipeline_stages():
                 result = img2img_pipe(
                     prompt=prompt,
                     negative_prompt=negative_prompt if negative_prompt else None,
@@ -194,15 +317,144 @@ def generate_img2img(prompt, negative_prompt, input_image, strength, num_steps,
                     strength=strength,
                     num_inference_steps=num_steps,
                     guidance_scale=guidance_scale,
-                    generator=generator
+                    generator=generator,
+                    **_preview_kwargs(img2img_pipe, preview_callback)
                 )
             
-            image = result.images[0]
-            return image, "✅ 传统图生图成功！"
+            _mark_bucket_used("img2img", width, height, session["local_backend"])
+            image = _finish_image(result.images[0], output)
+            return image, f"✅ 传统图生图成功！{bucket_note}\n{report_peak_memory(memory_decision)}"
             
         except Exception as e:
             return None, f"❌ 生成失败: {str(e)}"
 
+# SD 1.x/2.x 潜变量(4通道)到RGB的线性近似系数，用于跳过VAE解码快速生成预览
+LATENT_RGB_FACTORS = np.array([
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+], dtype=np.float32)
+
+class GenerationCancelled(Exception):
+    """流式生成被用户停止"""
+
+def latents_to_preview(latents):
+    """把潜变量线性投影成低分辨率RGB预览图（不经过VAE）"""
+    if hasattr(latents, "detach"):
+        latents = latents[0].detach().float().cpu().numpy()
+    else:
+        # ONNX管道的潜变量是numpy数组
+        latents = np.asarray(latents, dtype=np.float32)[0]
+    
+    rgb = np.einsum("chw,cr->hwr", latents, LATENT_RGB_FACTORS)
+    rgb = ((rgb + 1.0) * 127.5).clip(0, 255).astype(np.uint8)
+    preview = Image.fromarray(rgb)
+    scale = PREVIEW_CONFIG["upscale"]
+    if scale > 1:
+        preview = preview.resize((preview.width * scale, preview.height * scale), Image.BILINEAR)
+    return preview
+
+def _preview_kwargs(pipeline, preview_callback):
+    """根据管道支持的回调接口构造逐步回调参数：每步检查关闭中止信号，传入preview_callback时每N步推送预览"""
+    every = max(1, int(PREVIEW_CONFIG["every_n_steps"]))
+    
+    def on_step(step, latents):
+        if cancel_requested():
+            raise GenerationCancelled("生成已中止")
+        if preview_callback is None:
+            return
+        step += 1
+        preview_callback(latents_to_preview(latents) if step % every == 0 else None, step)
+    
+    if "callback_on_step_end" in inspect.signature(pipeline.__call__).parameters:
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            on_step(step, callback_kwargs["latents"])
+            return callback_kwargs
+        return {"callback_on_step_end": on_step_end}
+    
+    # 旧版diffusers及ONNX管道只支持 callback(step, timestep, latents)
+    return {"callback": lambda step, timestep, latents: on_step(step, latents), "callback_steps": 1}
+
+def _stopped_check(preview_callback):
+    """推理进程池生成的停止检查：流式生成的调用方停止后，preview_callback 会抛出 GenerationCancelled"""
+    if preview_callback is None:
+        return None
+    
+    def stopped():
+        try:
+            preview_callback(None, 0)
+        except GenerationCancelled:
+            return True
+        return False
+    return stopped
+
+def _stream_generation(generate_fn, args, pack, **kwargs):
+    """在后台线程运行生成函数，边生成边产出预览；调用方停止迭代时在下一步中止生成"""
+    updates = queue.Queue()
+    cancelled = threading.Event()
+    
+    def preview_callback(preview, step):
+        if cancelled.is_set():
+            raise GenerationCancelled("生成已中止")
+        if preview is not None:
+            updates.put(("preview", preview, step))
+    
+    def worker():
+        try:
+            updates.put(("done", generate_fn(*args, preview_callback=preview_callback, **kwargs), None))
+        except Exception as e:
+            updates.put(("error", e, None))
+    
+    # 复制当前上下文，生成线程中的span挂在本次请求的追踪下
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, payload, step = updates.get()
+            if kind == "preview":
+                yield pack(payload, f"⏳ 生成中... 第 {step} 步（低分辨率预览）")
+            elif kind == "done":
+                yield payload
+                return
+            else:
+                raise payload
+    finally:
+        # 停止按钮或客户端断开：通知生成线程在下一步退出，等它释放管道后再交还并发名额
+        cancelled.set()
+        thread.join()
+
+def generate_image_stream(prompt, negative_prompt, num_steps, guidance_scale, width, height, seed, session=None):
+    """文生图（流式）：本地模式每隔N步返回一次预览，最后返回编码后的结果文件路径（编码在生成线程中完成）"""
+    yield from _stream_generation(
+        generate_image,
+        (prompt, negative_prompt, num_steps, guidance_scale, width, height, seed),
+        lambda preview, status: (preview, status),
+        output="file",
+        session=session
+    )
+
+def generate_controlnet_image_stream(prompt, negative_prompt, control_image, control_type, num_steps, guidance_scale, controlnet_conditioning_scale, width, height, seed, session=None):
+    """ControlNet生成（流式）：预览期间控制图预览保持不变，最后随结果一起更新"""
+    import gradio as gr
+    yield from _stream_generation(
+        generate_controlnet_image,
+        (prompt, negative_prompt, control_image, control_type, num_steps, guidance_scale, controlnet_conditioning_scale, width, height, seed),
+        lambda preview, status: (preview, gr.update(), status),
+        output="file",
+        session=session
+    )
+
+def generate_img2img_stream(prompt, negative_prompt, input_image, strength, num_steps, guidance_scale, width, height, seed, session=None):
+    """传统图生图（流式）"""
+    yield from _stream_generation(
+        generate_img2img,
+        (prompt, negative_prompt, input_image, strength, num_steps, guidance_scale, width, height, seed),
+        lambda preview, status: (preview, status),
+        output="file",
+        session=session
+    )
+
 def add_prompt_tags(current_prompt, selected_tags):
     """添加选中的标签到prompt中"""
     if not selected_tags:
@@ -217,3 +469,305 @@ def add_prompt_tags(current_prompt, selected_tags):
     else:
         # 如果没有prompt，直接使用标签
         return new_tags
+
+
+# 参数网格可扫描的参数: 参数名 -> (显示名, 类型, 适用的生成模式)
+GRID_PARAMETERS = {
+    "guidance_scale": ("引导强度", float, ("txt2img", "img2img", "controlnet")),
+    "num_steps": ("采样步数", int, ("txt2img", "img2img", "controlnet")),
+    "strength": ("变化强度", float, ("img2img",)),
+    "controlnet_conditioning_scale": ("ControlNet强度", float, ("controlnet",)),
+    "seed": ("随机种子", int, ("txt2img", "img2img", "controlnet")),
+}
+
+# API模式下各生成模式真正会传给云端的参数
+GRID_API_PARAMETERS = {
+    "txt2img": ("guidance_scale", "num_steps"),
+    "img2img": ("strength",),
+    "controlnet": ("controlnet_conditioning_scale",),
+}
+
+# 单次网格任务允许的最大格子数
+GRID_MAX_CELLS = 16
+
+def parse_grid_values(param_name, values_text):
+    """解析逗号分隔的参数取值列表"""
+    if not param_name or param_name == "none":
+        return [None]
+    if param_name not in GRID_PARAMETERS:
+        raise ValueError(f"不支持扫描的参数: {param_name}")
+    
+    cast = GRID_PARAMETERS[param_name][1]
+    values = []
+    for item in str(values_text or "").replace("，", ",").split(","):
+        item = item.strip()
+        if item:
+            values.append(cast(float(item)))
+    if not values:
+        raise ValueError(f"请为 {GRID_PARAMETERS[param_name][0]} 填写至少一个取值")
+    return values
+
+def _grid_cells(base_params, x_param, x_values, y_param, y_values):
+    """展开网格，返回 [(行, 列, 参数字典)]"""
+    cells = []
+    for row, y_value in enumerate(y_values):
+        for col, x_value in enumerate(x_values):
+            params = dict(base_params)
+            if y_value is not None:
+                params[y_param] = y_value
+            if x_value is not None:
+                params[x_param] = x_value
+            cells.append((row, col, params))
+    return cells
+
+def _make_generator(seed, pipeline=None):
+    """根据种子创建随机数生成器（-1 表示随机），ONNX管道使用numpy随机状态"""
+    if seed is None or seed == -1:
+        return None
+    if pipeline is not None and is_onnx_pipeline(pipeline):
+        return np.random.RandomState(int(seed))
+    import torch
+    return torch.Generator(device=get_device()).manual_seed(int(seed))
+
+def _format_grid_value(param_name, value):
+    """格式化网格标签中的参数值"""
+    if value is None:
+        return ""
+    label = GRID_PARAMETERS[param_name][0]
+    if isinstance(value, float):
+        return f"{label}={value:g}"
+    return f"{label}={value}"
+
+def build_contact_sheet(images, x_param, x_values, y_param, y_values, cell_size=256):
+    """把网格结果拼成带标签的联系表"""
+    from PIL import ImageDraw
+    
+    header_h = 28 if x_values != [None] else 0
+    header_w = 150 if y_values != [None] else 0
+    cols, rows = len(x_values), len(y_values)
+    sheet = Image.new("RGB", (header_w + cols * cell_size, header_h + rows * cell_size), "white")
+    draw = ImageDraw.Draw(sheet)
+    
+    for col, x_value in enumerate(x_values):
+        if header_h:
+            draw.text((header_w + col * cell_size + 6, 8), _format_grid_value(x_param, x_value), fill="black")
+    for row, y_value in enumerate(y_values):
+        if header_w:
+            draw.text((6, header_h + row * cell_size + cell_size // 2 - 6), _format_grid_value(y_param, y_value), fill="black")
+    
+    for (row, col), image in images.items():
+        left, top = header_w + col * cell_size, header_h + row * cell_size
+        if image is None:
+            draw.rectangle([left, top, left + cell_size - 1, top + cell_size - 1], outline="red")
+            draw.text((left + 6, top + 6), "failed", fill="red")
+            continue
+        thumb = image.convert("RGB").copy()
+        thumb.thumbnail((cell_size, cell_size))
+        sheet.paste(thumb, (left + (cell_size - thumb.width) // 2, top + (cell_size - thumb.height) // 2))
+    
+    return sheet
+
+def _run_grid_api(mode, cells, shared, model_id, control_type, session=None):
+    """API模式运行网格：共享预处理结果和编码后的输入图像"""
+    images = {}
+    for row, col, params in cells:
+        if mode == "txt2img":
+            image, _ = generate_image_api(shared["prompt"], shared["negative_prompt"], model_id,
+                                          num_steps=params["num_steps"], guidance_scale=params["guidance_scale"], session=session)
+        elif mode == "img2img":
+            image, _ = generate_img2img_api(shared["prompt"], shared["negative_prompt"], shared["image_b64"], params["strength"], session=session)
+        else:
+            image, _ = generate_controlnet_image_api(shared["prompt"], shared["negative_prompt"], shared["image_b64"], control_type,
+                                                     controlnet_conditioning_scale=params["controlnet_conditioning_scale"], session=session)
+        images[(row, col)] = image
+    return images
+
+def _run_grid_onnx(mode, cells, shared, pipeline):
+    """ONNX后端运行网格：逐格调用管道，共享预处理后的输入图像"""
+    images = {}
+    for row, col, params in cells:
+        kwargs = {
+            "prompt": shared["prompt"],
+            "negative_prompt": shared["negative_prompt"] if shared["negative_prompt"] else None,
+            "num_inference_steps": params["num_steps"],
+            "guidance_scale": params["guidance_scale"],
+            "generator": _make_generator(params["seed"], pipeline),
+            # 每步检查中止信号，关闭时不必等整张网格跑完
+            **_preview_kwargs(pipeline, None),
+        }
+        if mode == "txt2img":
+            kwargs.update(width=shared["width"], height=shared["height"])
+        else:
+            kwargs.update(image=shared["image"], strength=params["strength"])
+        try:
+            with pipeline_stages():
+                images[(row, col)] = pipeline(**kwargs).images[0]
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            print(f"⚠️ 网格格子生成失败 {params}: {e}")
+            images[(row, col)] = None
+    return images
+
+def _run_grid_pool(mode, cells, shared, input_image, control_type, session):
+    """推理进程池运行网格：各格子并行分派给工作进程（每格单独推理，不共享文本嵌入和批量推理）"""
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def run_cell(params):
+        arguments = {"prompt": shared["prompt"], "negative_prompt": shared["negative_prompt"], "num_steps": params["num_steps"],
+                     "guidance_scale": params["guidance_scale"], "width": shared["width"], "height": shared["height"], "seed": params["seed"]}
+        if mode == "img2img":
+            arguments.update(input_image=shared["image"], strength=params["strength"])
+        elif mode == "controlnet":
+            # 工作进程中的生成函数自行预处理控制图
+            arguments.update(control_image=input_image, control_type=control_type,
+                             controlnet_conditioning_scale=params["controlnet_conditioning_scale"])
+        return run_in_pool(mode, arguments, session)[0]
+    
+    # 网格只占用一个本地通道槽位，并行度只借用当前空闲的槽位，不挤占排队中的其他请求；
+    # 每个格子复制一份上下文，分派span挂在本次请求的追踪下
+    with spare_lane_slots("local", pool_size() - 1) as spare, ThreadPoolExecutor(max_workers=1 + spare) as executor:
+        futures = {(row, col): executor.submit(contextvars.copy_context().run, run_cell, params) for row, col, params in cells}
+    return {position: future.result() for position, future in futures.items()}
+
+def _run_grid_local(mode, cells, shared, pipeline):
+    """本地模式运行网格：共享文本嵌入、VAE编码结果和控制图，仅种子不同的格子合批推理"""
+    if is_onnx_pipeline(pipeline):
+        return _run_grid_onnx(mode, cells, shared, pipeline)
+    
+    import torch
+    device = get_device()
+    with stage("text_encode"):
+        prompt_embeds, negative_embeds = pipeline.encode_prompt(
+            shared["prompt"], device, 1, True,
+            negative_prompt=shared["negative_prompt"] if shared["negative_prompt"] else None
+        )[:2]
+    
+    init_latents = None
+    if mode == "img2img":
+        with stage("preprocess"):
+            image_tensor = pipeline.image_processor.preprocess(shared["image"]).to(device, dtype=pipeline.vae.dtype)
+            with torch.no_grad():
+                init_latents = pipeline.vae.encode(image_tensor).latent_dist.mode() * pipeline.vae.config.scaling_factor
+    
+    # 除种子外参数完全一致的格子共用一次批量推理
+    groups = {}
+    for row, col, params in cells:
+        key = tuple(sorted((k, v) for k, v in params.items() if k != "seed"))
+        groups.setdefault(key, []).append((row, col, params))
+    
+    images = {}
+    for key, members in groups.items():
+        params = dict(key)
+        kwargs = {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": negative_embeds,
+            "num_inference_steps": params["num_steps"],
+            "guidance_scale": params["guidance_scale"],
+            "num_images_per_prompt": len(members),
+            # 每步检查中止信号，关闭时不必等整张网格跑完
+            **_preview_kwargs(pipeline, None),
+        }
+        generators = [_make_generator(m[2]["seed"], pipeline) for m in members]
+        if all(g is not None for g in generators):
+            kwargs["generator"] = generators
+        
+        if mode == "txt2img":
+            kwargs.update(width=shared["width"], height=shared["height"])
+        elif mode == "img2img":
+            kwargs.update(image=init_latents, strength=params["strength"])
+        else:
+            kwargs.update(image=shared["control_map"], width=shared["width"], height=shared["height"],
+                          controlnet_conditioning_scale=params["controlnet_conditioning_scale"])
+        
+        try:
+            with memory_policy_applied(pipeline, shared["width"], shared["height"], batch_size=len(members)) as memory_decision, \
+                    torch.autocast(get_device()), pipeline_stages():
+                result = pipeline(**kwargs)
+            report_peak_memory(memory_decision)
+            for (row, col, _), image in zip(members, result.images):
+                images[(row, col)] = image
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            print(f"⚠️ 网格批次生成失败 {params}: {e}")
+            for row, col, _ in members:
+                images[(row, col)] = None
+    return images
+
+@_measured("grid")
+def generate_grid(mode, prompt, negative_prompt, input_image, control_type, num_steps, guidance_scale, strength,
+                  controlnet_conditioning_scale, width, height, seed, x_param, x_values_text, y_param, y_values_text, session=None, output="pil"):
+    """参数网格生成：一次任务扫描最多两个参数，返回带标签的联系表"""
+    session = resolve_session(session)
+    pipelines = get_session_pipelines(session)
+    current_controlnet = session["controlnet"]
+    
+    pipeline = {"txt2img": pipelines["pipe"], "img2img": pipelines["img2img_pipe"], "controlnet": pipelines["controlnet_pipe"]}.get(mode)
+    if pipeline is None:
+        return None, "❌ 请先加载模型"
+    
+    if mode != "txt2img" and input_image is None:
+        return None, "❌ 请上传输入图像"
+    
+    if mode == "controlnet" and current_controlnet != control_type:
+        return None, f"❌ 当前加载的是 {CONTROLNET_TYPES[current_controlnet]['name']}，请重新加载模型选择 {CONTROLNET_TYPES[control_type]['name']}"
+    
+    try:
+        x_values = parse_grid_values(x_param, x_values_text)
+        y_values = parse_grid_values(y_param, y_values_text)
+    except ValueError as e:
+        return None, f"❌ 参数取值错误: {str(e)}"
+    
+    for param_name in (x_param, y_param):
+        if not param_name or param_name == "none":
+            continue
+        if mode not in GRID_PARAMETERS[param_name][2]:
+            return None, f"❌ {GRID_PARAMETERS[param_name][0]} 不适用于当前生成模式"
+        if session["run_mode"] == "api" and param_name not in GRID_API_PARAMETERS[mode]:
+            return None, f"❌ API模式下 {GRID_PARAMETERS[param_name][0]} 不会传给云端，请改用本地模式扫描"
+    if x_param and x_param != "none" and x_param == y_param:
+        return None, "❌ X轴与Y轴不能选择同一个参数"
+    
+    cell_count = len(x_values) * len(y_values)
+    if cell_count > GRID_MAX_CELLS:
+        return None, f"❌ 网格共 {cell_count} 格，超过上限 {GRID_MAX_CELLS} 格"
+    
+    base_params = {
+        "num_steps": int(num_steps),
+        "guidance_scale": float(guidance_scale),
+        "strength": float(strength),
+        "controlnet_conditioning_scale": float(controlnet_conditioning_scale),
+        "seed": int(seed),
+    }
+    cells = _grid_cells(base_params, x_param, x_values, y_param, y_values)
+    
+    bucket_note = ""
+    if session["run_mode"] != "api":
+        width, height, bucket_note = _snap_resolution(width, height, session["local_backend"])
+    
+    # 所有格子共享的输入只准备一次
+    shared = {"prompt": prompt, "negative_prompt": negative_prompt, "width": width, "height": height}
+    if mode == "img2img":
+        with stage("preprocess"):
+            shared["image"] = input_image.resize((width, height))
+    elif mode == "controlnet" and not is_pool_pipeline(pipeline):
+        shared["control_map"] = preprocess_control_image(input_image, control_type)
+    
+    try:
+        if session["run_mode"] == "api":
+            if mode != "txt2img":
+                shared["image_b64"] = encode_image_b64(shared["image"] if mode == "img2img" else shared["control_map"])
+            images = _run_grid_api(mode, cells, shared, session["model"], control_type, session)
+        elif is_pool_pipeline(pipeline):
+            images = _run_grid_pool(mode, cells, shared, input_image, control_type, session)
+        else:
+            images = _run_grid_local(mode, cells, shared, pipeline)
+    except Exception as e:
+        return None, f"❌ 网格生成失败: {str(e)}"
+    
+    sheet = _finish_image(build_contact_sheet(images, x_param, x_values, y_param, y_values), output)
+    failed = sum(1 for image in images.values() if image is None)
+    if failed:
+        return sheet, f"⚠️ 网格生成完成：{cell_count - failed}/{cell_count} 格成功{bucket_note}"
+    return sheet, f"✅ 网格生成完成：共 {cell_count} 格{bucket_note}"
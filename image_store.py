@@ -0,0 +1,116 @@
+"""
+输出存储模块 - 把生成结果以编码后的字节保存到按内容哈希命名的文件，供界面直接返回文件路径
+"""
+
+import io
+import os
+import hashlib
+import threading
+from config import OUTPUT_CONFIG
+from metrics import stage, count_cache
+
+# 文件头魔数 -> 扩展名
+_MAGIC_FORMATS = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+# PIL格式名 -> (扩展名, 编码参数函数)
+_ENCODERS = {
+    # method=0 为WebP最快的编码档位
+    "webp": ("webp", lambda: {"format": "WEBP", "quality": OUTPUT_CONFIG["quality"], "method": 0}),
+    "jpeg": ("jpg", lambda: {"format": "JPEG", "quality": OUTPUT_CONFIG["quality"]}),
+    "png": ("png", lambda: {"format": "PNG", "compress_level": OUTPUT_CONFIG["png_compress_level"]}),
+}
+
+_prune_lock = threading.Lock()
+_stores_since_prune = 0
+
+def sniff_format(data):
+    """根据文件头识别图像格式，返回扩展名，无法识别时返回None"""
+    for magic, ext in _MAGIC_FORMATS:
+        if data.startswith(magic):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def encode_image(image, fmt=None):
+    """把PIL图像编码为字节，返回 (字节, 扩展名)"""
+    fmt = (fmt or OUTPUT_CONFIG["format"]).lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in _ENCODERS:
+        raise ValueError(f"不支持的输出格式: {fmt}")
+    
+    ext, options = _ENCODERS[fmt]
+    if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffered = io.BytesIO()
+    image.save(buffered, **options())
+    return buffered.getvalue(), ext
+
+def store_bytes(data, ext):
+    """按内容哈希保存已编码的图像字节，相同内容只写一次，返回文件路径"""
+    digest = hashlib.sha256(data).hexdigest()
+    directory = os.path.join(OUTPUT_CONFIG["dir"], digest[:2])
+    path = os.path.join(directory, f"{digest}.{ext}")
+    exists = os.path.exists(path)
+    if exists:
+        # 刷新修改时间：清理按修改时间删除最旧的文件，刚返回给界面的文件不能被当成最旧的删掉
+        try:
+            os.utime(path)
+        except OSError:
+            exists = False
+    count_cache("output_store", exists)
+    if not exists:
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        _maybe_prune()
+    return path
+
+def store_encoded(data):
+    """保存上游返回的已编码图像：能识别的格式原样保存，否则解码后按配置格式重新编码"""
+    ext = sniff_format(data)
+    if ext is None:
+        from PIL import Image
+        return store_image(Image.open(io.BytesIO(data)))
+    with stage("output_encode"):
+        return store_bytes(data, ext)
+
+def store_image(image, fmt=None):
+    """编码并保存PIL图像，返回文件路径"""
+    with stage("output_encode"):
+        data, ext = encode_image(image, fmt)
+        return store_bytes(data, ext)
+
+def _maybe_prune(every=50):
+    """每保存若干个文件检查一次，超过上限时删除最旧的文件"""
+    global _stores_since_prune
+    with _prune_lock:
+        _stores_since_prune += 1
+        if _stores_since_prune < every:
+            return
+        _stores_since_prune = 0
+    
+    entries = []
+    for root, _, files in os.walk(OUTPUT_CONFIG["dir"]):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+    excess = len(entries) - OUTPUT_CONFIG["max_files"]
+    if excess <= 0:
+        return
+    for _, path in sorted(entries)[:excess]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,386 @@
+"""
+本地推理进程池 - N个推理工作进程各自加载本地管道，每个进程绑定一组CPU核心并使用独立的线程数设置，
+由调度器把生成请求分派给空闲的进程；输入/输出图像通过共享内存传递，不经过pickle序列化
+
+一个进程用全部核心跑一次推理时，大量线程间的同步开销和界面进程中GIL下的编码、预处理工作都会拖慢吞吐；
+多核CPU上多个小线程数的进程并行生成，总吞吐量通常明显更高（每个进程都加载一份模型，内存按进程数增加）。
+配置见 config.INFERENCE_POOL_CONFIG，启用后本地模式的加载和生成自动通过进程池：
+
+    SD_INFERENCE_WORKERS=8 SD_INFERENCE_THREADS=8 python app.py      # 64核：8个进程 × 8线程
+
+每个工作进程有一块输入和一块输出共享内存（按最大分辨率预分配），请求消息只包含参数和图像在共享内存中的位置。
+进程池模式下不推送中间预览；停止按钮和关闭流程的中止请求通过每个进程的中止事件转发，工作进程在下一步中止。
+"""
+
+import os
+import queue
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from config import INFERENCE_POOL_CONFIG
+from concurrency import cancel_requested, use_cancel_event
+from tracing import span
+from metrics import stage
+
+# 工作进程：{"index", "process", "conn", "pid", "input", "output", "cancel", "cores", "threads", "stopped"}
+_workers = []
+_idle = queue.Queue()
+_pool_lock = threading.Lock()
+# 启动工作进程时临时修改本进程的环境变量，同一时间只启动一个
+_spawn_lock = threading.Lock()
+# 加载占用全部工作进程，多个会话同时加载时逐个执行，避免各自只拿到一部分进程而互相等待
+_load_lock = threading.Lock()
+
+# 各生成类型返回的元组长度（出错时除最后的状态文本外其余为None）
+_RESULT_SIZES = {"txt2img": 2, "img2img": 2, "controlnet": 3}
+
+class PoolPipeline:
+    """管道池中代表推理进程池的占位管道，生成函数见到它时把请求分派给工作进程"""
+
+    def __init__(self, kind):
+        self.kind = kind
+
+def is_pool_pipeline(pipeline):
+    """判断管道是否为推理进程池的占位管道"""
+    return isinstance(pipeline, PoolPipeline)
+
+def pool_enabled():
+    """是否启用推理进程池"""
+    return INFERENCE_POOL_CONFIG["workers"] > 0
+
+def pool_size():
+    """已启动的工作进程数"""
+    return len(_workers)
+
+def worker_pids():
+    """各工作进程的 (序号, pid)"""
+    return [(worker["index"], worker["pid"]) for worker in list(_workers)]
+
+def core_groups(workers, threads=0):
+    """把本进程可用的CPU核心分成workers组，每组threads个（0表示平均分配），核心不够时循环复用"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    threads = threads or max(1, len(cores) // workers)
+    return [sorted({cores[(index * threads + offset) % len(cores)] for offset in range(threads)}) for index in range(workers)]
+
+# ---------- 共享内存图像传输 ----------
+
+def write_images(segment, images):
+    """把PIL图像按RGB uint8依次写入共享内存，返回每张图像的 (偏移, 高, 宽)"""
+    # numpy在用到时才导入：工作进程导入本模块时线程数和核心绑定还未生效
+    import numpy as np
+    metas, offset = [], 0
+    for image in images:
+        array = np.asarray(image.convert("RGB"), dtype=np.uint8)
+        if offset + array.nbytes > segment.size:
+            raise ValueError(f"图像 {image.width}x{image.height} 超出共享内存容量，请调大 INFERENCE_POOL_CONFIG['max_image_pixels']")
+        np.ndarray(array.shape, dtype=np.uint8, buffer=segment.buf, offset=offset)[...] = array
+        metas.append((offset, array.shape[0], array.shape[1]))
+        offset += array.nbytes
+    return metas
+
+def read_images(segment, metas):
+    """从共享内存复制出PIL图像，复制后共享内存可立即被下一次请求复用"""
+    import numpy as np
+    from PIL import Image
+    images = []
+    for offset, height, width in metas:
+        view = np.ndarray((height, width, 3), dtype=np.uint8, buffer=segment.buf, offset=offset)
+        images.append(Image.fromarray(view.copy()))
+        del view
+    return images
+
+def _pack(values, segment):
+    """把值列表中的PIL图像写入共享内存，返回可通过管道发送的 [("image", 位置) | ("value", 值)]"""
+    from PIL import Image
+    metas = iter(write_images(segment, [value for value in values if isinstance(value, Image.Image)]))
+    return [("image", next(metas)) if isinstance(value, Image.Image) else ("value", value) for value in values]
+
+def _unpack(packed, segment):
+    """_pack 的逆过程"""
+    images = iter(read_images(segment, [meta for tag, meta in packed if tag == "image"]))
+    return [next(images) if tag == "image" else value for tag, value in packed]
+
+def _attach(name):
+    """工作进程中打开调度器创建的共享内存，由调度器负责释放"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python 3.13之前没有track参数；spawn启动的工作进程与调度器共用资源跟踪器，调度器unlink时一并撤销登记
+        return shared_memory.SharedMemory(name=name)
+
+# ---------- 工作进程 ----------
+
+@contextmanager
+def _worker_environment(threads):
+    """启动工作进程期间设置子进程继承的环境变量
+
+    spawn的子进程在调用 _worker_main 之前就会重新导入主模块（app.py → image_generation → numpy），
+    线程数环境变量只有在子进程启动时就存在，才能在numpy/torch第一次导入时生效。
+    """
+    variables = {"OMP_NUM_THREADS": str(threads), "MKL_NUM_THREADS": str(threads), "OPENBLAS_NUM_THREADS": str(threads),
+                 # 工作进程内直接使用本地管道，不再嵌套进程池
+                 "SD_INFERENCE_WORKERS": "0"}
+    with _spawn_lock:
+        previous = {name: os.environ.get(name) for name in variables}
+        os.environ.update(variables)
+        try:
+            yield
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+def _pin_threads(pid, cores):
+    """把进程的所有线程绑定到指定核心（sched_setaffinity只作用于一个线程，之后创建的线程继承调用线程的绑定）"""
+    try:
+        threads = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        threads = [pid]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, cores)
+        except OSError:
+            pass
+
+def _worker_main(index, cores, threads, conn, input_name, output_name, cancel_event):
+    """工作进程入口：绑定核心、设置线程数，然后逐个处理调度器发来的加载/生成请求"""
+    INFERENCE_POOL_CONFIG["workers"] = 0
+    # 生成的逐步回调检查 cancel_requested()，调度器设置该事件即可中止进行中的生成
+    use_cancel_event(cancel_event)
+    # 调度器在启动后已绑定过核心；主模块导入期间若已创建线程，这里再把它们全部绑定一次
+    if cores and hasattr(os, "sched_setaffinity"):
+        _pin_threads(os.getpid(), cores)
+
+    import torch
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    from session import create_session
+    from models import load_models
+    from image_generation import generate_image, generate_img2img, generate_controlnet_image
+    generators = {"txt2img": generate_image, "img2img": generate_img2img, "controlnet": generate_controlnet_image}
+
+    input_segment, output_segment = _attach(input_name), _attach(output_name)
+    session = create_session("local")
+    loaded_settings = None
+    conn.send(("ready", os.getpid()))
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message[0] == "stop":
+                break
+
+            command, settings = message[0], message[1]
+            status = None
+            if command == "load" or settings != loaded_settings or not session["loaded"]:
+                # 同一进程内的管道池会复用已加载的模型
+                selected_model, controlnet_type, local_backend = settings
+                status = load_models("local", selected_model, controlnet_type, local_backend=local_backend, session=session)
+                loaded_settings = None if status.startswith("❌") else settings
+            if command == "load":
+                conn.send(status)
+                continue
+
+            kind, names, packed = message[2], message[3], message[4]
+            if loaded_settings is None:
+                result = (None,) * (_RESULT_SIZES[kind] - 1) + (status,)
+            else:
+                try:
+                    arguments = dict(zip(names, _unpack(packed, input_segment)))
+                    result = generators[kind](**arguments, session=session)
+                except Exception as e:
+                    result = (None,) * (_RESULT_SIZES[kind] - 1) + (f"❌ 推理进程执行失败: {e}",)
+            try:
+                conn.send(_pack(list(result), output_segment))
+            except ValueError as e:
+                conn.send(_pack([None] * (_RESULT_SIZES[kind] - 1) + [f"❌ {e}"], output_segment))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        input_segment.close()
+        output_segment.close()
+
+def _start_process(worker):
+    """为工作进程条目启动（或重启）进程，之后需要 _wait_ready 等待其就绪"""
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(
+        target=_worker_main,
+        args=(worker["index"], worker["cores"], worker["threads"], child_conn, worker["input"].name, worker["output"].name,
+              worker["cancel"]),
+        name=f"sd-inference-{worker['index']}", daemon=True
+    )
+    with _worker_environment(worker["threads"]):
+        process.start()
+    if worker["cores"] and hasattr(os, "sched_setaffinity"):
+        # 子进程刚启动时只有主线程，之后numpy/torch创建的线程池都继承这里的绑定
+        _pin_threads(process.pid, worker["cores"])
+    child_conn.close()
+    worker.update(process=process, conn=parent_conn)
+
+def _wait_ready(worker):
+    _, worker["pid"] = worker["conn"].recv()
+
+def _restart(worker):
+    """工作进程意外退出后重启，模型在下一次请求时重新加载"""
+    if worker["stopped"]:
+        return
+    print(f"⚠️ 推理进程 #{worker['index']} (pid {worker['pid']}) 意外退出，正在重启")
+    worker["conn"].close()
+    worker["process"].join(5)
+    _start_process(worker)
+    _wait_ready(worker)
+
+def _request(worker, message, should_cancel=None):
+    """向工作进程发送请求并等待回复；工作进程意外退出时重启它并返回None
+
+    等待期间关闭流程要求中止、或 should_cancel() 返回True（流式生成的调用方已停止）时，通知工作进程在下一步中止。
+    """
+    try:
+        worker["cancel"].clear()
+        worker["conn"].send(message)
+        while not worker["conn"].poll(0.1):
+            if not worker["cancel"].is_set() and (cancel_requested() or (should_cancel is not None and should_cancel())):
+                worker["cancel"].set()
+        return worker["conn"].recv()
+    except (EOFError, OSError):
+        _restart(worker)
+        return None
+
+def start_pool(workers=None, threads=None):
+    """启动推理进程池（已启动时直接返回），返回工作进程数"""
+    with _pool_lock:
+        if _workers:
+            return len(_workers)
+        workers = workers or INFERENCE_POOL_CONFIG["workers"]
+        threads = threads or INFERENCE_POOL_CONFIG["threads_per_worker"]
+        groups = core_groups(workers, threads)
+        context = multiprocessing.get_context("spawn")
+        # 每个进程一块输入（图生图输入或控制图）和一块输出（生成结果和预处理后的控制图）共享内存
+        image_bytes = INFERENCE_POOL_CONFIG["max_image_pixels"] * 3
+        started = []
+        for index, cores in enumerate(groups):
+            worker = {
+                "index": index, "pid": None, "stopped": False,
+                "cores": cores if INFERENCE_POOL_CONFIG["pin_cores"] else None, "threads": threads or len(cores),
+                "input": shared_memory.SharedMemory(create=True, size=image_bytes),
+                "output": shared_memory.SharedMemory(create=True, size=image_bytes * 2),
+                "cancel": context.Event(),
+            }
+            _start_process(worker)
+            started.append(worker)
+        # 各进程并行导入torch，全部就绪后才开始接收请求
+        for worker in started:
+            _wait_ready(worker)
+            _workers.append(worker)
+            _idle.put(worker)
+        print(f"🧵 推理进程池已启动: {len(_workers)} 个进程 × {_workers[0]['threads']} 线程")
+        return len(_workers)
+
+def stop_pool(timeout=10.0):
+    """停止所有工作进程并释放共享内存"""
+    with _pool_lock:
+        workers = list(_workers)
+        _workers.clear()
+    while True:
+        try:
+            _idle.get_nowait()
+        except queue.Empty:
+            break
+
+    for worker in workers:
+        worker["stopped"] = True
+        try:
+            worker["conn"].send(("stop",))
+        except OSError:
+            pass
+    for worker in workers:
+        worker["process"].join(timeout)
+        if worker["process"].is_alive():
+            worker["process"].terminate()
+            worker["process"].join(5)
+        worker["conn"].close()
+        for segment in (worker["input"], worker["output"]):
+            try:
+                segment.close()
+                segment.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+
+def load_pool_models(selected_model, controlnet_type, local_backend):
+    """让所有工作进程并行加载模型，等待进行中的生成结束后开始，返回各进程的加载状态"""
+    start_pool()
+    with _load_lock:
+        return _load_all(selected_model, controlnet_type, local_backend)
+
+def _load_all(selected_model, controlnet_type, local_backend):
+    workers = [_idle.get() for _ in range(len(_workers))]
+    try:
+        settings = (selected_model, controlnet_type, local_backend)
+        sent = []
+        for worker in workers:
+            try:
+                worker["conn"].send(("load", settings))
+                sent.append(worker)
+            except OSError:
+                _restart(worker)
+        statuses = []
+        for worker in workers:
+            try:
+                statuses.append(worker["conn"].recv() if worker in sent else None)
+            except (EOFError, OSError):
+                _restart(worker)
+                statuses.append(None)
+        return [status or f"❌ 推理进程 #{worker['index']} 加载时意外退出" for worker, status in zip(workers, statuses)]
+    finally:
+        for worker in workers:
+            _idle.put(worker)
+
+def run_in_pool(kind, arguments, session, should_cancel=None):
+    """把一次生成分派给空闲的工作进程，返回与对应生成函数结构相同的结果元组（图像为PIL）
+
+    arguments为生成函数的关键字参数，其中的PIL图像经共享内存传递；工作进程按会话的模型设置按需加载模型。
+    should_cancel() 返回True时（以及关闭流程要求中止时）工作进程在下一步中止生成。
+    """
+    start_pool()
+    with stage("pool_wait"):
+        worker = _idle.get()
+    try:
+        with span("inference_pool.generate", worker=worker["index"], pid=worker["pid"]):
+            names = list(arguments)
+            try:
+                packed = _pack([arguments[name] for name in names], worker["input"])
+            except ValueError as e:
+                return (None,) * (_RESULT_SIZES[kind] - 1) + (f"❌ {e}",)
+            settings = (session["model"], session["controlnet"], session["local_backend"])
+            reply = _request(worker, ("generate", settings, kind, names, packed), should_cancel)
+            if reply is None:
+                return (None,) * (_RESULT_SIZES[kind] - 1) + ("❌ 推理进程意外退出，已重启，请重试",)
+            return tuple(_unpack(reply, worker["output"]))
+    finally:
+        if not worker["stopped"]:
+            _idle.put(worker)
+
+def describe_pool():
+    """进程池状态说明，附加到加载状态中"""
+    if not _workers:
+        return "🧵 推理进程池未启动"
+    lines = [f"🧵 推理进程池: {len(_workers)} 个进程"]
+    for worker in _workers:
+        cores = worker["cores"]
+        binding = f"核心 {cores[0]}-{cores[-1]}" if cores and cores == list(range(cores[0], cores[-1] + 1)) else \
+                  f"核心 {','.join(map(str, cores))}" if cores else "未绑定核心"
+        lines.append(f"  #{worker['index']} pid {worker['pid']} · {worker['threads']} 线程 · {binding}")
+    return "\n".join(lines)
@@ -0,0 +1,618 @@
+"""
+持久化任务队列 - 生成请求写入SQLite成为带ID的任务，由独立的工作进程执行
+
+界面、批量工具和命令行只负责提交任务和查询状态，刷新页面或断开连接不会丢失任务；
+工作进程各自加载模型、逐个领取任务执行，吞吐量随工作进程数增加。任务状态：
+
+    queued → running → succeeded / failed        （排队中的任务可以 cancelled）
+
+执行中的任务定期写心跳，工作进程崩溃后其任务在 stale_after 秒后重新排队，超过 max_attempts 次标记为失败。
+结果图像保存在任务数据库旁的 results 目录（不受 image_store 按数量清理的影响），任务记录其文件路径；
+任务结束超过 result_retention 秒后结果图像由工作进程删除，任务记录保留。配置见 config.JOB_QUEUE_CONFIG。
+
+    python job_queue.py worker -n 2                   # 启动2个工作进程
+    python job_queue.py submit --prompt "a cat" --model runwayml/stable-diffusion-v1-5 --wait
+    python job_queue.py list
+    python job_queue.py status <任务ID>
+    python job_queue.py cancel <任务ID>
+
+任务中保存了会话的API Token，任务结束后立即清除。
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import multiprocessing
+from contextlib import closing
+from config import JOB_QUEUE_CONFIG
+
+JOB_KINDS = ("txt2img", "img2img", "controlnet")
+TERMINAL_STATES = ("succeeded", "failed", "cancelled")
+STATE_LABELS = {
+    "queued": "⏳ 排队中",
+    "running": "🏃 执行中",
+    "succeeded": "✅ 已完成",
+    "failed": "❌ 失败",
+    "cancelled": "🚫 已取消",
+}
+# 保存到任务中的会话字段（不含进程内状态 loaded）
+SESSION_FIELDS = ("run_mode", "model", "controlnet", "api_token", "proxy", "local_backend")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    params TEXT NOT NULL,
+    session TEXT NOT NULL,
+    input_path TEXT,
+    batch TEXT,
+    client_id TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state_created ON jobs (state, created_at);
+CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch, client_id);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    pid INTEGER,
+    started_at REAL,
+    heartbeat_at REAL,
+    job_id TEXT
+);
+"""
+
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+def _inputs_dir():
+    return os.path.join(os.path.dirname(JOB_QUEUE_CONFIG["path"]), "inputs")
+
+def _results_dir():
+    return os.path.join(os.path.dirname(JOB_QUEUE_CONFIG["path"]), "results")
+
+def _keep_result(job, path):
+    """把输出存储中的结果复制到任务结果目录
+
+    输出存储超过 max_files 后会删除最旧的文件，任务结果需要在客户端取走之前一直可用。
+    文件名带尝试次数，重新排队后的两次执行不会互相覆盖。
+    """
+    import shutil
+    os.makedirs(_results_dir(), exist_ok=True)
+    result_path = os.path.join(_results_dir(), f"{job['id']}-{job['attempts']}{os.path.splitext(path)[1]}")
+    shutil.copyfile(path, result_path + ".tmp")
+    os.replace(result_path + ".tmp", result_path)
+    return result_path
+
+def _connect():
+    """打开任务数据库连接（自动提交模式，需要原子性的操作显式 BEGIN IMMEDIATE）"""
+    path = JOB_QUEUE_CONFIG["path"]
+    with _schema_lock:
+        if path not in _schema_ready:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with closing(sqlite3.connect(path, timeout=30, isolation_level=None)) as conn:
+                # WAL模式下查询状态不会被工作进程的写入阻塞
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+            _schema_ready.add(path)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _decode(row, with_token=False):
+    """数据库行转为任务字典；默认去掉会话中的Token"""
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["session"] = json.loads(job["session"])
+    if not with_token:
+        job["session"].pop("api_token", None)
+    return job
+
+# ---------- 提交与查询 ----------
+
+def submit_job(kind, params, session, input_image=None, batch=None, client_id=None):
+    """提交生成任务，返回任务ID
+
+    params为生成函数的关键字参数（prompt、num_steps等），input_image为图生图输入或ControlNet控制图像（PIL）。
+    同一 batch 中 client_id 相同、且未失败/取消的任务已存在时直接返回已有任务ID，批量工具中断后重新提交不会重复执行。
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError(f"不支持的任务类型: {kind}")
+    if kind != "txt2img" and input_image is None:
+        raise ValueError("图生图和ControlNet任务需要输入图像")
+
+    with closing(_connect()) as conn:
+        if batch is not None and client_id is not None:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE batch = ? AND client_id = ? AND state NOT IN ('failed', 'cancelled') "
+                "ORDER BY created_at DESC LIMIT 1", (batch, client_id)
+            ).fetchone()
+            if row is not None:
+                return row["id"]
+
+        job_id = uuid.uuid4().hex
+        input_path = None
+        if input_image is not None:
+            # 输入图像保存为文件，工作进程在另一个进程中读取
+            os.makedirs(_inputs_dir(), exist_ok=True)
+            input_path = os.path.join(_inputs_dir(), f"{job_id}.png")
+            input_image.convert("RGB").save(input_path, format="PNG", compress_level=1)
+
+        session_fields = {field: session.get(field) for field in SESSION_FIELDS}
+        conn.execute(
+            "INSERT INTO jobs (id, kind, state, params, session, input_path, batch, client_id, created_at) "
+            "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(params, ensure_ascii=False), json.dumps(session_fields, ensure_ascii=False),
+             input_path, batch, client_id, time.time())
+        )
+    return job_id
+
+def get_job(job_id):
+    """查询任务，不存在时返回None"""
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", ((job_id or "").strip(),)).fetchone()
+    return _decode(row) if row is not None else None
+
+def list_jobs(limit=20, state=None, batch=None):
+    """按提交时间倒序列出任务"""
+    conditions, values = [], []
+    if state is not None:
+        conditions.append("state = ?")
+        values.append(state)
+    if batch is not None:
+        conditions.append("batch = ?")
+        values.append(batch)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with closing(_connect()) as conn:
+        rows = conn.execute(f"SELECT * FROM jobs {where} ORDER BY created_at DESC LIMIT ?", (*values, limit)).fetchall()
+    return [_decode(row) for row in rows]
+
+def cancel_job(job_id):
+    """取消排队中的任务，返回是否取消成功（执行中的任务不能取消）"""
+    job_id = (job_id or "").strip()
+    with closing(_connect()) as conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET state = 'cancelled', finished_at = ?, message = '🚫 任务已取消' WHERE id = ? AND state = 'queued'",
+            (time.time(), job_id)
+        )
+    if cursor.rowcount == 0:
+        return False
+    _release_job(job_id)
+    return True
+
+def queue_counts():
+    """各状态的任务数"""
+    with closing(_connect()) as conn:
+        rows = conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+    return {row["state"]: row["n"] for row in rows}
+
+def active_workers():
+    """最近仍有心跳的工作进程"""
+    cutoff = time.time() - JOB_QUEUE_CONFIG["stale_after"]
+    with closing(_connect()) as conn:
+        rows = conn.execute("SELECT * FROM workers WHERE heartbeat_at >= ? ORDER BY name", (cutoff,)).fetchall()
+    return [dict(row) for row in rows]
+
+def watch_job(job_id, poll_interval=None, timeout=None):
+    """订阅任务状态：状态、执行者或消息变化时产出任务字典，到达终态（或超时）后结束"""
+    poll_interval = poll_interval or JOB_QUEUE_CONFIG["poll_interval"]
+    deadline = None if timeout is None else time.monotonic() + timeout
+    last = None
+    while True:
+        job = get_job(job_id)
+        if job is None:
+            return
+        snapshot = (job["state"], job["worker"], job["message"])
+        if snapshot != last:
+            last = snapshot
+            yield job
+        if job["state"] in TERMINAL_STATES or (deadline is not None and time.monotonic() >= deadline):
+            return
+        time.sleep(poll_interval)
+
+def wait_for_job(job_id, poll_interval=None, timeout=None):
+    """阻塞等待任务结束，返回最后一次查询到的任务字典"""
+    job = None
+    for job in watch_job(job_id, poll_interval, timeout):
+        pass
+    return job
+
+def format_job(job):
+    """任务状态的文本描述"""
+    if job is None:
+        return "❓ 找不到该任务"
+    lines = [f"🆔 {job['id']}  {STATE_LABELS.get(job['state'], job['state'])}",
+             f"📝 {job['kind']} · {job['session'].get('model')} · {job['params'].get('prompt', '')[:60]}"]
+    if job["state"] == "queued":
+        with closing(_connect()) as conn:
+            ahead = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND created_at < ?",
+                                 (job["created_at"],)).fetchone()[0]
+        workers = len(active_workers())
+        lines.append(f"⏳ 前面还有 {ahead} 个任务，活跃工作进程 {workers} 个" +
+                     ("（没有活跃的工作进程，请运行 python job_queue.py worker）" if workers == 0 else ""))
+    elif job["state"] == "running":
+        lines.append(f"🧵 {job['worker']} 已执行 {time.time() - job['started_at']:.0f}s（第 {job['attempts']} 次尝试）")
+    elif job["finished_at"] and job["started_at"]:
+        lines.append(f"⏱️ 执行耗时 {job['finished_at'] - job['started_at']:.1f}s")
+    if job["message"]:
+        lines.append(job["message"])
+    return "\n".join(lines)
+
+def format_job_list(jobs):
+    """任务列表的文本描述"""
+    if not jobs:
+        return "暂无任务"
+    counts = queue_counts()
+    header = " · ".join(f"{STATE_LABELS[state]} {counts[state]}" for state in STATE_LABELS if counts.get(state))
+    lines = [header, f"🧵 活跃工作进程: {len(active_workers())}", ""]
+    for job in jobs:
+        created = time.strftime("%m-%d %H:%M:%S", time.localtime(job["created_at"]))
+        lines.append(f"{created}  {STATE_LABELS.get(job['state'], job['state'])}  {job['id']}  "
+                     f"{job['kind']}  {job['params'].get('prompt', '')[:40]}")
+    return "\n".join(lines)
+
+# ---------- 工作进程 ----------
+
+def claim_job(worker):
+    """原子地领取最早排队的任务并标记为执行中，没有任务时返回None（返回的会话包含Token）"""
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is not None:
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', worker = ?, started_at = ?, heartbeat_at = ?, "
+                    "attempts = attempts + 1, message = NULL WHERE id = ?",
+                    (worker, now, now, row["id"])
+                )
+                row = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return _decode(row, with_token=True) if row is not None else None
+
+def _release_job(job_id):
+    """任务结束后清除会话中的Token并删除输入图像文件"""
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT session, input_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        session = json.loads(row["session"])
+        session.pop("api_token", None)
+        conn.execute("UPDATE jobs SET session = ? WHERE id = ?", (json.dumps(session, ensure_ascii=False), job_id))
+    if row["input_path"]:
+        try:
+            os.remove(row["input_path"])
+        except OSError:
+            pass
+
+def finish_job(job_id, worker, state, result=None, message=""):
+    """记录任务结果，返回是否记录成功
+
+    只有任务仍由 worker 执行时才写入：心跳超时后任务可能已重新排队并由其他工作进程领取，
+    此时迟到的结果被丢弃，也不删除新一次执行需要的输入图像。
+    """
+    with closing(_connect()) as conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET state = ?, result = ?, message = ?, finished_at = ? "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (state, result, message, time.time(), job_id, worker)
+        )
+    if cursor.rowcount != 1:
+        return False
+    _release_job(job_id)
+    return True
+
+def requeue_stale_jobs():
+    """心跳超时的执行中任务重新排队，超过最大尝试次数的标记为失败，返回处理的任务数"""
+    cutoff = time.time() - JOB_QUEUE_CONFIG["stale_after"]
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT id, attempts, worker FROM jobs WHERE state = 'running' AND heartbeat_at < ?",
+                                (cutoff,)).fetchall()
+            failed = []
+            for row in rows:
+                if row["attempts"] >= JOB_QUEUE_CONFIG["max_attempts"]:
+                    failed.append(row["id"])
+                    conn.execute("UPDATE jobs SET state = 'failed', finished_at = ?, message = ? WHERE id = ?",
+                                 (time.time(), f"❌ 工作进程 {row['worker']} 在执行中退出，已重试 {row['attempts']} 次", row["id"]))
+                else:
+                    conn.execute("UPDATE jobs SET state = 'queued', worker = NULL, message = ? WHERE id = ?",
+                                 (f"🔁 工作进程 {row['worker']} 在执行中退出，重新排队", row["id"]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    for job_id in failed:
+        _release_job(job_id)
+    return len(rows)
+
+def prune_results():
+    """删除结束超过 result_retention 秒的任务的结果图像，返回删除的文件数
+
+    任务记录保留，只清空结果路径；results 目录中没有任务引用的残留文件（例如执行中崩溃留下的）按修改时间一并清理。
+    """
+    retention = JOB_QUEUE_CONFIG["result_retention"]
+    if retention <= 0:
+        return 0
+    cutoff = time.time() - retention
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = [row["result"] for row in conn.execute(
+                "SELECT result FROM jobs WHERE result IS NOT NULL AND finished_at < ?", (cutoff,))]
+            conn.execute("UPDATE jobs SET result = NULL, message = COALESCE(message || char(10), '') || ? "
+                         "WHERE result IS NOT NULL AND finished_at < ?", ("🗑️ 结果图像已超过保留期限，已删除", cutoff))
+            referenced = {row["result"] for row in conn.execute("SELECT result FROM jobs WHERE result IS NOT NULL")}
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    
+    try:
+        names = os.listdir(_results_dir())
+    except OSError:
+        names = []
+    for name in names:
+        path = os.path.join(_results_dir(), name)
+        try:
+            if path not in referenced and os.path.getmtime(path) < cutoff:
+                expired.append(path)
+        except OSError:
+            pass
+    removed = 0
+    for path in set(expired):
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+def _beat(worker, job_id=None):
+    """写入工作进程（以及执行中任务）的心跳"""
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.execute("UPDATE workers SET heartbeat_at = ?, job_id = ? WHERE name = ?", (now, job_id, worker))
+        if job_id is not None:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ?", (now, job_id, worker))
+
+def _open_input(job):
+    if not job["input_path"]:
+        return None
+    from PIL import Image
+    with Image.open(job["input_path"]) as image:
+        return image.convert("RGB")
+
+def execute_job(job, sessions):
+    """执行任务，返回 (结果文件路径, 状态文本)
+
+    sessions 缓存本工作进程已加载的会话，连续执行同一模型的任务时不重复调用 load_models。
+    """
+    from models import load_models
+    from session import create_session
+    from image_generation import generate_image, generate_img2img, generate_controlnet_image
+
+    settings = job["session"]
+    key = tuple(json.dumps(settings.get(field), sort_keys=True) for field in SESSION_FIELDS)
+    session = sessions.get(key)
+    if session is None:
+        session = create_session(settings["run_mode"], settings["model"], settings["controlnet"],
+                                 settings.get("api_token") or "", settings.get("proxy"), settings["local_backend"])
+        status = load_models(session["run_mode"], session["model"], session["controlnet"], session["api_token"],
+                             session["local_backend"], session=session)
+        if status.startswith("❌"):
+            return None, status
+        sessions[key] = session
+
+    params = job["params"]
+    if job["kind"] == "txt2img":
+        return generate_image(params["prompt"], params.get("negative_prompt", ""), params["num_steps"],
+                              params["guidance_scale"], params["width"], params["height"], params["seed"],
+                              output="file", session=session)
+    if job["kind"] == "img2img":
+        return generate_img2img(params["prompt"], params.get("negative_prompt", ""), _open_input(job), params["strength"],
+                                params["num_steps"], params["guidance_scale"], params["width"], params["height"],
+                                params["seed"], output="file", session=session)
+    path, _, status = generate_controlnet_image(
+        params["prompt"], params.get("negative_prompt", ""), _open_input(job), params["control_type"], params["num_steps"],
+        params["guidance_scale"], params["controlnet_conditioning_scale"], params["width"], params["height"], params["seed"],
+        output="file", session=session
+    )
+    return path, status
+
+def worker_loop(name, stop_event=None):
+    """工作进程主循环：领取任务 → 执行（期间定期写心跳）→ 记录结果，直到 stop_event 被设置"""
+    stop_event = stop_event or threading.Event()
+    with closing(_connect()) as conn:
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO workers (name, pid, started_at, heartbeat_at, job_id) VALUES (?, ?, ?, ?, NULL)",
+                     (name, os.getpid(), now, now))
+    print(f"🧵 工作进程 {name} 已启动 (pid {os.getpid()})")
+
+    sessions = {}
+    last_stale_check = last_prune = 0.0
+    while not stop_event.is_set():
+        if time.monotonic() - last_stale_check >= JOB_QUEUE_CONFIG["heartbeat_interval"]:
+            last_stale_check = time.monotonic()
+            if requeue_stale_jobs():
+                print(f"🔁 {name}: 已重新排队心跳超时的任务")
+        if time.monotonic() - last_prune >= JOB_QUEUE_CONFIG["result_prune_interval"]:
+            last_prune = time.monotonic()
+            removed = prune_results()
+            if removed:
+                print(f"🗑️ {name}: 已删除 {removed} 个过期的结果图像")
+
+        job = claim_job(name)
+        if job is None:
+            _beat(name)
+            stop_event.wait(JOB_QUEUE_CONFIG["poll_interval"])
+            continue
+
+        # 执行期间由后台线程写心跳，长时间的本地生成不会被误判为崩溃
+        done = threading.Event()
+        def heartbeat(job_id=job["id"]):
+            while not done.wait(JOB_QUEUE_CONFIG["heartbeat_interval"]):
+                try:
+                    _beat(name, job_id)
+                except sqlite3.Error:
+                    pass
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        _beat(name, job["id"])
+
+        start = time.time()
+        try:
+            path, status = execute_job(job, sessions)
+            if path:
+                path = _keep_result(job, path)
+        except Exception as e:
+            path, status = None, f"❌ 任务执行异常: {e}"
+        finally:
+            done.set()
+            heartbeat_thread.join()
+        if not finish_job(job["id"], name, "succeeded" if path else "failed", path, status):
+            print(f"⚠️ {name}: {job['id']} 已不归本进程执行（心跳超时后被重新排队），丢弃结果")
+            if path:
+                os.remove(path)
+            continue
+        print(f"{'✅' if path else '❌'} {name}: {job['id']} {job['kind']} ({time.time() - start:.1f}s)")
+
+    with closing(_connect()) as conn:
+        conn.execute("DELETE FROM workers WHERE name = ?", (name,))
+
+def _worker_main(name, stop_event):
+    # 每个任务工作进程在进程内推理，吞吐量通过工作进程数扩展，不再各自启动推理进程池
+    from config import INFERENCE_POOL_CONFIG
+    INFERENCE_POOL_CONFIG["workers"] = 0
+    try:
+        worker_loop(name, stop_event)
+    except KeyboardInterrupt:
+        pass
+
+_worker_stop = None
+_worker_processes = []
+
+def start_workers(count, prefix=None):
+    """启动 count 个工作进程（spawn方式，各自导入模型库），返回进程列表"""
+    global _worker_stop
+    context = multiprocessing.get_context("spawn")
+    if _worker_stop is None:
+        _worker_stop = context.Event()
+    prefix = prefix or f"worker-{os.getpid()}"
+    processes = []
+    for index in range(count):
+        process = context.Process(target=_worker_main, args=(f"{prefix}-{index}", _worker_stop),
+                                  name=f"sd-job-{prefix}-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    _worker_processes.extend(processes)
+    return processes
+
+def stop_workers(processes=None, timeout=None):
+    """通知工作进程在当前任务结束后退出，超时仍未退出的直接终止（其任务之后会重新排队）
+
+    processes 默认为本进程启动的全部工作进程。
+    """
+    if processes is None:
+        processes = list(_worker_processes)
+    if _worker_stop is not None:
+        _worker_stop.set()
+    deadline = time.monotonic() + (timeout if timeout is not None else JOB_QUEUE_CONFIG["stale_after"])
+    for process in processes:
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.terminate()
+            process.join(5)
+        if process in _worker_processes:
+            _worker_processes.remove(process)
+
+# ---------- 命令行 ----------
+
+def main(argv=None):
+    import argparse
+    from config import LOCAL_BACKENDS
+    parser = argparse.ArgumentParser(description="持久化生成任务队列")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = commands.add_parser("worker", help="启动工作进程")
+    worker_parser.add_argument("-n", "--workers", type=int, default=1, help="工作进程数")
+
+    submit_parser = commands.add_parser("submit", help="提交文生图任务")
+    submit_parser.add_argument("--prompt", required=True)
+    submit_parser.add_argument("--negative-prompt", default="")
+    submit_parser.add_argument("--run-mode", choices=["api", "local"], default="api")
+    submit_parser.add_argument("--model", default="runwayml/stable-diffusion-v1-5")
+    submit_parser.add_argument("--token", default=os.environ.get("HF_API_TOKEN", ""), help="Hugging Face API Token")
+    submit_parser.add_argument("--backend", choices=list(LOCAL_BACKENDS.keys()), default="pytorch", help="本地推理后端")
+    submit_parser.add_argument("--steps", type=int, default=20)
+    submit_parser.add_argument("--guidance-scale", type=float, default=7.5)
+    submit_parser.add_argument("--width", type=int, default=512)
+    submit_parser.add_argument("--height", type=int, default=512)
+    submit_parser.add_argument("--seed", type=int, default=-1)
+    submit_parser.add_argument("--wait", action="store_true", help="等待任务结束并显示结果")
+
+    list_parser = commands.add_parser("list", help="列出最近的任务")
+    list_parser.add_argument("--limit", type=int, default=20)
+    list_parser.add_argument("--state", choices=list(STATE_LABELS))
+
+    for command, help_text in (("status", "查询任务状态"), ("cancel", "取消排队中的任务")):
+        commands.add_parser(command, help=help_text).add_argument("job_id")
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        processes = start_workers(args.workers)
+        print(f"💡 任务数据库: {JOB_QUEUE_CONFIG['path']}，Ctrl+C 在当前任务结束后退出")
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            print("\n🛑 等待进行中的任务结束...")
+            stop_workers(processes)
+        return 0
+
+    if args.command == "submit":
+        from session import create_session
+        session = create_session(args.run_mode, args.model, api_token=args.token, local_backend=args.backend)
+        job_id = submit_job("txt2img", {"prompt": args.prompt, "negative_prompt": args.negative_prompt, "num_steps": args.steps,
+                                        "guidance_scale": args.guidance_scale, "width": args.width, "height": args.height,
+                                        "seed": args.seed}, session)
+        print(job_id)
+        if not args.wait:
+            return 0
+        job = wait_for_job(job_id)
+        print(format_job(job))
+        if job["result"]:
+            print(f"🖼️ {job['result']}")
+        return 0 if job["state"] == "succeeded" else 1
+
+    if args.command == "list":
+        print(format_job_list(list_jobs(args.limit, args.state)))
+        return 0
+    if args.command == "status":
+        job = get_job(args.job_id)
+        print(format_job(job))
+        if job is not None and job["result"]:
+            print(f"🖼️ {job['result']}")
+        return 0 if job is not None else 1
+
+    if cancel_job(args.job_id):
+        print("🚫 任务已取消")
+        return 0
+    print("⚠️ 只能取消排队中的任务")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
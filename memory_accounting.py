@@ -0,0 +1,268 @@
+"""
+内存统计模块 - 统计已加载管道各组件的参数/缓冲区内存（按dtype）、各缓存目录大小、
+进程内存和每次请求的峰值内存，在界面和指标端点中展示
+
+只在本地模式已导入torch时读取CUDA统计，API模式不会因此加载torch。
+"""
+
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from config import LOCAL_CACHE_DIR, OUTPUT_CONFIG, TRACING_CONFIG, PROFILING_CONFIG
+from memory_policy import format_bytes, reset_peak_rss
+from metrics import observe, replace_gauges, register_collector, current_labels
+from tracing import set_attributes
+
+# 目录大小统计较慢（模型缓存可能有上千个文件），在该时间内复用上次结果
+CACHE_SIZE_TTL = 60
+
+_cache_sizes = {"time": 0.0, "sizes": {}}
+_cache_sizes_lock = threading.Lock()
+
+def _read_proc_status(pid="self"):
+    """读取 /proc/<pid>/status 中的内存字段（字节）"""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, amount = line.split()[:2]
+                    values[name.rstrip(":")] = int(amount) * 1024
+    except OSError:
+        pass
+    return values
+
+def process_memory():
+    """进程内存：{"rss", "peak_rss"}，以及已使用CUDA时的 {"cuda_allocated", "cuda_reserved"}"""
+    status = _read_proc_status()
+    memory = {"rss": status.get("VmRSS"), "peak_rss": status.get("VmHWM")}
+    if memory["rss"] is None:
+        try:
+            import psutil
+            memory["rss"] = psutil.Process().memory_info().rss
+        except ImportError:
+            pass
+    if memory["peak_rss"] is None:
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # macOS 返回字节，Linux 返回KB
+            memory["peak_rss"] = peak if sys.platform == "darwin" else peak * 1024
+        except ImportError:
+            pass
+
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        memory["cuda_allocated"] = torch.cuda.memory_allocated()
+        memory["cuda_reserved"] = torch.cuda.memory_reserved()
+    return memory
+
+# 进行中的 track_request_peak 数和累计进入次数，用于判断请求期间是否有其他生成并发
+_peak_state = {"active": 0, "entries": 0}
+_peak_lock = threading.Lock()
+
+@contextmanager
+def track_request_peak(enabled=True):
+    """记录代码块执行期间的峰值RSS
+
+    VmHWM是整个进程的峰值：enabled为False（API模式、推理进程池，生成不在本进程内存中进行）时不记录；
+    开始时已有其他生成在进行则不重置（会破坏对方的峰值），执行期间有其他生成开始则不记录（对方的内存计入了峰值）。
+    """
+    with _peak_lock:
+        exclusive = enabled and _peak_state["active"] == 0
+        _peak_state["active"] += 1
+        _peak_state["entries"] += 1
+        entries = _peak_state["entries"]
+    # 无法重置时峰值为进程生命周期内的最大值，不代表本次请求
+    tracked = exclusive and reset_peak_rss()
+    try:
+        yield
+    finally:
+        with _peak_lock:
+            _peak_state["active"] -= 1
+            overlapped = _peak_state["entries"] != entries
+        if tracked and not overlapped:
+            peak = _read_proc_status().get("VmHWM")
+            if peak is not None:
+                observe("sd_request_peak_memory_bytes", peak, device="cpu", **current_labels())
+                set_attributes(peak_rss_bytes=peak)
+
+def module_memory(module, seen=None):
+    """统计一个组件的参数和缓冲区内存，返回 {"parameter": {dtype: 字节}, "buffer": {dtype: 字节}, "device"}；
+    seen用于跨组件去重共享的张量"""
+    seen = set() if seen is None else seen
+    usage = {"parameter": {}, "buffer": {}, "device": None}
+
+    if hasattr(module, "parameters") and hasattr(module, "buffers"):
+        for kind, tensors in (("parameter", module.parameters()), ("buffer", module.buffers())):
+            for tensor in tensors:
+                key = (tensor.data_ptr(), tensor.numel(), tensor.dtype)
+                if tensor.data_ptr() and key in seen:
+                    continue
+                seen.add(key)
+                dtype = str(tensor.dtype).replace("torch.", "")
+                usage[kind][dtype] = usage[kind].get(dtype, 0) + tensor.numel() * tensor.element_size()
+                usage["device"] = usage["device"] or str(tensor.device)
+        return usage
+
+    # ONNX Runtime组件：推理会话加载整个模型文件，按磁盘上的模型文件大小统计
+    model_dir = getattr(module, "model_save_dir", None)
+    if model_dir and os.path.isdir(str(model_dir)):
+        usage["parameter"]["onnx"] = _directory_size(str(model_dir))
+        usage["device"] = "cpu"
+    return usage
+
+def _total(usage):
+    return sum(usage["parameter"].values()) + sum(usage["buffer"].values())
+
+def entry_memory(entry, seen=None):
+    """统计管道池条目中所有管道的组件内存，共享组件（UNet/VAE/文本编码器）只计一次。
+    返回 [{"component", "device", "parameter", "buffer", "total"}, ...]"""
+    seen = set() if seen is None else seen
+    pipelines = [("txt2img", entry.get("pipe")), ("img2img", entry.get("img2img_pipe"))]
+    pipelines += [(f"controlnet_{control_type}", pipeline) for control_type, pipeline in entry.get("controlnet_pipes", {}).items()]
+
+    counted, names, components = set(), set(), []
+    for pipeline_name, pipeline in pipelines:
+        for name, component in (getattr(pipeline, "components", None) or {}).items():
+            if component is None or id(component) in counted:
+                continue
+            counted.add(id(component))
+            usage = module_memory(component, seen)
+            if not _total(usage):
+                continue  # 分词器、调度器等不占张量内存
+            if name == "controlnet":
+                name = pipeline_name
+            elif name in names:
+                # 与其他管道不共享的同名组件（例如ONNX后端下各ControlNet管道共用的PyTorch UNet）
+                name = f"{pipeline_name}.{name}"
+            names.add(name)
+            components.append({"component": name, **usage, "total": _total(usage)})
+    return components
+
+def pipeline_memory():
+    """统计管道池中所有已加载模型的组件内存，返回 [{"model", "backend", "components", "total"}, ...]"""
+    import models
+    with models._pool_lock:
+        entries = list(models._pipeline_pool.items())
+
+    seen = set()
+    report = []
+    for (model_id, backend), entry in entries:
+        components = entry_memory(entry, seen)
+        report.append({"model": model_id, "backend": backend, "components": components,
+                       "total": sum(component["total"] for component in components)})
+    return report
+
+def _by_dtype(components):
+    """把组件的参数和缓冲区按dtype汇总"""
+    totals = {}
+    for component in components:
+        for kind in ("parameter", "buffer"):
+            for dtype, size in component[kind].items():
+                totals[dtype] = totals.get(dtype, 0) + size
+    return totals
+
+def describe_entry_memory(entry):
+    """加载完成后附加到状态栏的内存说明"""
+    components = entry_memory(entry)
+    total = sum(component["total"] for component in components)
+    dtypes = ", ".join(f"{dtype} {format_bytes(size)}" for dtype, size in sorted(_by_dtype(components).items(), key=lambda item: -item[1]))
+    memory = process_memory()
+    return f"💾 管道内存: {format_bytes(total)}（{dtypes or '无'}）| 进程内存: {format_bytes(memory['rss'])}"
+
+def _directory_size(path):
+    """统计目录下普通文件的总大小（不跟随符号链接，HF缓存的快照链接不会重复计算）"""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+def cache_directories():
+    """各缓存目录：Hugging Face模型缓存和本项目的缓存目录"""
+    hf_home = os.environ.get("HF_HOME", os.path.join(os.path.expanduser("~"), ".cache", "huggingface"))
+    return {
+        "hf_hub": os.environ.get("HF_HUB_CACHE", os.path.join(hf_home, "hub")),
+        "onnx": os.path.join(LOCAL_CACHE_DIR, "onnx"),
+        "int8": os.path.join(LOCAL_CACHE_DIR, "int8"),
+        "compile": os.path.join(LOCAL_CACHE_DIR, "compile"),
+        "outputs": OUTPUT_CONFIG["dir"],
+        "traces": os.path.dirname(TRACING_CONFIG["path"]),
+        "profiles": PROFILING_CONFIG["dir"],
+    }
+
+def cache_sizes(max_age=CACHE_SIZE_TTL):
+    """各缓存目录的磁盘占用（字节），不存在的目录不列出"""
+    with _cache_sizes_lock:
+        if time.monotonic() - _cache_sizes["time"] > max_age:
+            _cache_sizes["sizes"] = {name: _directory_size(path) for name, path in cache_directories().items() if os.path.isdir(path)}
+            _cache_sizes["time"] = time.monotonic()
+        return dict(_cache_sizes["sizes"])
+
+def format_memory_report():
+    """界面展示的内存总览"""
+    memory = process_memory()
+    lines = [f"🖥️ 进程内存: 当前 {format_bytes(memory['rss'])} | 峰值 {format_bytes(memory['peak_rss'])}"]
+    if "cuda_allocated" in memory:
+        lines.append(f"🎮 CUDA显存: 已分配 {format_bytes(memory['cuda_allocated'])} | 已保留 {format_bytes(memory['cuda_reserved'])}")
+
+    report = pipeline_memory()
+    lines.append("")
+    if not report:
+        lines.append("📦 已加载管道: 无（API模式或尚未加载本地模型）")
+    for entry in report:
+        lines.append(f"📦 {entry['model']} ({entry['backend']}): {format_bytes(entry['total'])}")
+        for component in sorted(entry["components"], key=lambda c: -c["total"]):
+            dtypes = ", ".join(f"{dtype} {format_bytes(size)}" for dtype, size in _by_dtype([component]).items())
+            buffers = sum(component["buffer"].values())
+            buffer_note = f"，缓冲区 {format_bytes(buffers)}" if buffers else ""
+            lines.append(f"   - {component['component']:<22}{format_bytes(component['total']):>10}  [{dtypes}{buffer_note}] @ {component['device']}")
+    
+    # 推理进程池中的管道加载在工作进程里，只能按进程统计
+    inference_pool = sys.modules.get("inference_pool")
+    if inference_pool is not None and inference_pool.pool_size():
+        lines.append("")
+        for index, pid in inference_pool.worker_pids():
+            status = _read_proc_status(pid)
+            lines.append(f"🧵 推理进程 #{index} (pid {pid}): 当前 {format_bytes(status.get('VmRSS'))} | 峰值 {format_bytes(status.get('VmHWM'))}")
+
+    lines.append("")
+    lines.append("🗂️ 缓存占用:")
+    sizes = cache_sizes()
+    if not sizes:
+        lines.append("   - 暂无缓存目录")
+    for name, path in cache_directories().items():
+        if name in sizes:
+            lines.append(f"   - {name:<10}{format_bytes(sizes[name]):>10}  {path}")
+    return "\n".join(lines)
+
+def collect_metrics():
+    """导出指标前刷新内存gauge"""
+    memory = process_memory()
+    replace_gauges("sd_process_memory_bytes", [({"kind": kind}, value) for kind, value in memory.items() if value is not None])
+
+    samples = []
+    for entry in pipeline_memory():
+        for component in entry["components"]:
+            for tensor_kind in ("parameter", "buffer"):
+                for dtype, size in component[tensor_kind].items():
+                    samples.append(({"model": entry["model"], "backend": entry["backend"], "component": component["component"],
+                                     "tensor": tensor_kind, "dtype": dtype}, size))
+    replace_gauges("sd_pipeline_memory_bytes", samples)
+    replace_gauges("sd_cache_disk_bytes", [({"cache": name}, size) for name, size in cache_sizes().items()])
+
+register_collector(collect_metrics)
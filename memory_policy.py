@@ -0,0 +1,277 @@
+"""
+内存策略模块 - 根据请求分辨率和可用内存自动启用VAE分块/切片与注意力切片
+"""
+
+import os
+import sys
+import weakref
+import collections
+import threading
+from contextlib import contextmanager
+from config import get_device, MEMORY_POLICY, LOCAL_MAX_DIRECT_RESOLUTION, LOCAL_MAX_RESOLUTION
+from metrics import observe, current_labels
+
+def get_available_memory():
+    """获取当前可用内存（字节），无法获取时返回None"""
+    if get_device() == "cuda":
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    
+    # Linux下直接读取 /proc/meminfo
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """把进程峰值RSS（VmHWM）重置为当前RSS，返回是否成功（仅Linux支持）"""
+    # Linux下写入5到clear_refs可以重置进程的VmHWM
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def reset_peak_memory():
+    """重置峰值内存统计（GPU为峰值显存，CPU为进程峰值RSS），返回是否成功"""
+    if get_device() == "cuda":
+        import torch
+        torch.cuda.reset_peak_memory_stats()
+        return True
+    return reset_peak_rss()
+
+def get_peak_memory():
+    """获取自上次重置以来的峰值内存（字节），无法获取时返回None"""
+    if get_device() == "cuda":
+        import torch
+        return torch.cuda.max_memory_allocated()
+    
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 返回字节，Linux 返回KB
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
+
+def format_bytes(num_bytes):
+    """格式化字节数"""
+    if num_bytes is None:
+        return "未知"
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+def estimate_memory(width, height, batch_size=1):
+    """粗略估算一次生成的峰值激活内存（字节）"""
+    bytes_per_value = 2 if get_device() == "cuda" else 4
+    # 无分类器引导会让UNet批次翻倍
+    unet_batch = batch_size * 2
+    tokens = (width // 8) * (height // 8)
+    # 最高分辨率层的自注意力矩阵 (8个头)
+    attention = tokens * tokens * 8 * bytes_per_value * unet_batch
+    # VAE解码器最后几层在全分辨率上有128通道的激活，按同时存活约4份估算
+    vae_decode = width * height * 128 * 4 * bytes_per_value * batch_size
+    return {"attention": attention, "vae_decode": vae_decode}
+
+def decide_memory_policy(width, height, batch_size=1):
+    """根据分辨率和可用内存决定需要启用的省内存选项"""
+    width, height = int(width), int(height)
+    if max(width, height) > LOCAL_MAX_RESOLUTION:
+        raise ValueError(f"分辨率 {width}x{height} 超过上限 {LOCAL_MAX_RESOLUTION}")
+    
+    available = get_available_memory()
+    estimate = estimate_memory(width, height, batch_size)
+    budget = available * MEMORY_POLICY["ram_budget_ratio"] if available else None
+    
+    decision = {
+        "width": width,
+        "height": height,
+        "available": available,
+        "estimate": estimate,
+        "attention_slicing": False,
+        "vae_slicing": batch_size > 1,
+        "vae_tiling": False,
+        "reasons": [],
+    }
+    
+    if not MEMORY_POLICY["enabled"]:
+        decision["vae_slicing"] = False
+        decision["reasons"].append("内存策略已关闭")
+        if max(width, height) > LOCAL_MAX_DIRECT_RESOLUTION:
+            raise ValueError(f"分辨率超过 {LOCAL_MAX_DIRECT_RESOLUTION} 需要启用内存策略（分块VAE解码）")
+        return decision
+    
+    if max(width, height) > LOCAL_MAX_DIRECT_RESOLUTION:
+        decision["vae_tiling"] = True
+        decision["reasons"].append(f"分辨率超过{LOCAL_MAX_DIRECT_RESOLUTION}，使用分块解码")
+    elif width * height > MEMORY_POLICY["vae_tiling_pixels"]:
+        decision["vae_tiling"] = True
+        decision["reasons"].append("大分辨率VAE解码")
+    
+    if budget is None:
+        # 无法获取内存信息时保守处理
+        decision["attention_slicing"] = True
+        decision["reasons"].append("无法获取可用内存，保守启用注意力切片")
+    else:
+        if estimate["attention"] > budget * 0.5:
+            decision["attention_slicing"] = True
+            decision["reasons"].append(f"注意力矩阵约 {format_bytes(estimate['attention'])}")
+        if not decision["vae_tiling"] and estimate["vae_decode"] > budget * 0.5:
+            decision["vae_tiling"] = True
+            decision["reasons"].append(f"VAE解码约 {format_bytes(estimate['vae_decode'])}")
+    
+    if batch_size > 1:
+        decision["reasons"].append(f"批量 {batch_size} 张，逐张VAE解码")
+    
+    return decision
+
+# 省内存开关（决策字典中的键，对应管道的 enable_xxx / disable_xxx 方法）
+MEMORY_TOGGLES = ("attention_slicing", "vae_slicing", "vae_tiling")
+
+def _toggle(pipeline, name, enabled):
+    """调用管道的 enable_xxx / disable_xxx 方法，管道不支持时返回False"""
+    method = getattr(pipeline, f"{'enable' if enabled else 'disable'}_{name}", None)
+    if method is None:
+        return False
+    method()
+    return True
+
+def _apply_toggles(pipeline, decision, dry_run=False):
+    """把决策中的开关应用到管道，去掉管道不支持的开关；dry_run时只检查是否支持，不调用开关方法"""
+    for name in MEMORY_TOGGLES:
+        method_name = f"{'enable' if decision[name] else 'disable'}_{name}"
+        supported = hasattr(pipeline, method_name) if dry_run else _toggle(pipeline, name, decision[name])
+        if not supported and decision[name]:
+            # 例如ONNX管道没有这些开关
+            if name == "vae_tiling" and max(decision["width"], decision["height"]) > LOCAL_MAX_DIRECT_RESOLUTION:
+                raise ValueError(f"当前推理后端不支持分块VAE解码，分辨率不能超过 {LOCAL_MAX_DIRECT_RESOLUTION}")
+            decision[name] = False
+            decision["reasons"].append(f"后端不支持{name}")
+    return decision
+
+def _print_decision(decision):
+    enabled = [name for name in MEMORY_TOGGLES if decision[name]]
+    print(f"🧠 内存策略 {decision['width']}x{decision['height']} (可用内存 {format_bytes(decision['available'])}): "
+          f"{', '.join(enabled) if enabled else '无需省内存选项'}"
+          f"{' - ' + '; '.join(decision['reasons']) if decision['reasons'] else ''}")
+
+def apply_memory_policy(pipeline, width, height, batch_size=1):
+    """决定并应用内存策略，返回决策信息"""
+    decision = _apply_toggles(pipeline, decide_memory_policy(width, height, batch_size))
+    _print_decision(decision)
+    
+    # CPU的进程峰值RSS由 memory_accounting.track_request_peak 在请求开始时重置（有并发请求时不重置）
+    if get_device() == "cuda":
+        reset_peak_memory()
+    return decision
+
+# 共享组件 -> 开关状态：同一管道池条目的文生图/图生图/ControlNet管道共用UNet和VAE，省内存开关作用在共享组件上。
+# 只在切换开关时独占：需要的开关与正在生成的请求相同时直接并发执行，需要不同开关的请求等这些请求结束后再切换
+_policy_states = weakref.WeakKeyDictionary()
+_policy_states_lock = threading.Lock()
+
+def _policy_state(pipeline):
+    owner = getattr(pipeline, "vae", None)
+    if owner is None:
+        owner = getattr(pipeline, "vae_decoder", None)
+    if owner is None:
+        owner = pipeline
+    with _policy_states_lock:
+        state = _policy_states.get(owner)
+        if state is None:
+            state = _policy_states[owner] = {
+                "condition": threading.Condition(),
+                # 按到达顺序排队，需要不同开关的请求不会被源源不断的相同开关请求饿死
+                "queue": collections.deque(),
+                # 正在执行的请求数、它们使用的开关、是否独占
+                "users": 0,
+                "active": None,
+                "exclusive": False,
+                # 各管道上次应用的开关（ControlNet管道的开关还作用在它自己的ControlNet模型上）
+                "applied": weakref.WeakKeyDictionary(),
+            }
+        return state
+
+@contextmanager
+def memory_policy_applied(pipeline, width, height, batch_size=1, exclusive=False):
+    """应用内存策略并在代码块（生成）执行期间保持，返回决策信息
+
+    共用UNet/VAE的管道需要相同开关时并发执行，需要不同开关时等正在使用旧开关的生成结束后再切换，
+    不会在其他请求生成中途改变切片/分块开关。exclusive为True时独占共享组件（如编译预热临时替换模块）。
+    """
+    decision = decide_memory_policy(width, height, batch_size)
+    wanted = tuple(decision[name] for name in MEMORY_TOGGLES)
+    state = _policy_state(pipeline)
+    condition = state["condition"]
+    ticket = object()
+    
+    def admitted():
+        if state["queue"][0] is not ticket or state["exclusive"]:
+            return False
+        if state["users"] == 0:
+            return True
+        return not exclusive and state["active"] == wanted and state["applied"].get(pipeline) == wanted
+    
+    with condition:
+        state["queue"].append(ticket)
+        try:
+            condition.wait_for(admitted)
+            if state["users"] == 0:
+                # 没有进行中的生成，可以安全地切换开关
+                _apply_toggles(pipeline, decision)
+                state["applied"][pipeline] = wanted
+                state["active"] = wanted
+                if get_device() == "cuda":
+                    reset_peak_memory()
+            else:
+                _apply_toggles(pipeline, decision, dry_run=True)
+        finally:
+            state["queue"].remove(ticket)
+            condition.notify_all()
+        state["users"] += 1
+        state["exclusive"] = exclusive
+    _print_decision(decision)
+    try:
+        yield decision
+    finally:
+        with condition:
+            state["users"] -= 1
+            if exclusive:
+                state["exclusive"] = False
+            condition.notify_all()
+
+def report_peak_memory(decision):
+    """记录本次生成的峰值内存，返回可附加到状态栏的文本"""
+    peak = get_peak_memory()
+    decision["peak"] = peak
+    print(f"📈 生成峰值内存: {format_bytes(peak)}")
+    if peak is not None and get_device() == "cuda":
+        # CPU峰值RSS由 memory_accounting.track_request_peak 按请求记录
+        observe("sd_request_peak_memory_bytes", peak, device="cuda", **current_labels())
+    
+    enabled = [name for name in ("attention_slicing", "vae_slicing", "vae_tiling") if decision[name]]
+    options = ", ".join(enabled) if enabled else "默认"
+    return f"🧠 内存策略: {options} | 峰值内存: {format_bytes(peak)}"
@@ -0,0 +1,230 @@
+"""
+指标模块 - 记录各阶段耗时直方图、缓存/错误计数和内存gauge，按Prometheus文本格式导出
+
+阶段耗时自动带上当前请求的标签（模式/模型/管道），标签通过contextvars在调用链中传递，
+API客户端、输出存储等下层模块不需要额外参数。不依赖 prometheus_client。
+"""
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import METRICS_CONFIG
+from tracing import span, set_attributes
+
+# 当前请求的标签：{"mode", "model", "pipeline"}
+_request_labels = contextvars.ContextVar("sd_request_labels", default=None)
+# 当前线程正在执行的管道调用内，文本编码/VAE解码的累计耗时
+_pipeline_timing = threading.local()
+
+LABEL_NAMES = ("mode", "model", "pipeline")
+
+# 指标定义：名称 -> (类型, 说明, 标签名)
+METRICS = {
+    "sd_stage_seconds": ("histogram", "Time spent in each generation stage", ("stage",) + LABEL_NAMES),
+    "sd_generation_seconds": ("histogram", "End-to-end generation handler latency", LABEL_NAMES),
+    "sd_generation_requests_total": ("counter", "Generation requests by outcome", LABEL_NAMES + ("outcome",)),
+    "sd_api_responses_total": ("counter", "Inference API responses by HTTP status (or network error kind)", ("status",)),
+    "sd_cache_requests_total": ("counter", "Cache lookups by cache and result", ("cache", "result")),
+    "sd_request_peak_memory_bytes": ("histogram", "Peak memory during a generation request (process RSS or CUDA allocated)", ("device",) + LABEL_NAMES),
+    "sd_process_memory_bytes": ("gauge", "Process memory (resident, peak resident, CUDA allocated/reserved)", ("kind",)),
+    "sd_pipeline_memory_bytes": ("gauge", "Parameter and buffer bytes of loaded pipeline components by dtype", ("model", "backend", "component", "tensor", "dtype")),
+    "sd_cache_disk_bytes": ("gauge", "On-disk size of each cache directory", ("cache",)),
+}
+
+# 非耗时类直方图的分桶上界
+BUCKETS = {
+    "sd_request_peak_memory_bytes": tuple(2 ** power * 1024 ** 2 for power in range(7, 16)),  # 128MB ~ 32GB
+}
+
+_lock = threading.Lock()
+# 名称 -> {标签值元组: 计数值 或 [各分桶计数..., 总和, 总数]}
+_values = {name: {} for name in METRICS}
+# 导出前调用的采集函数，用于刷新按需计算的gauge
+_collectors = []
+
+def _label_values(name, labels):
+    """按指标定义的标签顺序取标签值，未提供的标签为空字符串"""
+    return tuple(str(labels.get(label, "")) for label in METRICS[name][2])
+
+def inc(name, value=1, **labels):
+    """计数器加值"""
+    key = _label_values(name, labels)
+    with _lock:
+        _values[name][key] = _values[name].get(key, 0) + value
+
+def observe(name, value, **labels):
+    """直方图记录一次观测值"""
+    buckets = BUCKETS.get(name, METRICS_CONFIG["buckets"])
+    key = _label_values(name, labels)
+    with _lock:
+        series = _values[name].get(key)
+        if series is None:
+            series = _values[name][key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+def set_gauge(name, value, **labels):
+    """设置gauge的当前值"""
+    key = _label_values(name, labels)
+    with _lock:
+        _values[name][key] = value
+
+def replace_gauges(name, samples):
+    """整体替换gauge的所有序列（已卸载的管道等不再导出），samples为 [(标签字典, 值), ...]"""
+    series = {_label_values(name, labels): value for labels, value in samples}
+    with _lock:
+        _values[name] = series
+
+def register_collector(collector):
+    """注册导出前调用的采集函数"""
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+def current_labels():
+    """当前请求的标签，不在请求内时为空字典"""
+    return _request_labels.get() or {}
+
+@contextmanager
+def request_labels(**labels):
+    """在代码块内设置当前请求的标签"""
+    token = _request_labels.set({name: labels.get(name, "") for name in LABEL_NAMES})
+    try:
+        yield
+    finally:
+        _request_labels.reset(token)
+
+@contextmanager
+def stage(name, **attributes):
+    """记录代码块的阶段耗时，同时作为当前追踪的子span"""
+    start = time.perf_counter()
+    try:
+        with span(name, **attributes):
+            yield
+    finally:
+        observe("sd_stage_seconds", time.perf_counter() - start, stage=name, **current_labels())
+
+def record_generation(seconds, outcome):
+    """记录一次生成请求的端到端耗时和结果（ok / error / cancelled）"""
+    labels = current_labels()
+    observe("sd_generation_seconds", seconds, **labels)
+    inc("sd_generation_requests_total", outcome=outcome, **labels)
+
+def count_cache(cache, hit):
+    """记录一次缓存查找"""
+    inc("sd_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+def count_api_response(status):
+    """记录一次推理API响应（HTTP状态码或 timeout / connection_error）"""
+    inc("sd_api_responses_total", status=status)
+
+def _timed_method(method, slot):
+    """包装管道的方法：在管道调用内把耗时累加到当前线程的计时槽"""
+    def wrapper(*args, **kwargs):
+        timing = getattr(_pipeline_timing, "current", None)
+        if timing is None:
+            return method(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            with span(slot):
+                return method(*args, **kwargs)
+        finally:
+            timing[slot] += time.perf_counter() - start
+    wrapper._sd_timed = True
+    return wrapper
+
+def instrument_pipeline(pipeline):
+    """为管道的文本编码和VAE解码挂上计时（只影响该实例，重复调用无副作用）"""
+    for attr in ("encode_prompt", "_encode_prompt"):
+        method = getattr(pipeline, attr, None)
+        if method is not None and not getattr(method, "_sd_timed", False):
+            setattr(pipeline, attr, _timed_method(method, "text_encode"))
+
+    # 多个管道共享同一个VAE，只包装一次；ONNX管道的VAE解码计入去噪阶段
+    vae = getattr(pipeline, "vae", None)
+    if vae is not None and hasattr(vae, "decode") and not getattr(vae.decode, "_sd_timed", False):
+        vae.decode = _timed_method(vae.decode, "vae_decode")
+    return pipeline
+
+@contextmanager
+def pipeline_stages():
+    """记录一次管道调用：文本编码、去噪循环（总耗时减去编码与解码）、VAE解码"""
+    previous = getattr(_pipeline_timing, "current", None)
+    timing = _pipeline_timing.current = {"text_encode": 0.0, "vae_decode": 0.0}
+    start = time.perf_counter()
+    try:
+        with span("pipeline"):
+            try:
+                yield
+            finally:
+                denoise = max(0.0, time.perf_counter() - start - timing["text_encode"] - timing["vae_decode"])
+                set_attributes(denoise_ms=round(denoise * 1000, 3))
+    finally:
+        _pipeline_timing.current = previous
+        labels = current_labels()
+        observe("sd_stage_seconds", timing["text_encode"], stage="text_encode", **labels)
+        observe("sd_stage_seconds", denoise, stage="denoise", **labels)
+        if timing["vae_decode"]:
+            observe("sd_stage_seconds", timing["vae_decode"], stage="vae_decode", **labels)
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(label_names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render_prometheus():
+    """按Prometheus文本格式导出所有指标"""
+    for collector in list(_collectors):
+        try:
+            collector()
+        except Exception as e:
+            print(f"⚠️ 指标采集失败: {e}")
+    
+    lines = []
+    with _lock:
+        snapshot = {name: dict(series) for name, series in _values.items()}
+
+    for name, (kind, help_text, label_names) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        buckets = BUCKETS.get(name, METRICS_CONFIG["buckets"])
+        for values, data in sorted(snapshot[name].items()):
+            if kind in ("counter", "gauge"):
+                lines.append(f"{name}{_format_labels(label_names, values)} {data}")
+                continue
+            for bound, count in zip(buckets, data):
+                lines.append(f"{name}_bucket{_format_labels(label_names, values, [('le', str(bound) if isinstance(bound, int) else f'{bound:g}')])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(label_names, values, [('le', '+Inf')])} {data[-1]}")
+            lines.append(f"{name}_sum{_format_labels(label_names, values)} {data[-2]:.6f}")
+            lines.append(f"{name}_count{_format_labels(label_names, values)} {data[-1]}")
+    return "\n".join(lines) + "\n"
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """在后台线程启动只提供 /metrics 的HTTP服务（界面模式没有可挂载路由的FastAPI应用时使用）"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 抓取请求很频繁，不打印访问日志
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 指标抓取地址: http://{host}:{port}/metrics")
+    return server
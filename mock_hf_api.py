@@ -0,0 +1,307 @@
+"""
+本地模拟推理API - 模拟 Hugging Face 推理接口，用于离线压测和基准测试，不消耗API额度
+
+实现应用用到的所有接口：
+    POST /models/<模型ID>          文生图（inputs为字符串）、图生图和ControlNet（inputs中带base64图像）
+    HEAD /models/<模型ID>          连接测试
+    GET  /api/whoami-v2            Token验证
+    GET  /api/models               模型列表
+    GET  /mock/stats               模拟服务自身的请求统计（JSON）
+
+可配置生成耗时分布、冷启动（503 + estimated_time）、429限流、请求体大小上限（413）和随机错误，
+默认值见 config.MOCK_API_CONFIG。启动后把应用指向它：
+
+    python mock_hf_api.py --latency lognormal:2,0.4 --cold-start 20 --rate-limit 30
+    SD_HF_API_BASE_URL=http://127.0.0.1:8765 python app.py
+
+返回的图像为随机像素PNG（不依赖PIL），大小接近真实生成结果的上界；也可用 --image 返回固定文件。
+"""
+
+import os
+import json
+import math
+import time
+import zlib
+import base64
+import random
+import struct
+import binascii
+import threading
+from collections import deque
+from config import MOCK_API_CONFIG, API_ENDPOINTS, CONTROLNET_API_ENDPOINTS
+
+def parse_latency(spec):
+    """解析耗时分布描述，返回每次调用给出一个耗时（秒）的函数"""
+    spec = str(spec).strip()
+    kind, _, args = spec.partition(":")
+    if not args:
+        kind, args = "fixed", kind
+    values = [float(value) for value in args.split(",") if value.strip()]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal" and len(values) == 2:
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        # 参数为中位数和对数标准差，长尾更接近真实推理服务
+        return lambda: values[0] * math.exp(random.gauss(0.0, values[1]))
+    raise ValueError(f"无法解析的耗时分布: {spec}（示例: fixed:2, uniform:1,3, normal:2,0.5, lognormal:2,0.4）")
+
+def known_models():
+    """应用配置中的所有推理模型ID（从端点URL中取出）"""
+    endpoints = list(API_ENDPOINTS.values()) + list(CONTROLNET_API_ENDPOINTS.values())
+    return {endpoint.split("/models/", 1)[1] for endpoint in endpoints}
+
+def random_png(width, height):
+    """生成随机像素的RGB PNG（随机数据几乎不可压缩，大小接近未压缩像素数据）"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    row_bytes = width * 3
+    noise = os.urandom(row_bytes * height)
+    raw = b"".join(b"\x00" + noise[y * row_bytes:(y + 1) * row_bytes] for y in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+def create_mock_server(host=None, port=None, image_path=None, **overrides):
+    """创建模拟服务（未启动），overrides 覆盖 MOCK_API_CONFIG 中的同名配置"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    options = {**MOCK_API_CONFIG, **{key: value for key, value in overrides.items() if value is not None}}
+    latency = parse_latency(options["latency"])
+    models = known_models()
+    fixed_image = None
+    if image_path:
+        with open(image_path, "rb") as f:
+            fixed_image = f.read()
+        fixed_type = "image/png" if fixed_image[:8] == b"\x89PNG\r\n\x1a\n" else "image/jpeg"
+
+    lock = threading.Lock()
+    model_state = {}     # 模型ID -> {"ready_at", "last_used"}
+    rate_windows = {}    # Token -> 最近请求时间队列
+    images = {}          # (宽, 高) -> PNG字节
+    stats = {"requests": 0, "by_status": {}, "by_mode": {}, "in_flight": 0, "max_in_flight": 0}
+    slots = threading.BoundedSemaphore(options["concurrency"]) if options["concurrency"] else None
+
+    def image_for(width, height):
+        if fixed_image is not None:
+            return fixed_image, fixed_type
+        with lock:
+            if (width, height) not in images:
+                images[(width, height)] = random_png(width, height)
+            return images[(width, height)], "image/png"
+
+    def warm_up(model_id, trigger):
+        """返回模型还需加载的秒数（0表示就绪）；trigger为True时冷模型开始加载"""
+        now = time.monotonic()
+        with lock:
+            state = model_state.get(model_id)
+            idle = options["idle_unload"] and state and now - state["last_used"] > options["idle_unload"]
+            if state is None or idle:
+                if not trigger:
+                    return 0.0
+                state = model_state[model_id] = {"ready_at": now + options["cold_start"], "last_used": now}
+            state["last_used"] = now
+            return max(0.0, state["ready_at"] - now)
+
+    def throttled(token):
+        """滑动窗口限流，返回需要等待的秒数（0表示放行）"""
+        if not options["rate_limit"]:
+            return 0.0
+        now = time.monotonic()
+        with lock:
+            window = rate_windows.setdefault(token, deque())
+            while window and now - window[0] > options["rate_window"]:
+                window.popleft()
+            if len(window) >= options["rate_limit"]:
+                return options["rate_window"] - (now - window[0])
+            window.append(now)
+            return 0.0
+
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body=b"", content_type="application/json", headers=None, mode=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode("utf-8")
+            with lock:
+                stats["requests"] += 1
+                stats["by_status"][str(status)] = stats["by_status"].get(str(status), 0) + 1
+                if mode:
+                    stats["by_mode"][mode] = stats["by_mode"].get(mode, 0) + 1
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _token(self):
+            """返回请求的Token；要求Token但缺失或无效时返回None"""
+            auth = self.headers.get("Authorization", "")
+            token = auth[7:].strip() if auth.startswith("Bearer ") else ""
+            if options["require_token"] and not token.startswith("hf_"):
+                return None
+            return token or self.client_address[0]
+
+        def _model_id(self):
+            path = self.path.split("?", 1)[0]
+            if not path.startswith("/models/"):
+                return None
+            return path[len("/models/"):].strip("/")
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/api/whoami-v2":
+                if self._token() is None or not self.headers.get("Authorization"):
+                    self._send(401, {"error": "Invalid credentials in Authorization header"})
+                    return
+                self._send(200, {"type": "user", "name": "mock-user", "auth": {"accessToken": {"role": "read"}}})
+            elif path == "/api/models":
+                self._send(200, [{"id": model_id, "pipeline_tag": "text-to-image"} for model_id in sorted(models)])
+            elif path == "/mock/stats":
+                with lock:
+                    snapshot = json.loads(json.dumps(stats))
+                    snapshot["models"] = {model_id: {"ready": state["ready_at"] <= time.monotonic()} for model_id, state in model_state.items()}
+                self._send(200, snapshot)
+            elif path == "/":
+                self._send(200, b"mock huggingface api", "text/plain")
+            else:
+                self._send(404, {"error": "Not Found"})
+
+        def do_HEAD(self):
+            model_id = self._model_id()
+            if model_id is None or model_id not in models:
+                self._send(404)
+            elif self._token() is None:
+                self._send(401)
+            else:
+                self._send(503 if warm_up(model_id, trigger=False) else 200)
+
+        def do_POST(self):
+            model_id = self._model_id()
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > options["max_payload_bytes"]:
+                # 丢弃过大的请求体（分块读取，不保留在内存中），客户端才能稳定收到413
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                self._send(413, {"error": f"Payload too large: {length} bytes exceeds {options['max_payload_bytes']}"})
+                return
+            body = self.rfile.read(length)
+
+            if model_id is None or model_id not in models:
+                self._send(404, {"error": f"Model {model_id} does not exist"})
+                return
+            token = self._token()
+            if token is None:
+                self._send(401, {"error": "Invalid credentials in Authorization header"})
+                return
+            retry_after = throttled(token)
+            if retry_after:
+                self._send(429, {"error": "Rate limit reached. Please retry later."},
+                           headers={"Retry-After": str(math.ceil(retry_after))})
+                return
+
+            try:
+                payload = json.loads(body)
+                mode, width, height = self._parse_payload(model_id, payload)
+            except (ValueError, TypeError, KeyError, binascii.Error) as e:
+                self._send(400, {"error": f"Invalid payload: {e}"})
+                return
+
+            loading = warm_up(model_id, trigger=True)
+            if loading:
+                self._send(503, {"error": f"Model {model_id} is currently loading", "estimated_time": round(loading, 1)},
+                           mode=mode)
+                return
+
+            if slots:
+                slots.acquire()
+            with lock:
+                stats["in_flight"] += 1
+                stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+            try:
+                time.sleep(latency())
+            finally:
+                with lock:
+                    stats["in_flight"] -= 1
+                if slots:
+                    slots.release()
+
+            if options["error_rate"] and random.random() < options["error_rate"]:
+                self._send(500, {"error": "Internal Server Error"}, mode=mode)
+                return
+            image, content_type = image_for(width, height)
+            self._send(200, image, content_type, mode=mode)
+
+        def _parse_payload(self, model_id, payload):
+            """校验请求体，返回 (生成类型, 宽, 高)"""
+            inputs = payload["inputs"]
+            parameters = payload.get("parameters") or {}
+            if isinstance(inputs, str):
+                mode = "txt2img"
+            else:
+                if not isinstance(inputs.get("prompt"), str):
+                    raise ValueError("inputs.prompt must be a string")
+                base64.b64decode(inputs["image"], validate=True)
+                mode = "controlnet" if "controlnet" in model_id else "img2img"
+            width = int(parameters.get("width") or 512)
+            height = int(parameters.get("height") or 512)
+            if not (64 <= width <= 2048 and 64 <= height <= 2048):
+                raise ValueError("width and height must be between 64 and 2048")
+            return mode, width, height
+
+        def log_message(self, format, *args):
+            pass  # 压测时请求很多，不打印访问日志
+
+    server = ThreadingHTTPServer((host or options["host"], options["port"] if port is None else port), MockHandler)
+    server.daemon_threads = True
+    return server
+
+def start_mock_server(host="127.0.0.1", port=0, **options):
+    """在后台线程启动模拟服务（默认随机端口），返回 (服务器, 基础URL)"""
+    server = create_mock_server(host, port, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="本地模拟 Hugging Face 推理API")
+    parser.add_argument("--host", default=MOCK_API_CONFIG["host"])
+    parser.add_argument("--port", type=int, default=MOCK_API_CONFIG["port"])
+    parser.add_argument("--latency", help=f"生成耗时分布（默认 {MOCK_API_CONFIG['latency']}）")
+    parser.add_argument("--cold-start", type=float, help="模型冷启动时长（秒）")
+    parser.add_argument("--idle-unload", type=float, help="模型空闲多久后重新冷启动（秒）")
+    parser.add_argument("--rate-limit", type=int, help="每个Token在窗口内允许的请求数")
+    parser.add_argument("--rate-window", type=float, help="限流窗口（秒）")
+    parser.add_argument("--max-payload-bytes", type=int, help="请求体大小上限")
+    parser.add_argument("--concurrency", type=int, help="同时处理的生成请求数")
+    parser.add_argument("--error-rate", type=float, help="随机返回500的比例")
+    parser.add_argument("--no-auth", action="store_true", help="不要求Token")
+    parser.add_argument("--image", help="返回固定的图像文件（PNG/JPEG）")
+    args = parser.parse_args(argv)
+
+    server = create_mock_server(
+        args.host, args.port, image_path=args.image,
+        latency=args.latency, cold_start=args.cold_start, idle_unload=args.idle_unload,
+        rate_limit=args.rate_limit, rate_window=args.rate_window, max_payload_bytes=args.max_payload_bytes,
+        concurrency=args.concurrency, error_rate=args.error_rate, require_token=False if args.no_auth else None,
+    )
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    print(f"🧪 模拟推理API已启动: {base_url}")
+    print(f"💡 把应用指向它: SD_HF_API_BASE_URL={base_url} python app.py")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
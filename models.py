@@ -2,18 +2,28 @@
 模型管理模块 - 处理本地模型的加载和管理
 """
 
-import torch
-from diffusers import StableDiffusionPipeline, StableDiffusionControlNetPipeline, ControlNetModel
-from diffusers import StableDiffusionImg2ImgPipeline, DPMSolverMultistepScheduler
-from config import DEVICE, CONTROLNET_TYPES, get_available_models, API_SUPPORTED_MODELS, API_ENDPOINTS
+import os
+import threading
+from collections import OrderedDict
+from config import get_device, CONTROLNET_TYPES, PIPELINE_POOL_SIZE, LOCAL_BACKENDS, LOCAL_MODEL_CONFIG, get_available_models, API_SUPPORTED_MODELS, API_ENDPOINTS
+from metrics import count_cache, instrument_pipeline
+from memory_accounting import describe_entry_memory
 
-# 全局变量存储管道
+# 全局变量存储管道（进程默认会话：最近一次加载的模型，供没有界面会话的调用方使用）
 pipe = None
 controlnet_pipe = None
 img2img_pipe = None
 current_model = "runwayml/stable-diffusion-v1-5"
 current_controlnet = None
 RUN_MODE = "api"
+LOCAL_BACKEND = "pytorch"
+
+# 共享管道池：(模型ID, 推理后端) -> {"pipe", "img2img_pipe", "controlnet_pipes": {ControlNet类型: 管道}, "backend_name"}
+# 各会话按自己的模型设置从池中取管道，相同模型只加载一次
+_pipeline_pool = OrderedDict()
+_pool_lock = threading.Lock()
+# 管道池键 -> 加载锁
+_load_locks = {}
 
 def get_current_model_info():
     """获取当前模型信息"""
@@ -25,21 +35,185 @@ def get_current_model_info():
     else:
         return "❌ 未加载模型"
 
-def load_models(run_mode, selected_model, controlnet_type="canny", api_token=""):
-    """加载模型管道 - 改进版本，支持API模型检测"""
-    global pipe, controlnet_pipe, img2img_pipe, current_model, current_controlnet, RUN_MODE
+def _pool_get(key):
+    """从管道池取出条目并标记为最近使用"""
+    with _pool_lock:
+        entry = _pipeline_pool.get(key)
+        if entry is not None:
+            _pipeline_pool.move_to_end(key)
+        return entry
+
+def _pool_put(key, entry):
+    """放入管道池，超过容量时淘汰最久未使用的条目（进行中的请求仍持有引用，可正常完成）"""
+    with _pool_lock:
+        _pipeline_pool[key] = entry
+        _pipeline_pool.move_to_end(key)
+        while len(_pipeline_pool) > max(1, PIPELINE_POOL_SIZE):
+            evicted, _ = _pipeline_pool.popitem(last=False)
+            print(f"♻️ 管道池已满，释放模型: {evicted[0]} ({evicted[1]})")
+
+def _load_local_base(selected_model, local_backend):
+    """加载本地文生图/图生图管道，返回管道池条目"""
+    import torch
+    from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline, DPMSolverMultistepScheduler
+    DEVICE = get_device()
     
-    if not selected_model:
-        return "❌ 请选择一个模型"
+    if local_backend == "onnx":
+        # ONNX Runtime后端：首次加载时导出ONNX并缓存，之后直接加载
+        from onnx_backend import load_onnx_pipelines
+        base_pipe, base_img2img_pipe = load_onnx_pipelines(selected_model)
+    else:
+        # 量化后端优先使用磁盘缓存中的量化组件，跳过fp32权重加载
+        cached_components = {}
+        if local_backend == "int8":
+            from quantization import load_quantized_components
+            cached_components = load_quantized_components(selected_model)
+            count_cache("int8_components", bool(cached_components))
+        
+        # 基础文生图管道
+        base_pipe = StableDiffusionPipeline.from_pretrained(
+            selected_model,
+            torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
+            safety_checker=None,
+            requires_safety_checker=False,
+            **cached_components
+        )
+        base_pipe = base_pipe.to(DEVICE)
+        base_pipe.scheduler = DPMSolverMultistepScheduler.from_config(base_pipe.scheduler.config)
+        
+        if local_backend == "int8" and not cached_components:
+            from quantization import quantize_pipeline
+            quantize_pipeline(base_pipe, selected_model)
+        
+        if local_backend == "compile":
+            # 先编译共享组件，后面构建的图生图/ControlNet管道自动复用编译结果
+            from compile_backend import configure_compile_cache, compile_pipelines
+            configure_compile_cache(selected_model)
+            compile_pipelines([base_pipe])
+        
+        # 传统图生图管道 - 与文生图共享UNet/VAE/文本编码器，避免重复占用内存
+        base_img2img_pipe = StableDiffusionImg2ImgPipeline(
+            **{**base_pipe.components, "scheduler": DPMSolverMultistepScheduler.from_config(base_pipe.scheduler.config)},
+            requires_safety_checker=False
+        )
     
-    # 更新全局配置
-    RUN_MODE = run_mode
-    current_model = selected_model
+    # 文本编码和VAE解码计时，用于分阶段耗时指标
+    instrument_pipeline(base_pipe)
+    instrument_pipeline(base_img2img_pipe)
+    return {"pipe": base_pipe, "img2img_pipe": base_img2img_pipe, "controlnet_pipes": {},
+            "backend_name": LOCAL_BACKENDS[local_backend]["name"]}
+
+def _controlnet_source(controlnet_type):
+    """ControlNet权重来源：配置了本地目录时为 <目录>/<类型>，否则为Hub模型ID"""
+    local_dir = LOCAL_MODEL_CONFIG["controlnet_dir"]
+    if local_dir:
+        return os.path.join(local_dir, controlnet_type)
+    return CONTROLNET_TYPES[controlnet_type]["model_id"]
+
+def _load_local_controlnet(entry, selected_model, local_backend, controlnet_type):
+    """为管道池条目加载指定类型的ControlNet管道"""
+    import torch
+    from diffusers import StableDiffusionControlNetPipeline, ControlNetModel, DPMSolverMultistepScheduler
+    DEVICE = get_device()
+    
+    controlnet = ControlNetModel.from_pretrained(
+        _controlnet_source(controlnet_type),
+        torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32
+    )
+    if local_backend == "onnx":
+        # diffusers没有ONNX版ControlNet管道，ControlNet继续使用PyTorch：每个管道池条目只在第一次加载ControlNet时
+        # 加载一份PyTorch基础组件，各类型的ControlNet管道共用，不会每种类型再加载一份完整模型
+        base_pipe = entry.get("torch_base")
+        if base_pipe is None:
+            from diffusers import StableDiffusionPipeline
+            base_pipe = entry["torch_base"] = StableDiffusionPipeline.from_pretrained(
+                selected_model,
+                torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
+                safety_checker=None,
+                requires_safety_checker=False
+            ).to(DEVICE)
+    else:
+        base_pipe = entry["pipe"]
+    # 复用基础管道的组件，只额外加载ControlNet权重
+    new_controlnet_pipe = StableDiffusionControlNetPipeline(
+        **{**base_pipe.components, "scheduler": DPMSolverMultistepScheduler.from_config(base_pipe.scheduler.config)},
+        controlnet=controlnet,
+        requires_safety_checker=False
+    )
+    return instrument_pipeline(new_controlnet_pipe.to(DEVICE))
+
+def _load_lock(pool_key):
+    """管道池条目的加载锁，两个会话同时加载相同模型时只加载一次"""
+    with _pool_lock:
+        return _load_locks.setdefault(pool_key, threading.Lock())
+
+def _load_pool_models(selected_model, controlnet_type, local_backend, session):
+    """推理进程池模式：各工作进程并行加载模型，本进程的管道池只保存分派请求的占位管道"""
+    from inference_pool import load_pool_models, describe_pool, PoolPipeline
+    
+    statuses = load_pool_models(selected_model, controlnet_type, local_backend)
+    failed = [status for status in statuses if status.startswith("❌")]
+    if failed:
+        return f"{failed[0]}\n{describe_pool()}"
+    
+    pool_key = (selected_model, local_backend)
+    with _load_lock(pool_key):
+        entry = _pool_get(pool_key)
+        if entry is None:
+            entry = {"pipe": PoolPipeline("txt2img"), "img2img_pipe": PoolPipeline("img2img"), "controlnet_pipes": {},
+                     "backend_name": LOCAL_BACKENDS[local_backend]["name"]}
+            _pool_put(pool_key, entry)
+        entry["controlnet_pipes"].setdefault(controlnet_type, PoolPipeline("controlnet"))
+    
+    session.update(run_mode="local", model=selected_model, controlnet=controlnet_type, local_backend=local_backend, loaded=True)
+    # 各进程加载结果相同，只显示第一个进程的状态
+    return f"{statuses[0]}\n{describe_pool()}"
+
+def get_session_pipelines(session):
+    """按会话设置获取管道，返回 {"pipe", "img2img_pipe", "controlnet_pipe"}，未加载的管道为None"""
+    if not session.get("loaded"):
+        return {"pipe": None, "img2img_pipe": None, "controlnet_pipe": None}
+    if session["run_mode"] == "api":
+        return {"pipe": "api_mode", "img2img_pipe": "api_mode", "controlnet_pipe": "api_mode"}
+    
+    # 本地模型可能因管道池容量已被其他会话的加载淘汰，此时需要重新加载
+    entry = _pool_get((session["model"], session["local_backend"]))
+    if entry is None:
+        return {"pipe": None, "img2img_pipe": None, "controlnet_pipe": None}
+    return {"pipe": entry["pipe"], "img2img_pipe": entry["img2img_pipe"],
+            "controlnet_pipe": entry["controlnet_pipes"].get(session["controlnet"])}
+
+def load_models(run_mode, selected_model, controlnet_type="canny", api_token="", local_backend="pytorch", session=None):
+    """加载模型管道 - 改进版本，支持API模型检测和本地推理后端选择
+    
+    传入会话字典时，模型、Token等设置只写入该会话（本地管道放入共享管道池），不影响进程默认会话和其他会话；
+    未传入会话时加载到进程默认会话（全局变量），Token写入全局。
+    """
+    global pipe, controlnet_pipe, img2img_pipe, current_model, current_controlnet, RUN_MODE, LOCAL_BACKEND
+    
+    if session is not None:
+        return _load_session_models(run_mode, selected_model, controlnet_type, api_token, local_backend, session)
     
-    # 设置API Token
     if api_token.strip():
         from api_client import set_api_token
         set_api_token(api_token.strip())
+    from session import create_session
+    session = create_session(run_mode, selected_model, controlnet_type, local_backend=local_backend)
+    status = _load_session_models(run_mode, selected_model, controlnet_type, api_token, local_backend, session)
+    if session["loaded"]:
+        pipelines = get_session_pipelines(session)
+        RUN_MODE, current_model, current_controlnet, LOCAL_BACKEND = run_mode, selected_model, controlnet_type, local_backend
+        pipe, img2img_pipe, controlnet_pipe = pipelines["pipe"], pipelines["img2img_pipe"], pipelines["controlnet_pipe"]
+    return status
+
+def _load_session_models(run_mode, selected_model, controlnet_type, api_token, local_backend, session):
+    """为会话加载模型，设置只写入会话"""
+    if not selected_model:
+        return "❌ 请选择一个模型"
+    
+    # 设置API Token
+    if api_token.strip():
+        session["api_token"] = api_token.strip()
     
     # 获取模型信息
     available_models = get_available_models(run_mode)
@@ -62,10 +236,7 @@ def load_models(run_mode, selected_model, controlnet_type="canny", api_token="")
             token_status = "\n🔑 使用认证Token"
         
         # 模拟加载成功
-        pipe = "api_mode"
-        img2img_pipe = "api_mode" 
-        controlnet_pipe = "api_mode"
-        current_controlnet = controlnet_type
+        session.update(run_mode=run_mode, model=selected_model, controlnet=controlnet_type, loaded=True)
         
         # 判断模型类型并给出相应提示
         if selected_model.startswith("black-forest-labs/FLUX"):
@@ -80,49 +251,50 @@ def load_models(run_mode, selected_model, controlnet_type="canny", api_token="")
         return f"✅ API模式配置成功！\n📦 当前模型: {model_name}\n🎯 模型ID: {selected_model}\n🎮 ControlNet: {CONTROLNET_TYPES[controlnet_type]['name']}{quality_tip}{token_status}\n💾 存储空间占用: 0 GB\n\n💡 API模式无需下载模型，生成图片通过云端推理"
     
     else:
-        # 本地模式 - 下载模型到本地
+        # 本地模式 - 下载模型到本地；torch/diffusers只在加载时导入，API模式启动不必加载
+        if local_backend not in LOCAL_BACKENDS:
+            return f"❌ 未知的本地推理后端: {local_backend}"
+        if local_backend == "int8" and get_device() != "cpu":
+            return "❌ INT8动态量化仅支持CPU推理，GPU环境请使用PyTorch原生后端"
+        
+        from inference_pool import pool_enabled
+        if pool_enabled():
+            return _load_pool_models(selected_model, controlnet_type, local_backend, session)
+        
         try:
-            # 基础文生图管道
-            pipe = StableDiffusionPipeline.from_pretrained(
-                selected_model,
-                torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
-                safety_checker=None,
-                requires_safety_checker=False
-            )
-            pipe = pipe.to(DEVICE)
-            pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+            # 其他会话已加载过相同模型和后端时直接复用；同一条目的加载串行执行，不会重复加载
+            pool_key = (selected_model, local_backend)
+            with _load_lock(pool_key):
+                entry = _pool_get(pool_key)
+                count_cache("pipeline_pool", entry is not None)
+                if entry is None:
+                    entry = _load_local_base(selected_model, local_backend)
+                    _pool_put(pool_key, entry)
             
-            # 传统图生图管道
-            img2img_pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
-                selected_model,
-                torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
-                safety_checker=None,
-                requires_safety_checker=False
-            )
-            img2img_pipe = img2img_pipe.to(DEVICE)
-            img2img_pipe.scheduler = DPMSolverMultistepScheduler.from_config(img2img_pipe.scheduler.config)
+            backend_name = entry["backend_name"]
+            session.update(run_mode=run_mode, model=selected_model, local_backend=local_backend, loaded=True)
+            
+            if local_backend == "compile":
+                from config import COMPILE_CONFIG
+                if COMPILE_CONFIG["warmup_at_load"]:
+                    print(warmup_compiled_models(session))
             
             # ControlNet 管道
             try:
-                current_controlnet = controlnet_type
+                session["controlnet"] = controlnet_type
                 controlnet_info = CONTROLNET_TYPES[controlnet_type]
                 
-                controlnet = ControlNetModel.from_pretrained(
-                    controlnet_info["model_id"],
-                    torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32
-                )
-                controlnet_pipe = StableDiffusionControlNetPipeline.from_pretrained(
-                    selected_model,
-                    controlnet=controlnet,
-                    torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
-                    safety_checker=None,
-                    requires_safety_checker=False
-                )
-                controlnet_pipe = controlnet_pipe.to(DEVICE)
-                controlnet_pipe.scheduler = DPMSolverMultistepScheduler.from_config(controlnet_pipe.scheduler.config)
-                return f"✅ 本地模式所有模型加载成功！\n📦 当前模型: {model_name}\n🎯 模型ID: {selected_model}\n🎮 ControlNet: {controlnet_info['name']}\n💾 预计存储占用: ~6-10 GB"
+                with _load_lock(pool_key):
+                    controlnet_pipe = entry["controlnet_pipes"].get(controlnet_type)
+                    count_cache("controlnet_pool", controlnet_pipe is not None)
+                    if controlnet_pipe is None:
+                        controlnet_pipe = _load_local_controlnet(entry, selected_model, local_backend, controlnet_type)
+                        entry["controlnet_pipes"][controlnet_type] = controlnet_pipe
+                if local_backend == "onnx":
+                    backend_name += " (ControlNet使用PyTorch)"
+                return f"✅ 本地模式所有模型加载成功！\n📦 当前模型: {model_name}\n🎯 模型ID: {selected_model}\n🎮 ControlNet: {controlnet_info['name']}\n⚙️ 推理后端: {backend_name}\n{describe_entry_memory(entry)}"
             except Exception as controlnet_error:
-                return f"✅ 本地模式基础模型加载成功！\n📦 当前模型: {model_name}\n🎯 模型ID: {selected_model}\n⚠️ ControlNet加载失败: {str(controlnet_error)}\n💡 文生图和传统图生图功能可正常使用\n💾 预计存储占用: ~4-7 GB"
+                return f"✅ 本地模式基础模型加载成功！\n📦 当前模型: {model_name}\n🎯 模型ID: {selected_model}\n⚙️ 推理后端: {backend_name}\n⚠️ ControlNet加载失败: {str(controlnet_error)}\n💡 文生图和传统图生图功能可正常使用\n{describe_entry_memory(entry)}"
             
         except Exception as e:
             return f"❌ 本地模式加载失败: {str(e)}\n💡 建议尝试API模式以避免存储空间问题"
@@ -142,3 +314,46 @@ def get_current_model():
 def get_current_controlnet():
     """获取当前ControlNet类型"""
     return current_controlnet
+
+def unload_models():
+    """释放所有已加载的管道（包括共享管道池）及其显存/内存"""
+    global pipe, controlnet_pipe, img2img_pipe
+    with _pool_lock:
+        had_local = bool(_pipeline_pool)
+        _pipeline_pool.clear()
+    pipe = controlnet_pipe = img2img_pipe = None
+    # 推理进程池中的模型随工作进程一起释放
+    import sys
+    inference_pool = sys.modules.get("inference_pool")
+    if inference_pool is not None and inference_pool.pool_size():
+        inference_pool.stop_pool()
+    if not had_local:
+        return
+    
+    import gc
+    gc.collect()
+    if "torch" in sys.modules:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def get_local_backend():
+    """获取当前本地推理后端"""
+    return LOCAL_BACKEND
+
+def warmup_compiled_models(session=None):
+    """预热会话（未传入时为进程默认会话）已加载的编译模式管道的所有分辨率分桶，返回预热报告"""
+    from session import resolve_session
+    session = resolve_session(session)
+    base_pipe = get_session_pipelines(session)["pipe"]
+    if session["run_mode"] != "local" or session["local_backend"] != "compile" or base_pipe is None:
+        return "❌ 请先以本地模式 + torch.compile 后端加载模型"
+    from inference_pool import is_pool_pipeline
+    if is_pool_pipeline(base_pipe):
+        return "❌ 推理进程池模式下请设置 COMPILE_CONFIG['warmup_at_load']，各工作进程加载时自动预热"
+    
+    from compile_backend import warmup_buckets, format_warmup_report
+    try:
+        return format_warmup_report(warmup_buckets(base_pipe))
+    except Exception as e:
+        return f"❌ 编译预热失败: {str(e)}"
@@ -0,0 +1,177 @@
+"""
+ONNX Runtime后端模块 - 将文本编码器/UNet/VAE导出为ONNX（磁盘缓存），使用CPU执行提供程序推理
+"""
+
+import os
+import shutil
+from config import LOCAL_CACHE_DIR
+from metrics import count_cache
+
+# ONNX导出使用的算子集版本
+ONNX_OPSET = 14
+
+def _require_onnx():
+    """检查ONNX相关依赖"""
+    try:
+        import onnx  # noqa: F401
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        raise ImportError("ONNX后端需要安装 onnx 和 onnxruntime: pip install onnx onnxruntime")
+
+def get_onnx_cache_dir(model_id):
+    """获取模型ONNX导出缓存目录"""
+    import diffusers
+    safe_name = model_id.replace("/", "--").replace("\\", "--").replace(":", "")
+    return os.path.join(LOCAL_CACHE_DIR, "onnx", safe_name, f"opset{ONNX_OPSET}-diffusers{diffusers.__version__}")
+
+def _onnx_export(model, model_args, output_path, input_names, output_names, dynamic_axes):
+    """导出单个模块为ONNX"""
+    import torch
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            model_args,
+            f=output_path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            do_constant_folding=True,
+            opset_version=ONNX_OPSET,
+        )
+
+def export_pipeline_to_onnx(model_id, output_dir):
+    """把Stable Diffusion管道导出为OnnxStableDiffusionPipeline目录结构"""
+    import onnx
+    import torch
+    from diffusers import StableDiffusionPipeline, OnnxStableDiffusionPipeline, OnnxRuntimeModel
+    
+    print(f"📤 正在导出ONNX模型（仅首次需要）: {model_id}")
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        model_id, torch_dtype=torch.float32, safety_checker=None, requires_safety_checker=False
+    )
+    tmp_dir = output_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    # 文本编码器
+    num_tokens = pipeline.text_encoder.config.max_position_embeddings
+    text_hidden_size = pipeline.text_encoder.config.hidden_size
+    text_input = pipeline.tokenizer(
+        "A sample prompt", padding="max_length", max_length=pipeline.tokenizer.model_max_length,
+        truncation=True, return_tensors="pt"
+    )
+    _onnx_export(
+        pipeline.text_encoder,
+        (text_input.input_ids.to(dtype=torch.int32),),
+        os.path.join(tmp_dir, "text_encoder", "model.onnx"),
+        ["input_ids"], ["last_hidden_state", "pooler_output"],
+        {"input_ids": {0: "batch", 1: "sequence"}},
+    )
+    
+    # UNet（超过2GB，权重需要保存为外部数据）
+    unet_in_channels = pipeline.unet.config.in_channels
+    unet_sample_size = pipeline.unet.config.sample_size
+    unet_path = os.path.join(tmp_dir, "unet", "model.onnx")
+    _onnx_export(
+        pipeline.unet,
+        (
+            torch.randn(2, unet_in_channels, unet_sample_size, unet_sample_size),
+            torch.randn(2),
+            torch.randn(2, num_tokens, text_hidden_size),
+            False,
+        ),
+        unet_path,
+        ["sample", "timestep", "encoder_hidden_states", "return_dict"], ["out_sample"],
+        {
+            "sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
+            "timestep": {0: "batch"},
+            "encoder_hidden_states": {0: "batch", 1: "sequence"},
+        },
+    )
+    unet_model = onnx.load(unet_path)
+    unet_dir = os.path.dirname(unet_path)
+    shutil.rmtree(unet_dir)
+    os.makedirs(unet_dir)
+    onnx.save_model(unet_model, unet_path, save_as_external_data=True, all_tensors_to_one_file=True,
+                    location="weights.pb", convert_attribute=False)
+    del unet_model
+    
+    # VAE编码器（图生图使用）
+    vae = pipeline.vae
+    vae_sample_size = vae.config.sample_size
+    vae.forward = lambda sample, return_dict: vae.encode(sample, return_dict)[0].sample()
+    _onnx_export(
+        vae,
+        (torch.randn(1, vae.config.in_channels, vae_sample_size, vae_sample_size), False),
+        os.path.join(tmp_dir, "vae_encoder", "model.onnx"),
+        ["sample", "return_dict"], ["latent_sample"],
+        {"sample": {0: "batch", 1: "channels", 2: "height", 3: "width"}},
+    )
+    
+    # VAE解码器
+    vae.forward = vae.decode
+    _onnx_export(
+        vae,
+        (torch.randn(1, vae.config.latent_channels, unet_sample_size, unet_sample_size), False),
+        os.path.join(tmp_dir, "vae_decoder", "model.onnx"),
+        ["latent_sample", "return_dict"], ["sample"],
+        {"latent_sample": {0: "batch", 1: "channels", 2: "height", 3: "width"}},
+    )
+    
+    onnx_pipeline = OnnxStableDiffusionPipeline(
+        vae_encoder=OnnxRuntimeModel.from_pretrained(os.path.join(tmp_dir, "vae_encoder")),
+        vae_decoder=OnnxRuntimeModel.from_pretrained(os.path.join(tmp_dir, "vae_decoder")),
+        text_encoder=OnnxRuntimeModel.from_pretrained(os.path.join(tmp_dir, "text_encoder")),
+        tokenizer=pipeline.tokenizer,
+        unet=OnnxRuntimeModel.from_pretrained(unet_dir),
+        scheduler=pipeline.scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    onnx_pipeline.save_pretrained(tmp_dir)
+    del onnx_pipeline, pipeline
+    
+    # 全部导出成功后再换名，避免中断留下不完整的缓存
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(output_dir), exist_ok=True)
+    os.replace(tmp_dir, output_dir)
+    print(f"✅ ONNX模型已导出: {output_dir}")
+
+def create_session_options():
+    """创建启用全部图优化的ONNX Runtime会话选项"""
+    import onnxruntime as ort
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return sess_options
+
+def load_onnx_pipelines(model_id):
+    """加载（必要时先导出）ONNX文生图与图生图管道，两者共享同一组推理会话"""
+    _require_onnx()
+    from diffusers import OnnxStableDiffusionPipeline, OnnxStableDiffusionImg2ImgPipeline, DPMSolverMultistepScheduler
+    
+    cache_dir = get_onnx_cache_dir(model_id)
+    cached = os.path.exists(os.path.join(cache_dir, "model_index.json"))
+    count_cache("onnx_export", cached)
+    if not cached:
+        export_pipeline_to_onnx(model_id, cache_dir)
+    else:
+        print(f"📦 已从缓存加载ONNX模型: {cache_dir}")
+    
+    txt2img = OnnxStableDiffusionPipeline.from_pretrained(
+        cache_dir,
+        provider="CPUExecutionProvider",
+        sess_options=create_session_options(),
+        safety_checker=None,
+        requires_safety_checker=False,
+    )
+    txt2img.scheduler = DPMSolverMultistepScheduler.from_config(txt2img.scheduler.config)
+    img2img = OnnxStableDiffusionImg2ImgPipeline(
+        **{**txt2img.components, "scheduler": DPMSolverMultistepScheduler.from_config(txt2img.scheduler.config)},
+        requires_safety_checker=False,
+    )
+    return txt2img, img2img
+
+def is_onnx_pipeline(pipeline):
+    """判断管道是否为ONNX Runtime管道"""
+    return type(pipeline).__name__.startswith("Onnx")
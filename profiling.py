@@ -0,0 +1,195 @@
+"""
+性能剖析模块 - 按需对单次生成做剖析，未启用时不产生任何开销
+
+请求通过 profile_request() 显式要求剖析（生成服务的 X-Profile 请求头、批量任务的 "profile" 字段），
+或按 PROFILING_CONFIG["sample_rate"] 抽样。本地模式使用PyTorch Profiler导出Chrome trace，
+API模式（或未安装torch时）使用cProfile。剖析文件和文本摘要写入剖析目录，
+index.jsonl 记录每次剖析对应的生成类型、模型、耗时、输出文件和trace ID。
+剖析次数或总大小超过 PROFILING_CONFIG["max_profiles"] / ["max_bytes"] 时删除最旧的剖析文件。
+
+查看最近的剖析：
+    python profiling.py --last 10
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import PROFILING_CONFIG
+from tracing import current_trace_id, set_attributes
+
+# 显式要求剖析时为一个字典，剖析完成后填入结果（文件列表等）
+_profile_request = contextvars.ContextVar("sd_profile_request", default=None)
+_index_lock = threading.Lock()
+
+@contextmanager
+def profile_request():
+    """要求剖析代码块内的生成，返回的字典在剖析完成后填入 "files"、"id" 等信息"""
+    capture = {}
+    token = _profile_request.set(capture)
+    try:
+        yield capture
+    finally:
+        _profile_request.reset(token)
+
+def _claim_capture():
+    """本次生成是否需要剖析：显式要求时返回请求的字典，抽样命中时返回新字典，否则返回None"""
+    capture = _profile_request.get()
+    if capture is not None:
+        # 同一请求只剖析最外层的一次生成
+        return None if capture.get("active") else capture
+    rate = PROFILING_CONFIG["sample_rate"]
+    if rate > 0 and random.random() < rate:
+        return {"sampled": True}
+    return None
+
+@contextmanager
+def profiled(kind, run_mode, model):
+    """按需剖析代码块，返回的字典可由调用方补充 "output"（生成结果文件路径）"""
+    capture = _claim_capture()
+    if capture is None:
+        yield None
+        return
+
+    capture["active"] = True
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{os.urandom(3).hex()}"
+    base_path = os.path.join(PROFILING_CONFIG["dir"], profile_id)
+    os.makedirs(PROFILING_CONFIG["dir"], exist_ok=True)
+    use_torch = run_mode == "local" and PROFILING_CONFIG["torch_profiler"] and "torch" in sys.modules
+
+    files = []
+    start = time.perf_counter()
+    try:
+        with (_torch_profile if use_torch else _cprofile)(base_path, files):
+            yield capture
+    finally:
+        capture.pop("active", None)
+        capture.update(id=profile_id, files=files)
+        entry = {
+            "id": profile_id,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "kind": kind,
+            "run_mode": run_mode,
+            "model": model,
+            "profiler": "torch" if use_torch else "cprofile",
+            "sampled": bool(capture.get("sampled")),
+            "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+            "files": [os.path.basename(path) for path in files],
+            "output": capture.get("output"),
+            "trace_id": current_trace_id(),
+        }
+        _append_index(entry)
+        _prune_profiles()
+        set_attributes(profile_id=profile_id)
+        print(f"🧪 已保存性能剖析: {base_path}.*（{entry['duration_ms']:.0f} ms）")
+
+@contextmanager
+def _cprofile(base_path, files):
+    """cProfile剖析当前线程，保存 .prof 和按累计耗时排序的 .txt 摘要"""
+    import cProfile
+    import pstats
+    import io
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(base_path + ".prof")
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILING_CONFIG["summary_rows"])
+        with open(base_path + ".txt", "w", encoding="utf-8") as f:
+            f.write(summary.getvalue())
+        files.extend([base_path + ".prof", base_path + ".txt"])
+
+@contextmanager
+def _torch_profile(base_path, files):
+    """PyTorch Profiler剖析CPU（及CUDA）算子，保存Chrome trace和按耗时排序的 .txt 摘要"""
+    import torch
+    from torch.profiler import profile, ProfilerActivity
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+    profiler = profile(activities=activities)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        profiler.export_chrome_trace(base_path + ".trace.json")
+        with open(base_path + ".txt", "w", encoding="utf-8") as f:
+            f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=PROFILING_CONFIG["summary_rows"]))
+        files.extend([base_path + ".trace.json", base_path + ".txt"])
+
+def _append_index(entry):
+    """追加剖析索引"""
+    with _index_lock:
+        with open(os.path.join(PROFILING_CONFIG["dir"], "index.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+def _prune_profiles():
+    """剖析次数或总大小超过上限时，按时间从旧到新删除整次剖析的文件（索引保留）"""
+    directory = PROFILING_CONFIG["dir"]
+    profiles = {}
+    with _index_lock:
+        for name in os.listdir(directory):
+            if name == "index.jsonl":
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # 同一次剖析的文件共用剖析ID前缀（<ID>.prof / <ID>.txt / <ID>.trace.json）
+            profile = profiles.setdefault(name.split(".", 1)[0], {"mtime": 0, "bytes": 0, "paths": []})
+            profile["mtime"] = max(profile["mtime"], stat.st_mtime)
+            profile["bytes"] += stat.st_size
+            profile["paths"].append(path)
+        
+        oldest_first = sorted(profiles.values(), key=lambda profile: profile["mtime"])
+        total_bytes = sum(profile["bytes"] for profile in oldest_first)
+        count = len(oldest_first)
+        # 最新的一次剖析总是保留
+        for profile in oldest_first[:-1]:
+            if count <= PROFILING_CONFIG["max_profiles"] and total_bytes <= PROFILING_CONFIG["max_bytes"]:
+                break
+            for path in profile["paths"]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            count -= 1
+            total_bytes -= profile["bytes"]
+
+def list_profiles(last=20):
+    """读取剖析索引，返回最近的若干条"""
+    path = os.path.join(PROFILING_CONFIG["dir"], "index.jsonl")
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return entries[-last:]
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="查看已保存的性能剖析")
+    parser.add_argument("--last", type=int, default=20, help="显示最近N条")
+    args = parser.parse_args(argv)
+
+    entries = list_profiles(args.last)
+    if not entries:
+        print(f"📭 暂无剖析记录（{PROFILING_CONFIG['dir']}）")
+        return
+    print(f"📂 剖析目录: {PROFILING_CONFIG['dir']}")
+    for entry in entries:
+        sampled = " 抽样" if entry["sampled"] else ""
+        print(f"{entry['time']}  {entry['id']:<40} {entry['run_mode']:<5} {entry['profiler']:<8} {entry['duration_ms']:>9.0f} ms{sampled}  "
+              f"{', '.join(entry['files'])}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+量化模块 - 本地CPU推理的INT8动态量化，量化结果缓存到磁盘
+"""
+
+import os
+import time
+import importlib
+import torch
+from config import LOCAL_CACHE_DIR
+
+# 需要量化的管道组件
+QUANTIZED_COMPONENTS = ("text_encoder", "unet")
+
+def get_quantized_cache_dir(model_id):
+    """获取模型量化缓存目录（按torch/diffusers版本区分，避免反序列化不兼容）"""
+    import diffusers
+    safe_name = model_id.replace("/", "--").replace("\\", "--").replace(":", "")
+    version_tag = f"torch{torch.__version__}-diffusers{diffusers.__version__}".replace("+", "_")
+    return os.path.join(LOCAL_CACHE_DIR, "int8", safe_name, version_tag)
+
+def quantize_module(module):
+    """对模块中的线性层做动态INT8量化"""
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _build_component(model_id, name):
+    """按模型的 model_index.json 构建组件结构（随机初始化，不加载fp32权重）"""
+    from diffusers import DiffusionPipeline
+    library, class_name = DiffusionPipeline.load_config(model_id)[name]
+    component_class = getattr(importlib.import_module(library), class_name)
+    if library == "diffusers":
+        return component_class.from_config(component_class.load_config(model_id, subfolder=name))
+    # transformers模型由配置对象构建
+    return component_class(component_class.config_class.from_pretrained(model_id, subfolder=name))
+
+def load_quantized_components(model_id):
+    """读取已缓存的量化组件，缓存不完整时返回空字典
+
+    缓存中只有量化后的state_dict：先按模型配置构建组件并做同样的动态量化，再以 weights_only=True 加载权重，
+    缓存目录中的文件不会被当作任意pickle对象反序列化。
+    """
+    cache_dir = get_quantized_cache_dir(model_id)
+    components = {}
+    for name in QUANTIZED_COMPONENTS:
+        path = os.path.join(cache_dir, f"{name}.state_dict.pt")
+        if not os.path.exists(path):
+            return {}
+        try:
+            state_dict = torch.load(path, map_location="cpu", weights_only=True)
+            module = quantize_module(_build_component(model_id, name).eval())
+            module.load_state_dict(state_dict)
+            components[name] = module
+        except Exception as e:
+            print(f"⚠️ 量化缓存读取失败，将重新量化: {e}")
+            return {}
+    print(f"📦 已从缓存加载INT8量化组件: {cache_dir}")
+    return components
+
+def quantize_pipeline(pipeline, model_id):
+    """量化管道的文本编码器和UNet，并把结果写入磁盘缓存"""
+    cache_dir = get_quantized_cache_dir(model_id)
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    for name in QUANTIZED_COMPONENTS:
+        start = time.time()
+        quantized = quantize_module(getattr(pipeline, name).eval())
+        setattr(pipeline, name, quantized)
+        # 只保存量化后的state_dict：下次加载时不必读取fp32权重，读取时也不需要反序列化任意对象
+        tmp_path = os.path.join(cache_dir, f"{name}.state_dict.pt.tmp")
+        torch.save(quantized.state_dict(), tmp_path)
+        os.replace(tmp_path, os.path.join(cache_dir, f"{name}.state_dict.pt"))
+        print(f"⚙️ {name} INT8量化完成，耗时 {time.time() - start:.1f}s")
+    
+    return pipeline
+
+def _psnr(image_a, image_b):
+    """计算两张图像的PSNR"""
+    import numpy as np
+    a = np.asarray(image_a.convert("RGB"), dtype=np.float64)
+    b = np.asarray(image_b.convert("RGB"), dtype=np.float64)
+    mse = ((a - b) ** 2).mean()
+    if mse == 0:
+        return float("inf")
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+def compare_quantized(model_id, prompts, seeds, num_steps=20, width=512, height=512):
+    """在固定种子下对比fp32与INT8量化管道的输出质量和耗时"""
+    from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+    
+    def run(pipeline):
+        outputs = []
+        for prompt in prompts:
+            for seed in seeds:
+                generator = torch.Generator(device="cpu").manual_seed(seed)
+                start = time.time()
+                image = pipeline(prompt=prompt, num_inference_steps=num_steps, width=width, height=height,
+                                 generator=generator).images[0]
+                outputs.append((prompt, seed, image, time.time() - start))
+        return outputs
+    
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        model_id, torch_dtype=torch.float32, safety_checker=None, requires_safety_checker=False
+    )
+    pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
+    reference = run(pipeline)
+    quantized = run(quantize_pipeline(pipeline, model_id))
+    
+    results = []
+    for (prompt, seed, ref_image, ref_time), (_, _, q_image, q_time) in zip(reference, quantized):
+        results.append({
+            "prompt": prompt,
+            "seed": seed,
+            "psnr": _psnr(ref_image, q_image),
+            "fp32_seconds": ref_time,
+            "int8_seconds": q_time,
+        })
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="INT8量化质量检查：固定种子对比fp32与INT8输出")
+    parser.add_argument("--model", default="runwayml/stable-diffusion-v1-5")
+    parser.add_argument("--prompt", action="append", help="可多次指定")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--min-psnr", type=float, default=20.0, help="低于该PSNR视为质量不合格")
+    args = parser.parse_args()
+    
+    prompts = args.prompt or ["a beautiful landscape with mountains and lakes, highly detailed"]
+    results = compare_quantized(args.model, prompts, args.seeds, args.steps, args.size, args.size)
+    
+    print(f"{'seed':>6} | {'PSNR(dB)':>9} | {'fp32(s)':>8} | {'int8(s)':>8} | prompt")
+    for r in results:
+        print(f"{r['seed']:>6} | {r['psnr']:>9.2f} | {r['fp32_seconds']:>8.1f} | {r['int8_seconds']:>8.1f} | {r['prompt'][:40]}")
+    
+    failed = [r for r in results if r["psnr"] < args.min_psnr]
+    if failed:
+        print(f"❌ {len(failed)}/{len(results)} 个样本PSNR低于 {args.min_psnr} dB")
+        raise SystemExit(1)
+    print(f"✅ 所有样本PSNR均不低于 {args.min_psnr} dB")
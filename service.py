@@ -0,0 +1,195 @@
+"""
+生成服务模块 - 无界面的JSON/HTTP生成接口，可独立运行或挂载在Gradio界面旁
+"""
+
+import io
+import json
+import base64
+from contextlib import nullcontext
+from urllib.parse import quote
+from PIL import Image
+from config import SERVICE_CONFIG, CONTROLNET_TYPES
+from concurrency import limited, is_accepting, observe_queue_wait, ShuttingDown
+from image_generation import generate_image, generate_img2img, generate_controlnet_image
+from metrics import render_prometheus, stage
+from tracing import span
+from profiling import profile_request
+from image_store import sniff_format
+from session import create_session
+
+# 生成服务自己的会话：由 load_service_models 加载模型，界面用户加载其他模型不影响服务请求
+_service_session = create_session()
+
+def load_service_models(run_mode, model, controlnet="canny", api_token="", local_backend="pytorch"):
+    """为生成服务的会话加载模型，返回加载状态"""
+    from models import load_models
+    return load_models(run_mode, model, controlnet, api_token, local_backend, session=_service_session)
+
+def decode_image(image_b64):
+    """解码请求中的base64图像（允许带data URI前缀）"""
+    if not image_b64:
+        return None
+    if image_b64.startswith("data:"):
+        image_b64 = image_b64.split(",", 1)[1]
+    return Image.open(io.BytesIO(base64.b64decode(image_b64))).convert("RGB")
+
+def encode_png(image):
+    """把生成结果编码为PNG（低压缩等级，编码更快）"""
+    with stage("output_encode"):
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG", compress_level=1)
+        return buffered.getvalue()
+
+def encode_response(image):
+    """生成结果编码为响应内容，返回 (字节, 媒体类型)：上游已编码的字节能识别格式时原样返回，不再解码重编码"""
+    if isinstance(image, bytes):
+        ext = sniff_format(image)
+        if ext is not None:
+            return image, "image/jpeg" if ext == "jpg" else f"image/{ext}"
+        image = Image.open(io.BytesIO(image))
+    return encode_png(image), "image/png"
+
+def _common_params(body):
+    """读取三种生成接口共用的参数"""
+    return {
+        "prompt": str(body.get("prompt", "")),
+        "negative_prompt": str(body.get("negative_prompt", "")),
+        "num_steps": int(body.get("num_steps", 20)),
+        "guidance_scale": float(body.get("guidance_scale", 7.5)),
+        "width": int(body.get("width", 512)),
+        "height": int(body.get("height", 512)),
+        "seed": int(body.get("seed", -1)),
+    }
+
+def run_txt2img(body, session):
+    """文生图接口，返回 (图像, 状态)，API模式下图像为上游返回的编码字节"""
+    p = _common_params(body)
+    return limited()(generate_image)(p["prompt"], p["negative_prompt"], p["num_steps"], p["guidance_scale"],
+                                     p["width"], p["height"], p["seed"], output="bytes", session=session)
+
+def run_img2img(body, session):
+    """图生图接口，返回 (图像, 状态)，API模式下图像为上游返回的编码字节"""
+    p = _common_params(body)
+    input_image = decode_image(body.get("image"))
+    return limited()(generate_img2img)(p["prompt"], p["negative_prompt"], input_image, float(body.get("strength", 0.7)),
+                                       p["num_steps"], p["guidance_scale"], p["width"], p["height"], p["seed"], output="bytes", session=session)
+
+def run_controlnet(body, session):
+    """ControlNet接口，返回 (图像, 状态)，API模式下图像为上游返回的编码字节"""
+    p = _common_params(body)
+    control_image = decode_image(body.get("image"))
+    control_type = body.get("control_type", "canny")
+    if control_type not in CONTROLNET_TYPES:
+        return None, f"❌ 不支持的ControlNet类型: {control_type}"
+    image, _, status = limited()(generate_controlnet_image)(
+        p["prompt"], p["negative_prompt"], control_image, control_type, p["num_steps"], p["guidance_scale"],
+        float(body.get("controlnet_conditioning_scale", 1.0)), p["width"], p["height"], p["seed"], output="bytes", session=session
+    )
+    return image, status
+
+# 路由名 -> 处理函数
+ENDPOINTS = {
+    "txt2img": run_txt2img,
+    "img2img": run_img2img,
+    "controlnet": run_controlnet,
+}
+
+def create_service_app(app=None):
+    """创建（或在已有FastAPI应用上注册）生成服务路由"""
+    from fastapi import FastAPI, Request
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import JSONResponse, Response
+    
+    app = app or FastAPI(title="AI 图像生成服务")
+    prefix = SERVICE_CONFIG["prefix"]
+    
+    async def handle(name, request):
+        # 每个请求一个trace，trace ID通过响应头返回，便于在追踪文件中定位慢请求
+        with span(f"POST {prefix}/{name}") as root:
+            response = await _handle(name, request)
+        if root is not None:
+            response.headers["X-Trace-Id"] = root["trace_id"]
+        return response
+    
+    async def _handle(name, request):
+        # 先按Content-Length拒绝过大的请求，不读入请求体；分块传输等没有该头的请求读取后再检查
+        try:
+            declared_length = int(request.headers.get("content-length", 0))
+        except ValueError:
+            return JSONResponse({"error": "invalid Content-Length"}, status_code=400)
+        if declared_length > SERVICE_CONFIG["max_body_bytes"]:
+            return JSONResponse({"error": "request body too large"}, status_code=413)
+        body_bytes = await request.body()
+        if len(body_bytes) > SERVICE_CONFIG["max_body_bytes"]:
+            return JSONResponse({"error": "request body too large"}, status_code=413)
+        try:
+            body = json.loads(body_bytes)
+        except ValueError:
+            return JSONResponse({"error": "invalid JSON body"}, status_code=400)
+        if not isinstance(body, dict):
+            return JSONResponse({"error": "JSON body must be an object"}, status_code=400)
+        
+        # 请求头 X-Profile: 1 或请求体 "profile": true 时剖析本次生成
+        profile = request.headers.get("x-profile", "").lower() in ("1", "true", "yes") or bool(body.get("profile"))
+        try:
+            with profile_request() if profile else nullcontext({}) as profile_capture, observe_queue_wait() as queue_wait:
+                # 生成是阻塞操作，放到线程池中执行
+                image, status = await run_in_threadpool(ENDPOINTS[name], body, _service_session)
+        except ShuttingDown as e:
+            # 关闭过程中拒绝新任务，提示负载均衡/客户端重试其他实例
+            return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "1"})
+        except (ValueError, TypeError, OSError) as e:
+            return JSONResponse({"error": f"invalid parameters: {e}"}, status_code=400)
+        
+        if image is None:
+            return JSONResponse({"error": status}, status_code=422)
+        content, media_type = await run_in_threadpool(encode_response, image)
+        # 状态文本含中文和emoji，放入响应头前需要URL编码
+        headers = {"X-Generation-Status": quote(status)}
+        if "waited" in queue_wait:
+            # 在生成通道中的排队等待，压测工具据此区分排队和生成耗时
+            headers["X-Queue-Wait-Ms"] = f"{queue_wait['waited'] * 1000:.1f}"
+        if profile_capture.get("id"):
+            headers["X-Profile-Id"] = profile_capture["id"]
+        return Response(content=content, media_type=media_type, headers=headers)
+    
+    for name in ENDPOINTS:
+        async def endpoint(request: Request, _name=name):
+            return await handle(_name, request)
+        app.add_api_route(f"{prefix}/{name}", endpoint, methods=["POST"], name=name)
+    
+    @app.get(f"{prefix}/health")
+    def health():
+        status = {"loaded": _service_session["loaded"], "mode": _service_session["run_mode"],
+                  "model": _service_session["model"], "accepting": is_accepting()}
+        # 关闭中返回503，负载均衡据此摘除实例
+        return JSONResponse(status, status_code=200 if status["accepting"] else 503)
+    
+    @app.get("/metrics")
+    def metrics():
+        # Prometheus抓取端点：各阶段耗时直方图、缓存命中和API响应状态计数
+        return Response(content=render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+    
+    return app
+
+if __name__ == "__main__":
+    import argparse
+    import uvicorn
+    
+    parser = argparse.ArgumentParser(description="无界面AI图像生成HTTP服务")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7870)
+    parser.add_argument("--mode", choices=["api", "local"], default="api")
+    parser.add_argument("--model", default="runwayml/stable-diffusion-v1-5")
+    parser.add_argument("--controlnet", choices=list(CONTROLNET_TYPES.keys()), default="canny")
+    parser.add_argument("--token", default="", help="Hugging Face API Token")
+    parser.add_argument("--backend", default="pytorch", help="本地推理后端")
+    args = parser.parse_args()
+    
+    print(load_service_models(args.mode, args.model, args.controlnet, args.token, args.backend))
+    from shutdown import graceful_shutdown
+    try:
+        # uvicorn收到SIGTERM后停止接收连接并等待进行中的请求完成，退出后再释放模型
+        uvicorn.run(create_service_app(), host=args.host, port=args.port)
+    finally:
+        graceful_shutdown("服务退出")
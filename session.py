@@ -0,0 +1,48 @@
+"""
+会话模块 - 每个界面会话独立保存运行模式、模型、ControlNet类型、API Token和代理设置
+
+生成函数和API客户端都从会话字典读取这些设置，一个用户加载模型、修改Token或代理
+不会影响其他用户正在进行的请求。生成服务、批量生成等调用方各自创建自己的会话；
+未传入会话的调用使用由进程级全局设置构造的默认会话，只有不带会话调用 load_models 时才会改变它。
+"""
+
+from config import DEFAULT_RUN_MODE, PROXY_CONFIG
+
+def create_session(run_mode=DEFAULT_RUN_MODE, model="runwayml/stable-diffusion-v1-5", controlnet="canny",
+                   api_token="", proxy=None, local_backend="pytorch"):
+    """创建新的会话字典"""
+    return {
+        "run_mode": run_mode,
+        "model": model,
+        "controlnet": controlnet,
+        "api_token": api_token,
+        "proxy": dict(proxy) if proxy else {"enabled": False, "http": None, "https": None},
+        "local_backend": local_backend,
+        # 是否已通过 load_models 为该会话加载（配置）模型
+        "loaded": False,
+    }
+
+def default_session():
+    """由进程级全局设置构造会话，供没有界面会话的调用方使用"""
+    import models
+    import api_client
+    return {
+        "run_mode": models.RUN_MODE,
+        "model": models.current_model,
+        "controlnet": models.current_controlnet,
+        "api_token": api_client.HF_API_TOKEN or "",
+        "proxy": dict(PROXY_CONFIG),
+        "local_backend": models.LOCAL_BACKEND,
+        "loaded": models.pipe is not None,
+    }
+
+def resolve_session(session):
+    """未传入会话时使用默认会话"""
+    return session if session is not None else default_session()
+
+def find_session(args, kwargs):
+    """从处理函数参数中找出会话字典（关键字参数session或最后一个位置参数）"""
+    session = kwargs.get("session")
+    if session is None and args and isinstance(args[-1], dict) and "run_mode" in args[-1]:
+        session = args[-1]
+    return session
@@ -0,0 +1,120 @@
+"""
+关闭协调模块 - 停止接收新任务，在期限内排空或中止进行中的生成，只释放一次管道和端口
+"""
+
+import os
+import sys
+import time
+import signal
+import atexit
+import threading
+from config import SHUTDOWN_CONFIG
+from concurrency import stop_accepting, request_cancel, wait_until_idle
+
+_shutdown_lock = threading.Lock()
+_shutdown_started = False
+_shutdown_finished = threading.Event()
+
+def is_shutting_down():
+    """关闭流程是否已开始"""
+    return _shutdown_started
+
+def _close_server():
+    """关闭Gradio服务器，释放监听端口"""
+    # 只有启动过界面时utils才会记录Gradio实例
+    utils = sys.modules.get("utils")
+    demo = getattr(utils, "demo_instance", None)
+    if demo is None:
+        return
+    try:
+        if getattr(demo, "server", None):
+            demo.server.should_exit = True
+        demo.close()
+        print("📴 Gradio应用已关闭")
+    except Exception as e:
+        print(f"⚠️ 关闭Gradio应用时出现错误: {e}")
+
+def _release_models():
+    """释放已加载的模型管道"""
+    try:
+        from models import unload_models
+        unload_models()
+    except Exception as e:
+        print(f"⚠️ 释放模型时出现错误: {e}")
+
+def _stop_job_workers(timeout):
+    """停止本进程启动的后台任务工作进程"""
+    # 只有导入过任务队列（界面或批量工具启动了工作进程）时才需要停止
+    job_queue = sys.modules.get("job_queue")
+    if job_queue is None or not job_queue._worker_processes:
+        return
+    try:
+        print("🧵 等待后台任务工作进程结束当前任务...")
+        job_queue.stop_workers(timeout=timeout)
+    except Exception as e:
+        print(f"⚠️ 停止后台任务工作进程时出现错误: {e}")
+
+def graceful_shutdown(reason="", drain_timeout=None):
+    """
+    优雅关闭：停止接收新任务 → 等待进行中的任务完成（超时则要求在下一步中止）→ 关闭服务器 → 停止后台任务工作进程 → 释放模型。
+    多次调用（atexit、信号处理、finally）只执行一次，后续调用等待首次调用完成后返回。
+    """
+    global _shutdown_started
+    with _shutdown_lock:
+        if _shutdown_started:
+            first = False
+        else:
+            _shutdown_started = True
+            first = True
+    if not first:
+        _shutdown_finished.wait(SHUTDOWN_CONFIG["drain_timeout"] + SHUTDOWN_CONFIG["cancel_timeout"] + 5)
+        return
+    
+    start = time.monotonic()
+    try:
+        print(f"\n🔄 正在优雅关闭{f'（{reason}）' if reason else ''}...")
+        stop_accepting()
+        
+        if drain_timeout is None:
+            drain_timeout = SHUTDOWN_CONFIG["drain_timeout"]
+        if not wait_until_idle(0):
+            print(f"⏳ 等待进行中的任务完成（最长 {drain_timeout:g}s）...")
+            if not wait_until_idle(drain_timeout):
+                print("⏹️ 等待超时，要求进行中的生成在下一步中止")
+                request_cancel()
+                if not wait_until_idle(SHUTDOWN_CONFIG["cancel_timeout"]):
+                    print("⚠️ 仍有任务未结束，直接释放资源")
+        
+        _close_server()
+        _stop_job_workers(drain_timeout)
+        _release_models()
+        # 写出关闭前结束的请求追踪
+        from tracing import flush
+        flush()
+        print(f"✅ 资源清理完成，用时 {time.monotonic() - start:.2f}s")
+    except Exception as e:
+        print(f"❌ 清理过程中出现错误: {e}")
+    finally:
+        _shutdown_finished.set()
+
+def _signal_handler(signum, frame):
+    """信号处理：首次信号优雅关闭，关闭过程中再次收到信号则立即退出"""
+    signal_names = {
+        signal.SIGINT: "SIGINT (Ctrl+C)",
+        signal.SIGTERM: "SIGTERM (终止信号)"
+    }
+    signal_name = signal_names.get(signum, f"信号 {signum}")
+    
+    if is_shutting_down():
+        print(f"\n🛑 再次收到 {signal_name}，立即退出")
+        os._exit(1)
+    
+    print(f"\n🛑 接收到退出信号: {signal_name}")
+    graceful_shutdown(signal_name)
+    sys.exit(0)
+
+def install_shutdown_handlers():
+    """注册SIGINT/SIGTERM信号处理和atexit清理（重复注册也只会关闭一次）"""
+    signal.signal(signal.SIGINT, _signal_handler)
+    signal.signal(signal.SIGTERM, _signal_handler)
+    atexit.register(graceful_shutdown)
@@ -0,0 +1,134 @@
+"""
+通道并发控制测试：按到达顺序分配槽位、排队位置、放弃排队和借用空闲槽位
+"""
+
+import threading
+
+import pytest
+
+import concurrency
+from config import QUEUE_CONFIG
+
+LANE = "api"
+
+@pytest.fixture(autouse=True)
+def single_slot_lane(monkeypatch):
+    """api通道只有一个槽位，便于制造排队"""
+    monkeypatch.setitem(QUEUE_CONFIG["limits"], LANE, 1)
+    monkeypatch.setitem(QUEUE_CONFIG, "position_update_interval", 0.05)
+    yield
+    assert not concurrency._lane_waiters[LANE]
+    assert concurrency.get_queue_status()[LANE]["running"] == 0
+
+def _queue(order, name, entered=None, release=None):
+    def run():
+        with concurrency.lane_slot(LANE):
+            order.append(name)
+            if entered is not None:
+                entered.set()
+            if release is not None:
+                release.wait(5)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def _wait_for_waiters(count):
+    with concurrency._idle_condition:
+        assert concurrency._idle_condition.wait_for(lambda: len(concurrency._lane_waiters[LANE]) == count, 5)
+
+def test_slots_are_granted_in_arrival_order():
+    order = []
+    entered, release = threading.Event(), threading.Event()
+    first = _queue(order, "first", entered, release)
+    assert entered.wait(5)
+    waiters = []
+    for i in range(5):
+        waiters.append(_queue(order, i))
+        _wait_for_waiters(i + 1)
+    assert concurrency.get_queue_status()[LANE]["waiting"] == 5
+    release.set()
+    for thread in [first] + waiters:
+        thread.join(5)
+    assert order == ["first", 0, 1, 2, 3, 4]
+
+def test_slot_reports_position_and_wait():
+    entered, release = threading.Event(), threading.Event()
+    holder = _queue([], "holder", entered, release)
+    assert entered.wait(5)
+    slots = []
+    def run():
+        with concurrency.lane_slot(LANE) as slot:
+            slots.append(slot)
+    waiter = threading.Thread(target=run, daemon=True)
+    waiter.start()
+    _wait_for_waiters(1)
+    release.set()
+    holder.join(5)
+    waiter.join(5)
+    assert slots[0]["lane"] == LANE
+    assert slots[0]["position"] == 1
+    assert slots[0]["waited"] > 0
+
+def test_queued_generator_yields_live_position(monkeypatch):
+    gr = pytest.importorskip("gradio")
+    entered, release = threading.Event(), threading.Event()
+    holder = _queue([], "holder", entered, release)
+    assert entered.wait(5)
+
+    @concurrency.limited(LANE, outputs=2)
+    def handler():
+        yield ("image", "done")
+
+    results = handler()
+    update = next(results)
+    assert len(update) == 2
+    assert update[1].startswith("⏳ 排队中：第 1 位")
+    release.set()
+    holder.join(5)
+    assert list(results)[-1] == ("image", "done")
+
+def test_abandoned_waiter_leaves_the_queue(monkeypatch):
+    monkeypatch.setattr(concurrency, "_queue_update", lambda ticket, outputs: ("update", concurrency.queue_position(ticket)))
+    entered, release = threading.Event(), threading.Event()
+    holder = _queue([], "holder", entered, release)
+    assert entered.wait(5)
+
+    @concurrency.limited(LANE, outputs=2)
+    def handler():
+        yield ("image", "done")
+
+    results = handler()
+    assert next(results) == ("update", 1)
+    # 调用方断开（停止迭代）
+    results.close()
+    assert not concurrency._lane_waiters[LANE]
+    order = []
+    release.set()
+    holder.join(5)
+    _queue(order, "next").join(5)
+    assert order == ["next"]
+
+def test_spare_slots_only_borrow_idle_capacity(monkeypatch):
+    monkeypatch.setitem(QUEUE_CONFIG["limits"], LANE, 3)
+    with concurrency.lane_slot(LANE):
+        with concurrency.spare_lane_slots(LANE, 5) as spare:
+            assert spare == 2
+            assert concurrency.get_queue_status()[LANE]["running"] == 3
+        entered, release = threading.Event(), threading.Event()
+        other = _queue([], "other", entered, release)
+        assert entered.wait(5)
+        # 有请求排队时不借用
+        monkeypatch.setitem(QUEUE_CONFIG["limits"], LANE, 2)
+        waiter = _queue([], "waiter")
+        _wait_for_waiters(1)
+        with concurrency.spare_lane_slots(LANE, 1) as spare:
+            assert spare == 0
+        release.set()
+        other.join(5)
+        waiter.join(5)
+
+def test_shutdown_rejects_new_work(monkeypatch):
+    monkeypatch.setattr(concurrency, "_accepting", False)
+    with pytest.raises(concurrency.ShuttingDown):
+        with concurrency.lane_slot(LANE):
+            pass
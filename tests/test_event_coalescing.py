@@ -0,0 +1,83 @@
+"""
+事件合并测试：被同一会话新调用取代的旧调用结果被丢弃，登记只保存进行中的调用
+"""
+
+import threading
+
+import pytest
+
+import event_coalescing
+from event_coalescing import superseded
+
+def test_latest_call_tracking():
+    key = ("tags", "s1")
+    first = event_coalescing._next_call_id(key)
+    second = event_coalescing._next_call_id(key)
+    assert second > first
+    assert not event_coalescing._is_latest(key, first)
+    assert event_coalescing._is_latest(key, second)
+    # 旧调用结束不会删除新调用的登记
+    event_coalescing._finish_call(key, first)
+    assert event_coalescing._is_latest(key, second)
+    event_coalescing._finish_call(key, second)
+    assert key not in event_coalescing._latest_calls
+
+def test_superseded_outside_handler_is_false():
+    assert superseded() is False
+
+@pytest.fixture
+def gr():
+    return pytest.importorskip("gradio")
+
+def _request(gr, session_hash):
+    request = gr.Request.__new__(gr.Request)
+    try:
+        request.session_hash = session_hash
+    except AttributeError:
+        pytest.skip("当前Gradio版本的Request不允许设置session_hash")
+    return request
+
+def _blocking_handler(gr, key, entered, release, seen):
+    @event_coalescing.coalesce(key)
+    def handler(value):
+        entered.set()
+        release.wait(5)
+        seen.append(superseded())
+        return value
+    return handler
+
+def test_superseded_call_returns_no_change(gr):
+    entered, release, seen, results = threading.Event(), threading.Event(), [], []
+    handler = _blocking_handler(gr, "test-supersede", entered, release, seen)
+    slow = threading.Thread(target=lambda: results.append(handler("old", _request(gr, "s1"))), daemon=True)
+    slow.start()
+    assert entered.wait(5)
+
+    fast_handler = event_coalescing.coalesce("test-supersede")(lambda value: value)
+    assert fast_handler("new", _request(gr, "s1")) == "new"
+    release.set()
+    slow.join(5)
+    assert seen == [True]
+    assert results[0] != "old"
+    assert not event_coalescing._latest_calls
+
+def test_sessions_do_not_supersede_each_other(gr):
+    entered, release, seen, results = threading.Event(), threading.Event(), [], []
+    handler = _blocking_handler(gr, "test-sessions", entered, release, seen)
+    slow = threading.Thread(target=lambda: results.append(handler("mine", _request(gr, "s1"))), daemon=True)
+    slow.start()
+    assert entered.wait(5)
+    other = event_coalescing.coalesce("test-sessions")(lambda value: value)
+    assert other("theirs", _request(gr, "s2")) == "theirs"
+    release.set()
+    slow.join(5)
+    assert seen == [False]
+    assert results == ["mine"]
+
+def test_request_parameter_is_exposed_to_gradio(gr):
+    handler = event_coalescing.coalesce("test-signature", outputs=2)(lambda a, b: (a, b))
+    parameters = list(handler.__signature__.parameters.values())
+    assert [p.name for p in parameters] == ["a", "b", "request"]
+    assert parameters[-1].annotation is gr.Request
+    # 没有请求对象时按全局会话处理
+    assert handler(1, 2) == (1, 2)
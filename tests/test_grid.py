@@ -0,0 +1,47 @@
+"""
+参数网格测试：取值解析和网格展开
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from image_generation import parse_grid_values, _grid_cells, _format_grid_value
+
+def test_unused_axis_has_single_empty_value():
+    assert parse_grid_values(None, "1,2") == [None]
+    assert parse_grid_values("none", "") == [None]
+
+def test_values_are_cast_per_parameter():
+    assert parse_grid_values("num_steps", "10, 20.0,30") == [10, 20, 30]
+    assert parse_grid_values("guidance_scale", "5,7.5") == [5.0, 7.5]
+    # 全角逗号和空项
+    assert parse_grid_values("seed", "1，2,, 3 ") == [1, 2, 3]
+
+def test_invalid_values_are_rejected():
+    with pytest.raises(ValueError):
+        parse_grid_values("width", "512")
+    with pytest.raises(ValueError):
+        parse_grid_values("num_steps", " , ")
+    with pytest.raises(ValueError):
+        parse_grid_values("num_steps", "abc")
+
+def test_grid_cells_are_row_major():
+    base = {"num_steps": 20, "guidance_scale": 7.5, "seed": 1}
+    cells = _grid_cells(base, "guidance_scale", [5.0, 9.0], "seed", [1, 2, 3])
+    assert [(row, col) for row, col, _ in cells] == [(r, c) for r in range(3) for c in range(2)]
+    assert cells[0][2] == {"num_steps": 20, "guidance_scale": 5.0, "seed": 1}
+    assert cells[-1][2] == {"num_steps": 20, "guidance_scale": 9.0, "seed": 3}
+    # 基础参数不被修改
+    assert base == {"num_steps": 20, "guidance_scale": 7.5, "seed": 1}
+
+def test_single_axis_and_no_axis():
+    cells = _grid_cells({"seed": 1}, "seed", [4, 5], "none", [None])
+    assert [params["seed"] for _, _, params in cells] == [4, 5]
+    assert _grid_cells({"seed": 1}, "none", [None], "none", [None]) == [(0, 0, {"seed": 1})]
+
+def test_grid_value_labels():
+    assert _format_grid_value("guidance_scale", 7.50) == "引导强度=7.5"
+    assert _format_grid_value("num_steps", 20) == "采样步数=20"
+    assert _format_grid_value("seed", None) == ""
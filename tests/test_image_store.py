@@ -0,0 +1,62 @@
+"""
+输出存储测试：按内容哈希去重保存，超过上限时清理最旧的文件
+"""
+
+import os
+
+import pytest
+
+import image_store
+from config import OUTPUT_CONFIG
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"payload"
+
+@pytest.fixture(autouse=True)
+def output_dir(monkeypatch, tmp_path):
+    monkeypatch.setitem(OUTPUT_CONFIG, "dir", str(tmp_path))
+    monkeypatch.setattr(image_store, "_stores_since_prune", 0)
+    return tmp_path
+
+def test_sniff_format():
+    assert image_store.sniff_format(PNG) == "png"
+    assert image_store.sniff_format(b"\xff\xd8\xff\xe0") == "jpg"
+    assert image_store.sniff_format(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "webp"
+    assert image_store.sniff_format(b"not an image") is None
+
+def test_same_content_is_stored_once(output_dir):
+    path = image_store.store_bytes(PNG, "png")
+    assert path.endswith(".png")
+    # 两位哈希前缀作为子目录
+    name = os.path.basename(path)
+    assert os.path.dirname(path) == os.path.join(str(output_dir), name[:2])
+    with open(path, "rb") as f:
+        assert f.read() == PNG
+
+    os.utime(path, (1, 1))
+    assert image_store.store_bytes(PNG, "png") == path
+    # 命中时刷新修改时间，避免刚返回的文件被当成最旧的清理掉
+    assert os.path.getmtime(path) > 1
+    assert image_store.store_bytes(PNG + b"!", "png") != path
+    assert not [name for _, _, files in os.walk(output_dir) for name in files if name.endswith(".tmp")]
+
+def test_prune_removes_oldest_files(monkeypatch):
+    paths = []
+    for i in range(5):
+        path = image_store.store_bytes(PNG + bytes([i]), "png")
+        os.utime(path, (1000 + i, 1000 + i))
+        paths.append(path)
+    monkeypatch.setitem(OUTPUT_CONFIG, "max_files", 3)
+    image_store._maybe_prune(every=1)
+    assert [os.path.exists(path) for path in paths] == [False, False, True, True, True]
+
+def test_prune_runs_every_n_stores(monkeypatch):
+    first = image_store.store_bytes(PNG + b"1", "png")
+    os.utime(first, (1, 1))
+    image_store.store_bytes(PNG + b"2", "png")
+    monkeypatch.setitem(OUTPUT_CONFIG, "max_files", 1)
+    monkeypatch.setattr(image_store, "_stores_since_prune", 0)
+    image_store._maybe_prune(every=2)
+    # 计数未到时不清理
+    assert os.path.exists(first)
+    image_store._maybe_prune(every=2)
+    assert not os.path.exists(first)
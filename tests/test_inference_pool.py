@@ -0,0 +1,55 @@
+"""
+推理进程池测试：图像经共享内存在调度器和工作进程之间传递
+"""
+
+from multiprocessing import shared_memory
+
+import pytest
+
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+import inference_pool
+
+@pytest.fixture
+def segment():
+    shm = shared_memory.SharedMemory(create=True, size=64 * 64 * 3 * 2)
+    yield shm
+    shm.close()
+    shm.unlink()
+
+def _image(width, height, color):
+    return Image.new("RGB", (width, height), color)
+
+def test_pack_round_trip_keeps_order_and_values(segment):
+    first, second = _image(32, 16, (255, 0, 0)), _image(8, 24, (0, 0, 255))
+    values = [first, "✅ 生成完成", 42, second, None]
+    packed = inference_pool._pack(values, segment)
+    assert [tag for tag, _ in packed] == ["image", "value", "value", "image", "value"]
+    # 第二张图像紧接在第一张之后
+    assert packed[0][1] == (0, 16, 32)
+    assert packed[3][1] == (32 * 16 * 3, 24, 8)
+
+    unpacked = inference_pool._unpack(packed, segment)
+    assert unpacked[1:3] == ["✅ 生成完成", 42]
+    assert unpacked[4] is None
+    assert unpacked[0].size == (32, 16) and unpacked[0].getpixel((5, 5)) == (255, 0, 0)
+    assert unpacked[3].size == (8, 24) and unpacked[3].getpixel((7, 23)) == (0, 0, 255)
+
+def test_images_are_converted_to_rgb(segment):
+    gray = Image.new("L", (4, 4), 128)
+    (tag, meta), = inference_pool._pack([gray], segment)
+    image, = inference_pool._unpack([(tag, meta)], segment)
+    assert image.mode == "RGB"
+    assert image.getpixel((0, 0)) == (128, 128, 128)
+
+def test_unpacked_images_are_copies(segment):
+    packed = inference_pool._pack([_image(4, 4, (1, 2, 3))], segment)
+    image, = inference_pool._unpack(packed, segment)
+    # 共享内存被下一次请求覆盖后，已取出的图像不变
+    inference_pool._pack([_image(4, 4, (9, 9, 9))], segment)
+    assert image.getpixel((0, 0)) == (1, 2, 3)
+
+def test_oversized_image_is_rejected(segment):
+    with pytest.raises(ValueError):
+        inference_pool._pack([_image(128, 128, (0, 0, 0))], segment)
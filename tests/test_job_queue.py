@@ -0,0 +1,178 @@
+"""
+任务队列状态机测试：领取、心跳超时重新排队、按执行者记录结果、取消、批量去重和结果保留期限
+"""
+
+import os
+import json
+import time
+from contextlib import closing
+
+import pytest
+
+import job_queue
+from config import JOB_QUEUE_CONFIG
+
+SESSION = {"run_mode": "api", "model": "runwayml/stable-diffusion-v1-5", "controlnet": "canny",
+           "api_token": "hf_secret", "proxy": "", "local_backend": "pytorch", "loaded": True}
+
+@pytest.fixture(autouse=True)
+def job_db(tmp_path, monkeypatch):
+    """每个测试使用临时目录中的任务数据库"""
+    monkeypatch.setitem(JOB_QUEUE_CONFIG, "path", str(tmp_path / "jobs" / "jobs.sqlite3"))
+    return tmp_path
+
+def _submit(prompt="a cat", **kwargs):
+    return job_queue.submit_job("txt2img", {"prompt": prompt}, SESSION, **kwargs)
+
+def _stored_session(job_id):
+    with closing(job_queue._connect()) as conn:
+        return json.loads(conn.execute("SELECT session FROM jobs WHERE id = ?", (job_id,)).fetchone()["session"])
+
+def _expire_heartbeat(job_id):
+    """模拟执行中任务的工作进程崩溃：心跳早于 stale_after"""
+    with closing(job_queue._connect()) as conn:
+        conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?",
+                     (time.time() - JOB_QUEUE_CONFIG["stale_after"] - 1, job_id))
+
+def test_claim_returns_oldest_queued_job_with_token():
+    first = _submit("first")
+    _submit("second")
+    job = job_queue.claim_job("w1")
+    assert job["id"] == first
+    assert job["state"] == "running"
+    assert job["worker"] == "w1"
+    assert job["attempts"] == 1
+    assert job["session"]["api_token"] == "hf_secret"
+    # 查询接口不返回Token
+    assert "api_token" not in job_queue.get_job(first)["session"]
+
+def test_claim_without_queued_jobs_returns_none():
+    assert job_queue.claim_job("w1") is None
+    job_id = _submit()
+    job_queue.claim_job("w1")
+    assert job_queue.claim_job("w2") is None
+    assert job_queue.get_job(job_id)["worker"] == "w1"
+
+def test_finish_by_owner_records_result_and_clears_token():
+    job_id = _submit()
+    job_queue.claim_job("w1")
+    assert job_queue.finish_job(job_id, "w1", "succeeded", result="/tmp/out.png", message="ok")
+    job = job_queue.get_job(job_id)
+    assert job["state"] == "succeeded"
+    assert job["result"] == "/tmp/out.png"
+    assert job["finished_at"] is not None
+    assert "api_token" not in _stored_session(job_id)
+
+def test_finish_by_other_worker_is_rejected():
+    job_id = _submit()
+    job_queue.claim_job("w1")
+    assert not job_queue.finish_job(job_id, "w2", "succeeded", result="/tmp/other.png")
+    job = job_queue.get_job(job_id)
+    assert job["state"] == "running"
+    assert job["result"] is None
+    assert _stored_session(job_id)["api_token"] == "hf_secret"
+
+def test_finish_twice_is_rejected():
+    job_id = _submit()
+    job_queue.claim_job("w1")
+    assert job_queue.finish_job(job_id, "w1", "failed", message="boom")
+    assert not job_queue.finish_job(job_id, "w1", "succeeded", result="/tmp/out.png")
+    assert job_queue.get_job(job_id)["state"] == "failed"
+
+def test_stale_job_is_requeued_and_late_result_dropped():
+    job_id = _submit()
+    job_queue.claim_job("w1")
+    _expire_heartbeat(job_id)
+    assert job_queue.requeue_stale_jobs() == 1
+    job = job_queue.get_job(job_id)
+    assert job["state"] == "queued"
+    assert job["worker"] is None
+
+    retry = job_queue.claim_job("w2")
+    assert retry["id"] == job_id
+    assert retry["attempts"] == 2
+    # 原工作进程迟到的结果不能覆盖新一次执行
+    assert not job_queue.finish_job(job_id, "w1", "succeeded", result="/tmp/late.png")
+    assert job_queue.finish_job(job_id, "w2", "succeeded", result="/tmp/retry.png")
+    assert job_queue.get_job(job_id)["result"] == "/tmp/retry.png"
+
+def test_fresh_heartbeat_is_not_requeued():
+    job_id = _submit()
+    job_queue.claim_job("w1")
+    assert job_queue.requeue_stale_jobs() == 0
+    assert job_queue.get_job(job_id)["state"] == "running"
+
+def test_stale_job_fails_after_max_attempts(monkeypatch):
+    monkeypatch.setitem(JOB_QUEUE_CONFIG, "max_attempts", 1)
+    job_id = _submit()
+    job_queue.claim_job("w1")
+    _expire_heartbeat(job_id)
+    assert job_queue.requeue_stale_jobs() == 1
+    job = job_queue.get_job(job_id)
+    assert job["state"] == "failed"
+    assert "api_token" not in _stored_session(job_id)
+
+def test_cancel_only_queued_jobs():
+    queued = _submit("queued")
+    running = _submit("running")
+    with closing(job_queue._connect()) as conn:
+        # 让 running 先被领取
+        conn.execute("UPDATE jobs SET created_at = created_at - 10 WHERE id = ?", (running,))
+    assert job_queue.claim_job("w1")["id"] == running
+    assert not job_queue.cancel_job(running)
+    assert job_queue.cancel_job(queued)
+    assert job_queue.get_job(queued)["state"] == "cancelled"
+    assert job_queue.claim_job("w2") is None
+
+def test_batch_resubmit_returns_existing_job():
+    job_id = _submit(batch="b1", client_id="cat-001")
+    assert _submit(batch="b1", client_id="cat-001") == job_id
+    assert _submit(batch="b1", client_id="cat-002") != job_id
+    # 失败的任务重新提交时创建新任务
+    job_queue.claim_job("w1")
+    job_queue.finish_job(job_id, "w1", "failed", message="boom")
+    assert _submit(batch="b1", client_id="cat-001") != job_id
+
+def test_submit_rejects_unknown_kind_and_missing_image():
+    with pytest.raises(ValueError):
+        job_queue.submit_job("upscale", {"prompt": "a cat"}, SESSION)
+    with pytest.raises(ValueError):
+        job_queue.submit_job("img2img", {"prompt": "a cat"}, SESSION)
+
+def _finish_with_result(job_db, name, finished_at):
+    job_id = _submit(name)
+    job = job_queue.claim_job("w1")
+    source = job_db / f"{name}.png"
+    source.write_bytes(b"png")
+    result = job_queue._keep_result(job, str(source))
+    job_queue.finish_job(job_id, "w1", "succeeded", result=result, message="✅ ok")
+    with closing(job_queue._connect()) as conn:
+        conn.execute("UPDATE jobs SET finished_at = ? WHERE id = ?", (finished_at, job_id))
+    return job_id, result
+
+def test_expired_results_are_pruned(job_db, monkeypatch):
+    monkeypatch.setitem(JOB_QUEUE_CONFIG, "result_retention", 3600)
+    old_id, old_result = _finish_with_result(job_db, "old", time.time() - 7200)
+    new_id, new_result = _finish_with_result(job_db, "new", time.time())
+    # 执行中崩溃留下的、没有任务引用的旧文件
+    orphan = job_db / "jobs" / "results" / "orphan-1.png"
+    orphan.write_bytes(b"png")
+    stale = time.time() - 7200
+    os.utime(orphan, (stale, stale))
+
+    assert job_queue.prune_results() == 2
+    assert not os.path.exists(old_result)
+    assert not orphan.exists()
+    assert os.path.exists(new_result)
+    old_job = job_queue.get_job(old_id)
+    assert old_job["state"] == "succeeded"
+    assert old_job["result"] is None
+    assert old_job["message"].startswith("✅ ok\n🗑️")
+    assert job_queue.get_job(new_id)["result"] == new_result
+    assert job_queue.prune_results() == 0
+
+def test_zero_retention_keeps_results(job_db, monkeypatch):
+    monkeypatch.setitem(JOB_QUEUE_CONFIG, "result_retention", 0)
+    job_id, result = _finish_with_result(job_db, "old", time.time() - 10 ** 7)
+    assert job_queue.prune_results() == 0
+    assert job_queue.get_job(job_id)["result"] == result
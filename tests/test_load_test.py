@@ -0,0 +1,33 @@
+"""
+负载测试工具测试：百分位数和请求到达时刻（benchmarks/load_test.py）
+"""
+
+from load_test import percentile, arrival_times
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 11))
+    assert percentile([], 50) is None
+    assert percentile([7], 99) == 7
+    assert percentile(values, 0) == 1
+    assert percentile(values, 50) == 5
+    assert percentile(values, 90) == 9
+    assert percentile(values, 95) == 10
+    assert percentile(values, 100) == 10
+    # 不依赖输入顺序
+    assert percentile(list(reversed(values)), 50) == 5
+
+def test_arrival_times_constant_rate():
+    assert arrival_times([(2, 3)], process="constant") == [0.5, 1.0, 1.5, 2.0, 2.5]
+    # 速率为0的阶段只占用时间
+    assert arrival_times([(0, 10), (1, 2)], process="constant") == [11.0]
+    assert arrival_times([(4, 1), (2, 1)], process="constant") == [0.25, 0.5, 0.75, 1.5]
+
+def test_arrival_times_poisson():
+    times = arrival_times([(50, 10), (10, 10)], seed=1)
+    assert times == sorted(times)
+    assert all(0 < t < 20 for t in times)
+    first = [t for t in times if t < 10]
+    assert 400 < len(first) < 600
+    assert 50 < len(times) - len(first) < 150
+    assert arrival_times([(50, 10)], seed=1) == first
+    assert arrival_times([(50, 10)], seed=2) != first
@@ -0,0 +1,157 @@
+"""
+内存策略测试：按分辨率和可用内存决定省内存开关，共用组件的管道只在切换开关时互斥
+"""
+
+import threading
+
+import pytest
+
+import memory_policy
+from config import MEMORY_POLICY
+
+GB = 1024 ** 3
+
+@pytest.fixture(autouse=True)
+def cpu_device(monkeypatch):
+    """固定为CPU设备（不导入torch），可用内存默认充足"""
+    monkeypatch.setattr(memory_policy, "get_device", lambda: "cpu")
+    monkeypatch.setattr(memory_policy, "get_available_memory", lambda: 64 * GB)
+
+def _enabled(decision):
+    return [name for name in memory_policy.MEMORY_TOGGLES if decision[name]]
+
+def test_small_image_with_plenty_of_memory_needs_nothing():
+    assert _enabled(memory_policy.decide_memory_policy(512, 512)) == []
+
+def test_large_resolution_uses_tiled_decode():
+    decision = memory_policy.decide_memory_policy(1024, 1024)
+    assert decision["vae_tiling"]
+    assert memory_policy.decide_memory_policy(1536, 768)["vae_tiling"]
+
+def test_resolution_limits():
+    with pytest.raises(ValueError):
+        memory_policy.decide_memory_policy(4096, 512)
+
+def test_low_memory_enables_attention_slicing(monkeypatch):
+    monkeypatch.setattr(memory_policy, "get_available_memory", lambda: 1 * GB)
+    decision = memory_policy.decide_memory_policy(768, 768)
+    assert decision["attention_slicing"]
+    assert decision["reasons"]
+
+def test_unknown_memory_is_conservative(monkeypatch):
+    monkeypatch.setattr(memory_policy, "get_available_memory", lambda: None)
+    assert memory_policy.decide_memory_policy(512, 512)["attention_slicing"]
+
+def test_batches_decode_one_image_at_a_time():
+    assert memory_policy.decide_memory_policy(512, 512, batch_size=4)["vae_slicing"]
+
+def test_disabled_policy(monkeypatch):
+    monkeypatch.setitem(MEMORY_POLICY, "enabled", False)
+    assert _enabled(memory_policy.decide_memory_policy(1024, 1024, batch_size=2)) == []
+    with pytest.raises(ValueError):
+        memory_policy.decide_memory_policy(1536, 1536)
+
+class FakePipeline:
+    """记录开关调用的管道，vae为同一管道池条目中共用的组件"""
+    def __init__(self, vae, supports=memory_policy.MEMORY_TOGGLES):
+        self.vae = vae
+        self.calls = []
+        for name in supports:
+            setattr(self, f"enable_{name}", lambda name=name: self.calls.append(("enable", name)))
+            setattr(self, f"disable_{name}", lambda name=name: self.calls.append(("disable", name)))
+
+class SharedVae:
+    pass
+
+def _run_in_thread(pipeline, width, height, entered, release, **kwargs):
+    def run():
+        with memory_policy.memory_policy_applied(pipeline, width, height, **kwargs):
+            entered.set()
+            release.wait(5)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def test_same_toggles_run_concurrently():
+    pipe = FakePipeline(SharedVae())
+    first_in, release = threading.Event(), threading.Event()
+    first = _run_in_thread(pipe, 512, 512, first_in, release)
+    assert first_in.wait(5)
+    calls = len(pipe.calls)
+    second_in = threading.Event()
+    second = _run_in_thread(pipe, 512, 512, second_in, release)
+    # 开关相同：不等第一个请求结束，也不再调用开关方法
+    assert second_in.wait(5)
+    assert len(pipe.calls) == calls
+    release.set()
+    first.join(5)
+    second.join(5)
+
+def test_different_toggles_wait_for_running_requests():
+    vae = SharedVae()
+    txt2img, img2img = FakePipeline(vae), FakePipeline(vae)
+    first_in, release_first = threading.Event(), threading.Event()
+    first = _run_in_thread(txt2img, 512, 512, first_in, release_first)
+    assert first_in.wait(5)
+
+    tiled_in, release_tiled = threading.Event(), threading.Event()
+    tiled = _run_in_thread(img2img, 1024, 1024, tiled_in, release_tiled)
+    assert not tiled_in.wait(0.2)
+    # 排在需要切换开关的请求后面的相同开关请求也要等待，切换不会被饿死
+    late_in, release_late = threading.Event(), threading.Event()
+    late = _run_in_thread(txt2img, 512, 512, late_in, release_late)
+    assert not late_in.wait(0.2)
+
+    release_first.set()
+    assert tiled_in.wait(5)
+    assert ("enable", "vae_tiling") in img2img.calls
+    release_tiled.set()
+    assert late_in.wait(5)
+    release_late.set()
+    for thread in (first, tiled, late):
+        thread.join(5)
+
+def test_other_pipeline_of_the_entry_applies_its_own_toggles():
+    # ControlNet管道的开关还作用在它自己的模型上，第一次使用时要等共用组件空闲后应用
+    vae = SharedVae()
+    txt2img, controlnet = FakePipeline(vae), FakePipeline(vae)
+    first_in, release = threading.Event(), threading.Event()
+    first = _run_in_thread(txt2img, 512, 512, first_in, release)
+    assert first_in.wait(5)
+    second_in = threading.Event()
+    second = _run_in_thread(controlnet, 512, 512, second_in, threading.Event())
+    assert not second_in.wait(0.2)
+    release.set()
+    assert second_in.wait(5)
+    assert controlnet.calls
+    first.join(5)
+
+def test_exclusive_waits_and_blocks():
+    pipe = FakePipeline(SharedVae())
+    first_in, release_first = threading.Event(), threading.Event()
+    first = _run_in_thread(pipe, 512, 512, first_in, release_first)
+    assert first_in.wait(5)
+    exclusive_in, release_exclusive = threading.Event(), threading.Event()
+    exclusive = _run_in_thread(pipe, 512, 512, exclusive_in, release_exclusive, exclusive=True)
+    assert not exclusive_in.wait(0.2)
+    release_first.set()
+    assert exclusive_in.wait(5)
+    other_in = threading.Event()
+    other = _run_in_thread(pipe, 512, 512, other_in, threading.Event())
+    assert not other_in.wait(0.2)
+    release_exclusive.set()
+    assert other_in.wait(5)
+    first.join(5)
+    exclusive.join(5)
+
+def test_unsupported_toggles_are_dropped():
+    pipe = FakePipeline(SharedVae(), supports=())
+    with memory_policy.memory_policy_applied(pipe, 1024, 1024) as decision:
+        assert not decision["vae_tiling"]
+        assert "后端不支持vae_tiling" in decision["reasons"]
+    with pytest.raises(ValueError):
+        with memory_policy.memory_policy_applied(pipe, 1536, 1536):
+            pass
+    # 出错的请求不会留在队列中
+    with memory_policy.memory_policy_applied(pipe, 512, 512):
+        pass
@@ -0,0 +1,69 @@
+"""
+Prometheus文本格式导出测试
+"""
+
+import pytest
+
+import metrics
+from config import METRICS_CONFIG
+
+@pytest.fixture(autouse=True)
+def empty_metrics(monkeypatch):
+    """每个测试从空的指标值开始，不注册采集函数"""
+    monkeypatch.setattr(metrics, "_values", {name: {} for name in metrics.METRICS})
+    monkeypatch.setattr(metrics, "_collectors", [])
+
+def _series(text, prefix):
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+def test_every_metric_has_help_and_type():
+    text = metrics.render_prometheus()
+    for name, (kind, help_text, _) in metrics.METRICS.items():
+        assert f"# HELP {name} {help_text}" in text
+        assert f"# TYPE {name} {kind}" in text
+    assert text.endswith("\n")
+
+def test_counter_labels_follow_definition_order():
+    metrics.inc("sd_generation_requests_total", pipeline="txt2img", mode="api", model="m", outcome="ok")
+    metrics.inc("sd_generation_requests_total", 2, pipeline="txt2img", mode="api", model="m", outcome="ok")
+    lines = _series(metrics.render_prometheus(), "sd_generation_requests_total{")
+    assert lines == ['sd_generation_requests_total{mode="api",model="m",pipeline="txt2img",outcome="ok"} 3']
+
+def test_label_values_are_escaped():
+    metrics.inc("sd_cache_requests_total", cache='a"b\\c\nd', result="hit")
+    lines = _series(metrics.render_prometheus(), "sd_cache_requests_total{")
+    assert lines == ['sd_cache_requests_total{cache="a\\"b\\\\c\\nd",result="hit"} 1']
+
+def test_histogram_buckets_are_cumulative():
+    buckets = METRICS_CONFIG["buckets"]
+    for value in (0.003, 0.2, 0.2, 1000):
+        metrics.observe("sd_generation_seconds", value, mode="local", model="m", pipeline="txt2img")
+    text = metrics.render_prometheus()
+    labels = 'mode="local",model="m",pipeline="txt2img"'
+    bucket_lines = _series(text, "sd_generation_seconds_bucket{")
+    assert len(bucket_lines) == len(buckets) + 1
+    assert f'sd_generation_seconds_bucket{{{labels},le="0.005"}} 1' in bucket_lines
+    assert f'sd_generation_seconds_bucket{{{labels},le="0.25"}} 3' in bucket_lines
+    assert f'sd_generation_seconds_bucket{{{labels},le="120"}} 3' in bucket_lines
+    assert bucket_lines[-1] == f'sd_generation_seconds_bucket{{{labels},le="+Inf"}} 4'
+    counts = [int(line.rsplit(" ", 1)[1]) for line in bucket_lines]
+    assert counts == sorted(counts)
+    assert f"sd_generation_seconds_count{{{labels}}} 4" in text
+    assert f"sd_generation_seconds_sum{{{labels}}} 1000.403000" in text
+
+def test_custom_buckets_and_gauges():
+    metrics.observe("sd_request_peak_memory_bytes", 200 * 1024 ** 2, device="cpu", mode="local", model="m", pipeline="txt2img")
+    metrics.replace_gauges("sd_process_memory_bytes", [({"kind": "rss"}, 123), ({"kind": "peak_rss"}, 456)])
+    text = metrics.render_prometheus()
+    # 内存直方图使用自己的分桶（128MB起），整数上界不带小数
+    assert 'le="134217728"} 0' in text
+    assert 'le="268435456"} 1' in text
+    assert 'sd_process_memory_bytes{kind="rss"} 123' in text
+    assert 'sd_process_memory_bytes{kind="peak_rss"} 456' in text
+
+def test_collectors_run_before_export():
+    metrics.register_collector(lambda: metrics.set_gauge("sd_cache_disk_bytes", 42, cache="outputs"))
+    def broken():
+        raise RuntimeError("boom")
+    metrics.register_collector(broken)
+    assert 'sd_cache_disk_bytes{cache="outputs"} 42' in metrics.render_prometheus()
@@ -0,0 +1,85 @@
+"""
+本地模拟推理API测试：按Token的滑动窗口限流（429）和模型冷启动（503 + estimated_time）
+"""
+
+import json
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mock_hf_api import start_mock_server, known_models
+
+MODEL_ID = sorted(known_models())[0]
+
+@pytest.fixture
+def mock_api():
+    """启动模拟服务（随机端口），返回按配置启动服务的函数"""
+    servers = []
+    def start(**options):
+        server, url = start_mock_server(latency="fixed:0", **options)
+        servers.append(server)
+        return url
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def _request(url, method="POST", token="hf_test"):
+    """发送文生图请求，返回 (状态码, 响应头, 响应体)"""
+    body = json.dumps({"inputs": "a cat", "parameters": {"width": 64, "height": 64}}).encode("utf-8")
+    request = urllib.request.Request(f"{url}/models/{MODEL_ID}", data=body if method == "POST" else None, method=method,
+                                     headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+def test_generation_returns_png(mock_api):
+    url = mock_api()
+    status, headers, body = _request(url)
+    assert status == 200
+    assert headers["Content-Type"] == "image/png"
+    assert body.startswith(b"\x89PNG\r\n\x1a\n")
+
+def test_rate_limit_per_token(mock_api):
+    url = mock_api(rate_limit=2, rate_window=60)
+    assert _request(url)[0] == 200
+    assert _request(url)[0] == 200
+    status, headers, _ = _request(url)
+    assert status == 429
+    assert 0 < int(headers["Retry-After"]) <= 60
+    # 其他Token有自己的窗口
+    assert _request(url, token="hf_other")[0] == 200
+
+def test_rate_limit_window_slides(mock_api):
+    url = mock_api(rate_limit=1, rate_window=0.3)
+    assert _request(url)[0] == 200
+    assert _request(url)[0] == 429
+    time.sleep(0.4)
+    assert _request(url)[0] == 200
+
+def test_cold_start_returns_503_until_loaded(mock_api):
+    url = mock_api(cold_start=0.5)
+    status, _, body = _request(url)
+    assert status == 503
+    assert 0 < json.loads(body)["estimated_time"] <= 0.5
+    # 加载期间连接测试也返回503
+    assert _request(url, method="HEAD")[0] == 503
+    time.sleep(0.6)
+    assert _request(url)[0] == 200
+    assert _request(url, method="HEAD")[0] == 200
+
+def test_idle_model_is_unloaded(mock_api):
+    url = mock_api(cold_start=0.1, idle_unload=0.5)
+    assert _request(url)[0] == 503
+    time.sleep(0.2)
+    assert _request(url)[0] == 200
+    time.sleep(0.7)
+    assert _request(url)[0] == 503
+
+def test_missing_token_is_rejected(mock_api):
+    url = mock_api()
+    assert _request(url, token="")[0] == 401
@@ -0,0 +1,62 @@
+"""
+端口发现测试：解析 /proc/net/tcp 监听表，跳过被占用的端口
+"""
+
+import io
+import socket
+
+import pytest
+
+pytest.importorskip("requests")
+
+import utils
+
+TCP_TABLE = """  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000:1EB4 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 11111 1 0000000000000000 100 0 0 10 0
+   1: 0100007F:1EB5 0100007F:9C40 01 00000000:00000000 00:00000000 00000000  1000        0 22222 1 0000000000000000 20 4 30 10 -1
+   2: 0100007F:22B8 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 33333 1 0000000000000000 100 0 0 10 0
+"""
+TCP6_TABLE = """  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:1EB4 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 44444 1 0000000000000000 100 0 0 10 0
+"""
+
+def _fake_proc(tables):
+    def fake_open(path, *args, **kwargs):
+        if path not in tables:
+            raise FileNotFoundError(path)
+        return io.StringIO(tables[path])
+    return fake_open
+
+def test_parses_listening_sockets_only(monkeypatch):
+    monkeypatch.setattr(utils, "open", _fake_proc({"/proc/net/tcp": TCP_TABLE, "/proc/net/tcp6": TCP6_TABLE}), raising=False)
+    # 0x1EB4 = 7860（IPv4和IPv6各一个），0x1EB5 为已建立的连接，0x22B8 = 8888
+    assert utils._read_listening_sockets() == {7860: {"11111", "44444"}, 8888: {"33333"}}
+    assert utils.get_listening_ports() == {7860, 8888}
+
+def test_missing_proc_returns_none(monkeypatch):
+    monkeypatch.setattr(utils, "open", _fake_proc({}), raising=False)
+    assert utils._read_listening_sockets() is None
+    assert utils.get_listening_ports() is None
+
+def test_find_free_port_skips_listening_ports(monkeypatch):
+    monkeypatch.setattr(utils, "get_listening_ports", lambda: {7860, 7861})
+    monkeypatch.setattr(utils, "_can_bind", lambda port: True)
+    assert utils.find_free_port(7860, max_attempts=5) == 7862
+
+def test_find_free_port_falls_back_to_os_port(monkeypatch):
+    monkeypatch.setattr(utils, "get_listening_ports", lambda: None)
+    monkeypatch.setattr(utils, "_can_bind", lambda port: False)
+    monkeypatch.setattr(utils, "allocate_os_port", lambda: 45678)
+    assert utils.find_free_port(7860, max_attempts=3) == 45678
+
+def test_real_listening_socket_is_detected():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+        listening = utils.get_listening_ports()
+        if listening is None:
+            pytest.skip("当前系统没有 /proc/net/tcp")
+        assert port in listening
+        assert not utils.is_port_available(port)
+        assert utils.find_free_port(port, max_attempts=1) != port
@@ -0,0 +1,74 @@
+"""
+会话隔离测试：各会话按自己的设置从共享管道池取管道，加载模型不影响其他会话
+"""
+
+import pytest
+
+import models
+from session import create_session
+
+@pytest.fixture(autouse=True)
+def fake_loaders(monkeypatch):
+    """用占位对象代替真实的管道加载，记录加载次数"""
+    loads = []
+    def load_base(selected_model, local_backend):
+        loads.append(("base", selected_model, local_backend))
+        return {"pipe": f"pipe:{selected_model}", "img2img_pipe": f"img2img:{selected_model}",
+                "controlnet_pipes": {}, "backend_name": local_backend}
+    def load_controlnet(entry, selected_model, local_backend, controlnet_type):
+        loads.append(("controlnet", selected_model, controlnet_type))
+        return f"controlnet:{selected_model}:{controlnet_type}"
+    monkeypatch.setattr(models, "_load_local_base", load_base)
+    monkeypatch.setattr(models, "_load_local_controlnet", load_controlnet)
+    monkeypatch.setattr(models, "describe_entry_memory", lambda entry: "")
+    monkeypatch.setattr(models, "get_device", lambda: "cpu")
+    monkeypatch.setattr(models, "PIPELINE_POOL_SIZE", 2)
+    monkeypatch.setattr(models, "_pipeline_pool", models.OrderedDict())
+    monkeypatch.setattr(models, "_load_locks", {})
+    yield loads
+
+def _load(session, model, controlnet="canny"):
+    return models.load_models("local", model, controlnet, session=session)
+
+def test_unloaded_session_has_no_pipelines():
+    assert models.get_session_pipelines(create_session()) == {"pipe": None, "img2img_pipe": None, "controlnet_pipe": None}
+
+def test_sessions_get_their_own_model(fake_loaders):
+    first, second = create_session(), create_session()
+    assert _load(first, "model-a").startswith("✅")
+    assert _load(second, "model-b", "depth").startswith("✅")
+    assert models.get_session_pipelines(first) == {"pipe": "pipe:model-a", "img2img_pipe": "img2img:model-a",
+                                                   "controlnet_pipe": "controlnet:model-a:canny"}
+    assert models.get_session_pipelines(second)["controlnet_pipe"] == "controlnet:model-b:depth"
+    # 会话加载不改变进程默认会话
+    assert models.pipe is None
+
+def test_same_model_is_loaded_once(fake_loaders):
+    first, second = create_session(), create_session()
+    _load(first, "model-a")
+    _load(second, "model-a")
+    assert fake_loaders == [("base", "model-a", "pytorch"), ("controlnet", "model-a", "canny")]
+    assert models.get_session_pipelines(first) == models.get_session_pipelines(second)
+
+def test_api_session_is_not_affected_by_local_loads():
+    api = create_session(run_mode="api")
+    assert models.load_models("api", "runwayml/stable-diffusion-v1-5", session=api).startswith("✅")
+    _load(create_session(), "model-a")
+    assert models.get_session_pipelines(api)["pipe"] == "api_mode"
+    assert api["run_mode"] == "api"
+
+def test_evicted_model_needs_reloading(monkeypatch, fake_loaders):
+    monkeypatch.setattr(models, "PIPELINE_POOL_SIZE", 1)
+    first, second = create_session(), create_session()
+    _load(first, "model-a")
+    _load(second, "model-b")
+    # 容量为1时第二个模型淘汰第一个，第一个会话需要重新加载
+    assert models.get_session_pipelines(first)["pipe"] is None
+    assert models.get_session_pipelines(second)["pipe"] == "pipe:model-b"
+
+def test_alternating_models_stay_in_pool(fake_loaders):
+    first, second = create_session(), create_session()
+    _load(first, "model-a")
+    _load(second, "model-b")
+    _load(first, "model-a")
+    assert [load for load in fake_loaders if load[0] == "base"] == [("base", "model-a", "pytorch"), ("base", "model-b", "pytorch")]
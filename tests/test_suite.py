@@ -0,0 +1,62 @@
+"""
+基准测试套件测试：与基线比较（benchmarks/suite.py）
+"""
+
+import pytest
+
+from suite import compare
+
+def _report(results=None, skipped=None, failed=None, pattern=None):
+    return {"results": {name: {"median_ms": value} for name, value in (results or {}).items()},
+            "skipped": skipped or {}, "failed": failed or {}, "filter": pattern}
+
+def _baseline(results, thresholds=None):
+    baseline = {"results": {name: {"median_ms": value} for name, value in results.items()}}
+    if thresholds:
+        baseline["thresholds"] = thresholds
+    return baseline
+
+def _statuses(rows):
+    return {name: status for name, _, _, _, status in rows}
+
+def test_compare_within_threshold_passes():
+    rows, regressed = compare(_report({"a": 10.5, "b": 5.0}), _baseline({"a": 10.0, "b": 10.0}))
+    assert not regressed
+    statuses = _statuses(rows)
+    assert statuses["a"] == "✅"
+    assert statuses["b"] == "🚀 变快"
+
+def test_compare_slowdown_regresses():
+    rows, regressed = compare(_report({"a": 12.0}), _baseline({"a": 10.0}), threshold=0.15)
+    assert regressed
+    name, base, current, change, status = rows[0]
+    assert (name, base, current) == ("a", 10.0, 12.0)
+    assert change == pytest.approx(0.2)
+    assert status.startswith("❌")
+
+def test_compare_per_scenario_threshold_override():
+    rows, regressed = compare(_report({"a": 12.0}), _baseline({"a": 10.0}, thresholds={"a": 0.5}))
+    assert not regressed
+    assert _statuses(rows)["a"] == "✅"
+
+def test_compare_new_scenario_is_not_a_regression():
+    rows, regressed = compare(_report({"new": 1.0}), _baseline({}))
+    assert not regressed
+    assert _statuses(rows)["new"] == "🆕 无基线"
+
+def test_compare_missing_skipped_and_failed_scenarios_regress():
+    report = _report({"a": 10.0}, skipped={"b": "未安装torch"}, failed={"c": "boom", "d": "crash"})
+    rows, regressed = compare(report, _baseline({"a": 10.0, "b": 1.0, "c": 1.0, "e": 1.0}))
+    assert regressed
+    statuses = _statuses(rows)
+    assert statuses["b"].startswith("⚠️ 跳过")
+    assert statuses["c"] == "❌ 运行失败: boom"
+    # 基线中没有的失败场景同样算回退
+    assert statuses["d"] == "❌ 运行失败: crash"
+    assert statuses["e"] == "⚠️ 本次未运行"
+
+def test_compare_filter_ignores_scenarios_outside_it():
+    rows, regressed = compare(_report({"encode_256": 1.0}, pattern="encode"),
+                              _baseline({"encode_256": 1.0, "decode_256": 1.0}))
+    assert not regressed
+    assert "decode_256" not in _statuses(rows)
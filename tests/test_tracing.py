@@ -0,0 +1,57 @@
+"""
+追踪树格式化测试
+"""
+
+import tracing
+from tracing import format_trace
+
+def _span(span_id, name, parent_id=None, start=0.0, duration_ms=1.0, status="ok", **attributes):
+    return {"trace_id": "t1", "span_id": span_id, "parent_id": parent_id, "name": name, "start": start,
+            "duration_ms": duration_ms, "status": status, "attributes": attributes}
+
+def test_children_are_indented_and_sorted_by_start():
+    spans = [
+        _span("c2", "vae_decode", parent_id="root", start=3.0, duration_ms=20.0),
+        _span("root", "POST /v1/txt2img", start=0.0, duration_ms=120.5, lane="api"),
+        _span("c1", "queue.wait", parent_id="root", start=1.0, duration_ms=5.0),
+        _span("g1", "unet", parent_id="c2", start=3.5, duration_ms=10.0),
+    ]
+    lines = format_trace(spans).splitlines()
+    assert [line.split()[0] for line in lines] == ["POST", "queue.wait", "vae_decode", "unet"]
+    assert lines[0].startswith("POST /v1/txt2img")
+    assert lines[1].startswith("  queue.wait")
+    assert lines[2].startswith("  vae_decode")
+    assert lines[3].startswith("    unet")
+    assert "120.5 ms" in lines[0]
+    assert lines[0].endswith("lane=api")
+
+def test_error_status_is_shown():
+    lines = format_trace([_span("root", "generate.txt2img", status="error: boom")]).splitlines()
+    assert "[error: boom]" in lines[0]
+
+def test_orphan_spans_are_listed_as_roots():
+    # 父span尚未写出（例如生成线程在请求结束后才结束）时，子span作为根显示
+    spans = [
+        _span("root", "POST /v1/txt2img", start=0.0),
+        _span("late", "generate.txt2img", parent_id="missing", start=2.0),
+    ]
+    lines = format_trace(spans).splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith("generate.txt2img")
+
+def test_empty_trace():
+    assert format_trace([]) == ""
+
+def test_disabled_tracing_records_nothing(monkeypatch, tmp_path):
+    monkeypatch.setitem(tracing.TRACING_CONFIG, "exporter", "none")
+    monkeypatch.setitem(tracing.TRACING_CONFIG, "path", str(tmp_path / "traces.jsonl"))
+    assert not tracing.enabled()
+    with tracing.span("generate.txt2img") as span_record:
+        assert span_record is None
+        assert tracing.current_trace_id() is None
+    assert tracing._export_queue.empty()
+    assert not (tmp_path / "traces.jsonl").exists()
+
+def test_viewer_reports_missing_file(tmp_path, capsys):
+    tracing.main(["--file", str(tmp_path / "missing.jsonl")])
+    assert "SD_TRACE_EXPORTER=jsonl" in capsys.readouterr().out
@@ -0,0 +1,273 @@
+"""
+追踪模块 - 为每个界面事件/服务请求生成trace ID，把各层操作记录为嵌套span
+
+当前span保存在contextvars中：界面处理函数（concurrency.limited）或服务请求开启根span，
+生成函数、阶段计时和API客户端在其下开启子span，后台生成线程通过复制上下文继承。
+span结束后交给后台线程导出到本地JSONL文件或OTLP/HTTP(JSON)收集器，不阻塞请求。
+追踪默认关闭，通过 SD_TRACE_EXPORTER=jsonl|otlp 开启。
+
+查看最慢的请求：
+    python tracing.py --slowest 10
+    python tracing.py --trace <trace_id>
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import TRACING_CONFIG
+
+_current_span = contextvars.ContextVar("sd_current_span", default=None)
+
+# 待导出的span队列，由后台线程批量写出
+_export_queue = queue.Queue()
+_exporter_thread = None
+_exporter_lock = threading.Lock()
+
+def _new_id(num_bytes):
+    return os.urandom(num_bytes).hex()
+
+def enabled():
+    """是否记录追踪"""
+    return TRACING_CONFIG["exporter"] != "none"
+
+def current_span():
+    """当前span，不在追踪中时为None"""
+    return _current_span.get()
+
+def current_trace_id():
+    """当前trace ID，不在追踪中时为None"""
+    span_record = _current_span.get()
+    return span_record["trace_id"] if span_record else None
+
+def start_span(name, parent=None, **attributes):
+    """创建span（不设为当前span），parent为None时使用当前span，没有当前span时开启新trace"""
+    parent = parent or _current_span.get()
+    return {
+        "trace_id": parent["trace_id"] if parent else _new_id(16),
+        "span_id": _new_id(8),
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start": time.time(),
+        "attributes": dict(attributes),
+        "status": "ok",
+        "_perf_start": time.perf_counter(),
+    }
+
+def end_span(span_record, error=None):
+    """结束span并交给导出线程"""
+    span_record["duration_ms"] = round((time.perf_counter() - span_record.pop("_perf_start")) * 1000, 3)
+    if isinstance(error, GeneratorExit):
+        span_record["status"] = "cancelled"
+    elif error is not None:
+        span_record["status"] = "error"
+        span_record["error"] = f"{type(error).__name__}: {error}"[:300]
+    _export(span_record)
+
+@contextmanager
+def activate(span_record):
+    """在代码块内把已有span设为当前span（生成器处理函数每次恢复执行时使用），None时不做任何事"""
+    if span_record is None:
+        yield None
+        return
+    token = _current_span.set(span_record)
+    try:
+        yield span_record
+    finally:
+        _current_span.reset(token)
+
+@contextmanager
+def span(name, **attributes):
+    """在代码块内开启子span（没有当前span时开启新trace），未启用追踪时返回None"""
+    if not enabled():
+        yield None
+        return
+    span_record = start_span(name, **attributes)
+    error = None
+    token = _current_span.set(span_record)
+    try:
+        yield span_record
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(span_record, error)
+
+def set_attributes(**attributes):
+    """给当前span补充属性（例如响应大小、状态码）"""
+    span_record = _current_span.get()
+    if span_record is not None:
+        span_record["attributes"].update(attributes)
+
+def record_span(name, duration, **attributes):
+    """记录一个刚结束、耗时已知的子span（例如排队等待）"""
+    if not enabled() or _current_span.get() is None:
+        return
+    span_record = start_span(name, **attributes)
+    span_record["start"] -= duration
+    span_record["_perf_start"] -= duration
+    end_span(span_record)
+
+def _export(span_record):
+    """把结束的span放入导出队列，首次使用时启动导出线程"""
+    global _exporter_thread
+    if not enabled():
+        return
+    if _exporter_thread is None:
+        with _exporter_lock:
+            if _exporter_thread is None:
+                _exporter_thread = threading.Thread(target=_export_loop, name="trace-exporter", daemon=True)
+                _exporter_thread.start()
+    _export_queue.put(span_record)
+
+def _export_loop():
+    """后台导出：攒批写出，遇到flush标记时通知等待方"""
+    while True:
+        batch, waiters = [], []
+        item = _export_queue.get()
+        while True:
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            else:
+                batch.append(item)
+            if len(batch) >= 256:
+                break
+            try:
+                item = _export_queue.get_nowait()
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                if TRACING_CONFIG["exporter"] == "otlp":
+                    _export_otlp(batch)
+                else:
+                    _export_jsonl(batch)
+            except Exception as e:
+                print(f"⚠️ 追踪导出失败: {e}")
+        for waiter in waiters:
+            waiter.set()
+
+def _export_jsonl(batch):
+    """追加写入JSONL文件，每行一个span，超过大小上限时轮转"""
+    path = TRACING_CONFIG["path"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path) and os.path.getsize(path) > TRACING_CONFIG["max_file_bytes"]:
+        os.replace(path, path + ".1")
+    with open(path, "a", encoding="utf-8") as f:
+        for span_record in batch:
+            f.write(json.dumps(span_record, ensure_ascii=False, default=str) + "\n")
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _export_otlp(batch):
+    """按OTLP/HTTP JSON格式发送到收集器"""
+    import urllib.request
+    spans = []
+    for span_record in batch:
+        start_ns = int(span_record["start"] * 1e9)
+        otlp_span = {
+            "traceId": span_record["trace_id"],
+            "spanId": span_record["span_id"],
+            "name": span_record["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int(span_record["duration_ms"] * 1e6)),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span_record["attributes"].items()],
+            "status": {"code": 2, "message": span_record.get("error", "")} if span_record["status"] == "error" else {"code": 1},
+        }
+        if span_record["parent_id"]:
+            otlp_span["parentSpanId"] = span_record["parent_id"]
+        spans.append(otlp_span)
+    payload = {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "sd_frontend"}}]},
+        "scopeSpans": [{"scope": {"name": "sd_frontend"}, "spans": spans}],
+    }]}
+    request = urllib.request.Request(
+        TRACING_CONFIG["otlp_endpoint"], data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST"
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        response.read()
+
+def flush(timeout=2.0):
+    """等待已结束的span导出完成（关闭时调用）"""
+    if _exporter_thread is None:
+        return True
+    done = threading.Event()
+    _export_queue.put(done)
+    return done.wait(timeout)
+
+def load_traces(path=None):
+    """读取JSONL追踪文件，返回 {trace_id: [span, ...]}"""
+    traces = {}
+    with open(path or TRACING_CONFIG["path"], encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                span_record = json.loads(line)
+                traces.setdefault(span_record["trace_id"], []).append(span_record)
+    return traces
+
+def format_trace(spans):
+    """把一个trace的span格式化为缩进树"""
+    children = {}
+    for span_record in spans:
+        children.setdefault(span_record["parent_id"], []).append(span_record)
+    span_ids = {span_record["span_id"] for span_record in spans}
+    # 根span，或父span尚未写出（例如生成线程在请求结束后才结束）的span
+    roots = [s for s in spans if s["parent_id"] is None or s["parent_id"] not in span_ids]
+
+    lines = []
+    def walk(span_record, depth):
+        attributes = " ".join(f"{k}={v}" for k, v in span_record["attributes"].items())
+        status = "" if span_record["status"] == "ok" else f" [{span_record['status']}]"
+        lines.append(f"{'  ' * depth}{span_record['name']:<{40 - 2 * depth}} {span_record['duration_ms']:>10.1f} ms{status}  {attributes}")
+        for child in sorted(children.get(span_record["span_id"], []), key=lambda s: s["start"]):
+            walk(child, depth + 1)
+    for root in sorted(roots, key=lambda s: s["start"]):
+        walk(root, 0)
+    return "\n".join(lines)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="查看请求追踪")
+    parser.add_argument("--file", help=f"追踪文件（默认 {TRACING_CONFIG['path']}）")
+    parser.add_argument("--slowest", type=int, default=5, help="显示耗时最长的N个请求")
+    parser.add_argument("--trace", help="只显示指定trace ID")
+    parser.add_argument("--name", help="只统计根span名称包含该字符串的请求")
+    args = parser.parse_args(argv)
+
+    path = args.file or TRACING_CONFIG["path"]
+    if not os.path.exists(path):
+        print(f"❌ 追踪文件不存在: {path}\n💡 追踪默认关闭，设置 SD_TRACE_EXPORTER=jsonl 后重启以记录请求")
+        return
+    traces = load_traces(path)
+    if args.trace:
+        selected = [traces.get(args.trace, [])]
+    else:
+        ranked = []
+        for spans in traces.values():
+            roots = [s for s in spans if s["parent_id"] is None]
+            if roots and (not args.name or args.name in roots[0]["name"]):
+                ranked.append((roots[0]["duration_ms"], spans))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        selected = [spans for _, spans in ranked[:args.slowest]]
+
+    for spans in selected:
+        if spans:
+            print(f"🔎 trace {spans[0]['trace_id']}")
+            print(format_trace(spans))
+            print()
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,10 @@
 import subprocess
 import os
 import signal
-import atexit
-import sys
 import socket
 from datetime import datetime
 import requests
-from config import PROXY_CONFIG
+from config import PROXY_CONFIG, HF_API_CONFIG
 
 # 全局变量用于存储Gradio应用实例和端口信息
 demo_instance = None
@@ -28,48 +26,81 @@ def get_gradio_info():
     return demo_instance, server_port
 
 def cleanup_on_exit():
-    """程序退出时的清理函数"""
-    try:
-        print("\n🔄 正在清理资源...")
-        
-        # 关闭Gradio应用
-        if demo_instance is not None:
-            print("📴 关闭Gradio应用...")
+    """程序退出时的清理函数：交给关闭协调器，多次调用只清理一次"""
+    from shutdown import graceful_shutdown
+    graceful_shutdown()
+
+def _read_listening_sockets():
+    """Linux下解析 /proc/net/tcp{,6}，返回 {端口: {socket inode}}（仅LISTEN状态）；不支持时返回None"""
+    listening = {}
+    readable = False
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as f:
+                readable = True
+                next(f, None)  # 表头
+                for line in f:
+                    fields = line.split()
+                    # fields[1] 为 "地址:端口(十六进制)"，fields[3] 为状态，0A 表示LISTEN，fields[9] 为inode
+                    if len(fields) < 10 or fields[3] != "0A":
+                        continue
+                    port = int(fields[1].rsplit(":", 1)[1], 16)
+                    listening.setdefault(port, set()).add(fields[9])
+        except OSError:
+            continue
+    return listening if readable else None
+
+def get_listening_ports():
+    """获取正在监听的TCP端口集合（Linux），其他系统返回None"""
+    listening = _read_listening_sockets()
+    return None if listening is None else set(listening)
+
+def get_port_pids(port):
+    """查找监听指定端口的进程PID（Linux直接读取/proc，不启动子进程）"""
+    listening = _read_listening_sockets()
+    if listening is None:
+        return _get_port_pids_lsof(port)
+    
+    targets = {f"socket:[{inode}]" for inode in listening.get(port, ())}
+    pids = set()
+    if not targets:
+        return pids
+    
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        fd_dir = f"/proc/{entry}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue  # 进程已退出或无权限
+        for fd in fds:
             try:
-                # 尝试优雅关闭
-                if hasattr(demo_instance, 'server') and demo_instance.server:
-                    demo_instance.server.should_exit = True
-                    demo_instance.server.force_exit = True
-                
-                # 关闭demo实例
-                demo_instance.close()
-                print("✅ Gradio应用已关闭")
-                
-                # 给一点时间让服务器完全关闭
-                import time
-                time.sleep(1)
-                
-            except Exception as e:
-                print(f"⚠️ 关闭Gradio应用时出现错误: {e}")
-        
-        # 强制释放端口（多个端口）
-        ports_to_clean = []
-        if server_port is not None:
-            ports_to_clean.append(server_port)
-        
-        # 常见的Gradio端口
-        common_ports = [7860, 7861, 7862, 7863]
-        for port in common_ports:
-            if port not in ports_to_clean:
-                ports_to_clean.append(port)
-        
-        for port in ports_to_clean:
-            force_release_port(port)
-        
-        print("✅ 资源清理完成")
-        
-    except Exception as e:
-        print(f"❌ 清理过程中出现错误: {e}")
+                if os.readlink(os.path.join(fd_dir, fd)) in targets:
+                    pids.add(int(entry))
+                    break
+            except OSError:
+                continue
+    return pids
+
+def _get_port_pids_lsof(port):
+    """非Linux的Unix系统下使用lsof查找占用端口的进程"""
+    try:
+        result = subprocess.run(["lsof", "-ti", f":{port}"], capture_output=True, text=True, timeout=5)
+        return {int(pid) for pid in result.stdout.split() if pid.isdigit()}
+    except Exception:
+        return set()
+
+def wait_for_port_release(port, timeout=2.0, interval=0.05):
+    """轮询等待端口释放，返回是否在超时前释放"""
+    import time
+    deadline = time.monotonic() + timeout
+    while True:
+        if is_port_available(port):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
 
 def force_release_port(port):
     """强制释放指定端口"""
@@ -77,7 +108,6 @@ def force_release_port(port):
     
     try:
         import platform
-        import subprocess
         import time
         
         if platform.system() == "Windows":
@@ -149,34 +179,30 @@ def force_release_port(port):
                 print(f"⚠️ wmic方法失败: {e}")
         
         else:
-            # Unix系统下的端口释放
-            print(f"🐧 Unix系统 - 强制释放端口 {port}")
-            try:
-                # 使用lsof查找并终止进程
-                result = subprocess.run([
-                    "lsof", "-ti", f":{port}"
-                ], capture_output=True, text=True, timeout=5)
-                
-                if result.stdout:
-                    pids = result.stdout.strip().split('\n')
-                    for pid in pids:
-                        if pid.isdigit():
-                            try:
-                                # 先尝试SIGTERM
-                                subprocess.run(["kill", "-15", pid], timeout=3)
-                                time.sleep(0.5)
-                                # 再尝试SIGKILL
-                                subprocess.run(["kill", "-9", pid], timeout=3)
-                                print(f"🔄 已终止进程 PID: {pid}")
-                            except:
-                                pass
-                
-            except Exception as e:
-                print(f"⚠️ Unix端口清理失败: {e}")
+            # Unix系统下的端口释放：Linux直接读取/proc查找进程，用os.kill发送信号
+            pids = get_port_pids(port) - {os.getpid()}
+            if not pids:
+                print(f"✅ 端口 {port} 没有被其他进程占用")
+                return
+            
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    print(f"🔄 已向进程 PID {pid} 发送SIGTERM")
+                except OSError as e:
+                    print(f"⚠️ 终止进程 {pid} 失败: {e}")
+            
+            # 先给进程短暂的优雅退出时间，仍未释放再SIGKILL
+            if not wait_for_port_release(port, timeout=1.0):
+                for pid in pids:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        print(f"🔄 已强制终止进程 PID: {pid}")
+                    except OSError:
+                        pass
         
-        # 验证端口是否已释放
-        time.sleep(1)
-        if is_port_available(port):
+        # 验证端口是否已释放（轮询，端口释放后立即返回）
+        if wait_for_port_release(port, timeout=1.0):
             print(f"✅ 端口 {port} 已成功释放")
         else:
             print(f"⚠️ 端口 {port} 可能仍被占用")
@@ -184,72 +210,60 @@ def force_release_port(port):
     except Exception as e:
         print(f"⚠️ 释放端口 {port} 时出现错误: {e}")
 
-def is_port_available(port):
-    """检查端口是否可用"""
+def _can_bind(port):
+    """尝试绑定端口；Unix下开启SO_REUSEADDR，TIME_WAIT状态的旧连接不会导致误判为占用"""
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            if os.name != "nt":
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind(('0.0.0.0', port))
             return True
     except OSError:
         return False
 
-def signal_handler(signum, frame):
-    """信号处理函数"""
-    signal_names = {
-        signal.SIGINT: "SIGINT (Ctrl+C)",
-        signal.SIGTERM: "SIGTERM (终止信号)"
-    }
-    
-    signal_name = signal_names.get(signum, f"信号 {signum}")
-    print(f"\n🛑 接收到退出信号: {signal_name}")
-    print("🔄 正在优雅关闭应用...")
-    
-    cleanup_on_exit()
-    sys.exit(0)
+def is_port_available(port):
+    """检查端口是否可用"""
+    listening = get_listening_ports()
+    if listening is not None and port in listening:
+        return False
+    return _can_bind(port)
+
+def allocate_os_port():
+    """由操作系统分配一个空闲端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('0.0.0.0', 0))
+        return s.getsockname()[1]
 
 def setup_cleanup_handlers():
     """设置清理处理程序"""
-    # 注册信号处理
-    signal.signal(signal.SIGINT, signal_handler)  # Ctrl+C
-    signal.signal(signal.SIGTERM, signal_handler)  # 终止信号
-    
-    # 注册atexit处理
-    atexit.register(cleanup_on_exit)
-    
-    print("🛡️ 已设置自动端口释放机制")
+    from shutdown import install_shutdown_handlers
+    install_shutdown_handlers()
+    print("🛡️ 已设置优雅关闭机制")
 
-def find_free_port(start_port=7860, max_attempts=10):
-    """寻找可用端口，如果端口被占用则尝试清理"""
+def find_free_port(start_port=7860, max_attempts=10, release_busy=False):
+    """寻找可用端口：一次读取监听端口表跳过被占用的端口，范围内没有空闲端口时由系统分配；
+    release_busy=True 时才会尝试终止占用起始端口的进程"""
     print(f"🔍 正在寻找可用端口（从 {start_port} 开始）...")
     
+    listening = get_listening_ports()
     for port in range(start_port, start_port + max_attempts):
-        if is_port_available(port):
+        if listening is not None and port in listening:
+            continue
+        if _can_bind(port):
             print(f"✅ 找到可用端口: {port}")
             return port
-        else:
-            print(f"⚠️ 端口 {port} 已被占用")
-            
-            # 尝试清理被占用的端口
-            print(f"🔧 尝试清理端口 {port}...")
-            force_release_port(port)
-            
-            # 再次检查端口是否可用
-            import time
-            time.sleep(1)
-            if is_port_available(port):
-                print(f"✅ 端口 {port} 清理成功，将使用此端口")
-                return port
-            else:
-                print(f"❌ 端口 {port} 清理失败，继续尝试下一个端口...")
-                continue
     
-    print(f"❌ 在端口范围 {start_port}-{start_port + max_attempts} 内未找到可用端口")
-    # 最后的努力：强制使用起始端口
-    print(f"🚨 强制清理并使用端口 {start_port}")
-    force_release_port(start_port)
-    import time
-    time.sleep(2)
-    return start_port
+    print(f"⚠️ 端口范围 {start_port}-{start_port + max_attempts - 1} 均被占用")
+    if release_busy:
+        print(f"🔧 尝试清理端口 {start_port}...")
+        force_release_port(start_port)
+        if is_port_available(start_port):
+            print(f"✅ 端口 {start_port} 清理成功，将使用此端口")
+            return start_port
+    
+    port = allocate_os_port()
+    print(f"✅ 使用系统分配的端口: {port}")
+    return port
 
 def auto_push_to_github():
     """自动推送到 GitHub"""
@@ -313,7 +327,7 @@ def test_proxy_connection(enabled, http_proxy, https_proxy):
     try:
         # 测试连接到 Hugging Face
         response = requests.get(
-            "https://huggingface.co", 
+            HF_API_CONFIG["hub_url"], 
             proxies=proxies, 
             timeout=10
         )